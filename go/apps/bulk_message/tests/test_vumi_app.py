@@ -122,6 +122,71 @@ class TestBulkMessageApplication(VumiTestCase):
         self.assertEqual(
             (yield self.app.window_manager.count_in_flight(window_id)), 0)
 
+    @inlineCallbacks
+    def test_bulk_send_dedupe(self):
+        group = yield self.app_helper.create_group(u'group')
+        for name in [u'a', u'b']:
+            yield self.app_helper.create_contact(
+                msisdn=u'+27831234567', name=name, groups=[group])
+        yield self.app_helper.create_contact(
+            msisdn=u'+27831234568', groups=[group])
+        conversation = yield self.app_helper.create_conversation(
+            groups=[group])
+        batch_id = conversation.batch.key
+        yield self.app_helper.dispatch_command(
+            "bulk_send",
+            user_account_key=conversation.user_account.key,
+            conversation_key=conversation.key,
+            batch_id=batch_id,
+            dedupe=True,
+            content="hello world",
+            delivery_class="sms",
+            msg_options={},
+        )
+        window_id = self.app.get_window_id(conversation.key, batch_id)
+        self.assertEqual(
+            (yield self.app.window_manager.count_waiting(window_id)), 2)
+        # The dedupe set is cleaned up once the send has been enqueued.
+        self.assertEqual((yield self.app.dedupe_redis.keys()), [])
+
+    @inlineCallbacks
+    def test_bulk_send_in_batches(self):
+        self.app.enqueue_batch_size = 1
+        conversation = yield self.setup_conversation()
+        batch_id = conversation.batch.key
+        yield self.app_helper.dispatch_command(
+            "bulk_send",
+            user_account_key=conversation.user_account.key,
+            conversation_key=conversation.key,
+            batch_id=batch_id,
+            dedupe=False,
+            content="hello world",
+            delivery_class="sms",
+            msg_options={},
+        )
+        window_id = self.app.get_window_id(conversation.key, batch_id)
+        self.assertEqual(
+            (yield self.app.window_manager.count_waiting(window_id)), 2)
+
+    @inlineCallbacks
+    def test_bulk_send_publishes_enqueue_progress(self):
+        conversation = yield self.setup_conversation()
+        yield self.app_helper.dispatch_command(
+            "bulk_send",
+            user_account_key=conversation.user_account.key,
+            conversation_key=conversation.key,
+            batch_id=conversation.batch.key,
+            dedupe=False,
+            content="hello world",
+            delivery_class="sms",
+            msg_options={},
+        )
+        prefix = "go.campaigns.test-0-user.conversations.%s" % (
+            conversation.key,)
+        self.assertEqual(
+            self.app_helper.get_published_metrics(self.app),
+            [("%s.bulk_send.enqueued" % (prefix,), 2)])
+
     @inlineCallbacks
     def test_send_message_command(self):
         msg_options = {
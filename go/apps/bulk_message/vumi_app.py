@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 
 """Vumi application worker for the vumitools API."""
-from twisted.internet.defer import inlineCallbacks
+import uuid
 
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+
+from vumi.blinkenlights.metrics import Metric, LAST
 from vumi.components.window_manager import WindowManager
 from vumi import log
 
@@ -19,6 +22,15 @@ class BulkMessageApplication(GoApplicationWorker):
     max_ack_wait = 100
     monitor_interval = 20
     monitor_window_cleanup = True
+    # Number of flights pushed into the window concurrently while enqueuing.
+    enqueue_batch_size = 100
+    # Seconds to keep the set of already enqueued addresses used for dedupe.
+    dedupe_ttl = 24 * 60 * 60
+    # Check recipients against a snapshot of the account's opt-out keys taken
+    # at the start of the send rather than looking them up for each bunch.
+    # The snapshot is a single index lookup and holds only keys, so it stays
+    # cheap for accounts with many opt-outs too.
+    snapshot_opt_outs = True
 
     @inlineCallbacks
     def setup_application(self):
@@ -32,6 +44,8 @@ class BulkMessageApplication(GoApplicationWorker):
             interval=self.monitor_interval,
             cleanup=self.monitor_window_cleanup,
             cleanup_callback=self.on_window_cleanup)
+        self.dedupe_redis = self.redis.sub_manager('%s:dedupe' % (
+            self.worker_name,))
 
     @inlineCallbacks
     def teardown_application(self):
@@ -56,15 +70,46 @@ class BulkMessageApplication(GoApplicationWorker):
         return ':'.join([conversation_key, batch_id])
 
     @inlineCallbacks
-    def send_message_via_window(self, conv, window_id, batch_id, to_addr,
-                                msg_options, content):
-        yield self.window_manager.create_window(window_id, strict=False)
-        yield self.window_manager.add(window_id, {
-            'batch_id': batch_id,
-            'to_addr': to_addr,
-            'content': content,
-            'msg_options': msg_options,
-            })
+    def filter_duplicate_addresses(self, dedupe_key, to_addresses):
+        """
+        Return the addresses in `to_addresses` that haven't already been
+        seen for this send.
+
+        The addresses seen so far are kept in a Redis set rather than in
+        memory so that very large sends don't need to hold every recipient.
+        """
+        to_addresses = list(set(to_addresses))
+        added = yield gatherResults([
+            self.dedupe_redis.sadd(dedupe_key, to_addr)
+            for to_addr in to_addresses])
+        yield self.dedupe_redis.expire(dedupe_key, self.dedupe_ttl)
+        returnValue([
+            to_addr for to_addr, new in zip(to_addresses, added) if new])
+
+    @inlineCallbacks
+    def enqueue_messages(self, window_id, batch_id, to_addresses,
+                         msg_options, content):
+        """
+        Add a flight to the window for each address in `to_addresses`,
+        pushing at most :attr:`enqueue_batch_size` flights concurrently.
+        """
+        for i in range(0, len(to_addresses), self.enqueue_batch_size):
+            yield gatherResults([
+                self.window_manager.add(window_id, {
+                    'batch_id': batch_id,
+                    'to_addr': to_addr,
+                    'content': content,
+                    'msg_options': msg_options,
+                })
+                for to_addr in to_addresses[i:i + self.enqueue_batch_size]])
+
+    def publish_enqueue_progress(self, conv, enqueued, elapsed):
+        metrics = self.get_conversation_metric_manager(conv)
+        metrics.oneshot(Metric('bulk_send.enqueued', [LAST]), enqueued)
+        if elapsed > 0:
+            rate = float(enqueued) / elapsed
+            metrics.oneshot(Metric('bulk_send.enqueue_rate', [LAST]), rate)
+        metrics.publish_metrics()
 
     @inlineCallbacks
     def process_command_bulk_send(self, user_account_key, conversation_key,
@@ -77,19 +122,35 @@ class BulkMessageApplication(GoApplicationWorker):
                 conversation_key, user_account_key))
             return
 
-        to_addresses = []
-        for contacts_batch in (
-                yield conv.get_opted_in_contact_bunches(delivery_class)):
-            for contact in (yield contacts_batch):
-                to_addresses.append(contact.addr_for(delivery_class))
-        if dedupe:
-            to_addresses = set(to_addresses)
-
         self.add_conv_to_msg_options(conv, msg_options)
         window_id = self.get_window_id(conversation_key, batch_id)
-        for to_addr in to_addresses:
-            yield self.send_message_via_window(
-                conv, window_id, batch_id, to_addr, msg_options, content)
+        yield self.window_manager.create_window(window_id, strict=False)
+
+        # Contacts are enqueued a bunch at a time as they're loaded so that
+        # we never hold the full list of recipients in memory.
+        start_time = self.window_manager.get_clocktime()
+        dedupe_key = '%s:%s' % (window_id, uuid.uuid4().hex)
+        enqueued = 0
+        contact_bunches = yield conv.get_opted_in_contact_bunches(
+            delivery_class, snapshot_opt_outs=self.snapshot_opt_outs,
+            concurrency=self.get_contact_load_concurrency(user_account_key))
+        for contacts_batch in contact_bunches:
+            to_addresses = [
+                contact.addr_for(delivery_class)
+                for contact in (yield contacts_batch)]
+            if dedupe:
+                to_addresses = yield self.filter_duplicate_addresses(
+                    dedupe_key, to_addresses)
+            yield self.enqueue_messages(
+                window_id, batch_id, to_addresses, msg_options, content)
+            enqueued += len(to_addresses)
+            elapsed = self.window_manager.get_clocktime() - start_time
+            self.publish_enqueue_progress(conv, enqueued, elapsed)
+
+        if dedupe:
+            yield self.dedupe_redis.delete(dedupe_key)
+        log.info("Enqueued %s messages for conversation '%s'." % (
+            enqueued, conversation_key))
 
     def consume_ack(self, event):
         return self.handle_event(event)
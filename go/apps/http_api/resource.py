@@ -1,22 +1,34 @@
 # -*- test-case-name: go.apps.http_api.tests.test_vumi_app -*-
 
-from functools import partial
+from zope.interface import implements
 
 from twisted.web.server import NOT_DONE_YET
 from twisted.internet.error import ConnectionDone
 from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IPushProducer
 
 from vumi.message import TransportUserMessage, TransportEvent
 from vumi import log
 
 from go.apps.http_api_nostream.resource import (
-    BaseResource, MessageResource, MetricResource, ConversationResource)
+    BaseResource, MessageResource, MessageBatchResource, MetricResource,
+    ConversationResource)
 
 
 # NOTE: This module subclasses and uses things from go.apps.http_api_nostream.
 
 
 class StreamResourceMixin(object):
+    """Streams messages or events to a client as lines of JSON.
+
+    Clients may pass a ``cursor`` query parameter with the
+    ``http_api.stream_offset`` of the last message they saw to be sent
+    everything that came after it.
+
+    The resource is registered as a producer for its request so that we
+    stop sending to the client while its connection's write buffer is full.
+    """
+    implements(IPushProducer)
 
     message_class = None
     proxy_buffering = False
@@ -26,13 +38,34 @@ class StreamResourceMixin(object):
     def setup_stream_resource(self, worker, conversation_key):
         self.stream_ready = Deferred()
         self.stream_ready.addCallback(self.setup_stream)
-        self._callback = None
+        self._request = None
         self._rk = self.routing_key % {
             'transport_name': self.worker.transport_name,
             'conversation_key': self.conversation_key,
         }
+        # Flow control and replay state managed by the client manager.
+        self.paused = False
+        self.flushing = False
+        self.replaying = False
+        self.cursor = None
+
+    def get_replay_cursor(self, request):
+        [cursor] = request.args.get('cursor', [None])
+        if cursor is None:
+            return None
+        cursor = int(cursor)
+        if cursor < 0:
+            raise ValueError("Negative cursor: %r" % (cursor,))
+        return cursor
 
     def render_GET(self, request):
+        try:
+            self.cursor = self.get_replay_cursor(request)
+        except ValueError:
+            self.client_error_response(request, 'Invalid cursor')
+            return NOT_DONE_YET
+        self.replaying = self.cursor is not None
+
         resp_headers = request.responseHeaders
         resp_headers.addRawHeader('Content-Type', self.content_type)
         # Turn off proxy buffering, nginx will otherwise buffer our streaming
@@ -50,23 +83,35 @@ class StreamResourceMixin(object):
         request.write('')
         done = request.notifyFinish()
         done.addBoth(self.teardown_stream)
-        self._callback = partial(self.publish, request)
+        self._request = request
+        request.registerProducer(self, True)
         self.stream_ready.callback(request)
         return NOT_DONE_YET
 
     def setup_stream(self, request):
-        return self.worker.register_client(self._rk, self.message_class,
-                                           self._callback)
+        return self.worker.register_client(self._rk, self)
 
     def teardown_stream(self, err):
+        self.paused = True
         if not (err is None or err.trap(ConnectionDone)):
             log.error(err)
         log.info('Unregistering: %s, %s' % (self._rk, err.getErrorMessage()))
-        return self.worker.unregister_client(self._rk, self._callback)
+        return self.worker.unregister_client(self._rk, self)
+
+    def send(self, data):
+        """Write a JSON encoded message or event to the client."""
+        self._request.write('%s\n' % (data,))
 
-    def publish(self, request, message):
-        line = u'%s\n' % (message.to_json(),)
-        request.write(line.encode(self.encoding))
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        d = self.worker.flush_client(self._rk, self)
+        d.addErrback(log.err)
+
+    def stopProducing(self):
+        self.paused = True
 
 
 class EventStream(BaseResource, StreamResourceMixin):
@@ -91,9 +136,12 @@ class MessageStream(MessageResource, StreamResourceMixin):
 
 class StreamingConversationResource(ConversationResource):
 
+    concurrency_limited = True
+
     def get_child_resource(self, path):
         return {
             'events.json': EventStream,
             'messages.json': MessageStream,
+            'messages_batch.json': MessageBatchResource,
             'metrics.json': MetricResource,
         }.get(path)
@@ -1,24 +1,177 @@
 import base64
 import json
 
-from twisted.internet.defer import inlineCallbacks, DeferredQueue, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, Deferred, DeferredQueue, returnValue)
 from twisted.web.http_headers import Headers
 from twisted.web import http
 from twisted.web.server import NOT_DONE_YET
 
 from vumi.config import ConfigContext
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.tests.helpers import VumiTestCase
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper, MessageHelper
 from vumi.tests.utils import MockHttpServer, LogCatcher
 from vumi.transports.vumi_bridge.client import StreamingClient
 from vumi.utils import http_request_full
 
 from go.apps.http_api.resource import (
     StreamResourceMixin, StreamingConversationResource)
-from go.apps.http_api.vumi_app import StreamingHTTPWorker
+from go.apps.http_api.vumi_app import (
+    StreamingHTTPWorker, StreamingClientManager)
 from go.apps.tests.helpers import AppWorkerHelper
 
 
+class FakeStreamClient(object):
+    def __init__(self, cursor=None):
+        self.paused = False
+        self.flushing = False
+        self.replaying = cursor is not None
+        self.cursor = cursor
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(json.loads(data))
+
+    def sent_contents(self):
+        return [msg['content'] for msg in self.sent]
+
+
+class TestStreamingClientManager(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.manager = self.mk_manager()
+
+    def mk_manager(self):
+        return StreamingClientManager(
+            self.redis.sub_manager('message_cache'), backlog_size=5,
+            flush_batch_size=2)
+
+    @inlineCallbacks
+    def publish(self, *contents):
+        for content in contents:
+            yield self.manager.publish(
+                'stream', self.msg_helper.make_inbound(content))
+
+    @inlineCallbacks
+    def test_publish_to_client(self):
+        client = FakeStreamClient()
+        yield self.manager.start('stream', client)
+        yield self.publish('a', 'b')
+        self.assertEqual(client.sent_contents(), ['a', 'b'])
+        self.assertEqual(
+            [msg['helper_metadata']['http_api'] for msg in client.sent],
+            [{'stream_offset': 1}, {'stream_offset': 2}])
+        self.assertEqual(client.cursor, 2)
+        self.assertEqual((yield self.mk_manager().load_cursor('stream')), 2)
+
+    @inlineCallbacks
+    def test_cursor_not_moved_backwards(self):
+        lagging_manager = self.mk_manager()
+        yield lagging_manager.load_cursor('stream')
+        yield self.manager.advance_cursor('stream', 5)
+        yield lagging_manager.advance_cursor('stream', 3)
+        self.assertEqual((yield self.mk_manager().load_cursor('stream')), 5)
+        self.assertEqual(
+            (yield self.redis.sub_manager('message_cache').zrange(
+                self.manager.cursor_key('stream'), 0, -1)),
+            ['5'])
+
+    @inlineCallbacks
+    def test_backlog_flushed_on_start(self):
+        yield self.publish('a', 'b', 'c')
+        client = FakeStreamClient()
+        yield self.manager.start('stream', client)
+        self.assertEqual(client.sent_contents(), ['a', 'b', 'c'])
+        # Delivered messages aren't sent to the next client.
+        other_client = FakeStreamClient()
+        yield self.manager.start('stream', other_client)
+        self.assertEqual(other_client.sent, [])
+
+    def block_load_cursor(self):
+        loading = Deferred()
+        load_cursor = self.manager.load_cursor
+        self.patch(self.manager, 'load_cursor', lambda key: (
+            loading.addCallback(lambda _: load_cursor(key))))
+        return loading
+
+    @inlineCallbacks
+    def test_publish_while_loading_cursor(self):
+        yield self.publish('a', 'b')
+        loading = self.block_load_cursor()
+        client = FakeStreamClient()
+        start_d = self.manager.start('stream', client)
+        yield self.publish('c')
+        self.assertEqual(client.sent, [])
+        loading.callback(None)
+        yield start_d
+        self.assertEqual(client.sent_contents(), ['a', 'b', 'c'])
+        self.assertEqual(client.cursor, 3)
+        self.assertFalse(client.flushing)
+
+    @inlineCallbacks
+    def test_publish_while_loading_cursor_for_replay(self):
+        yield self.publish('a', 'b')
+        loading = self.block_load_cursor()
+        client = FakeStreamClient(cursor=1)
+        start_d = self.manager.start('stream', client)
+        yield self.publish('c')
+        self.assertEqual(client.sent, [])
+        self.assertEqual(client.cursor, 1)
+        loading.callback(None)
+        yield start_d
+        self.assertEqual(client.sent_contents(), ['b', 'c'])
+        self.assertFalse(client.flushing)
+
+    @inlineCallbacks
+    def test_backlog_size(self):
+        yield self.publish(*'abcdefg')
+        client = FakeStreamClient()
+        yield self.manager.start('stream', client)
+        self.assertEqual(client.sent_contents(), list('cdefg'))
+
+    @inlineCallbacks
+    def test_replay_from_cursor(self):
+        client = FakeStreamClient()
+        yield self.manager.start('stream', client)
+        yield self.publish('a', 'b', 'c')
+        self.manager.stop('stream', client)
+
+        replay_client = FakeStreamClient(cursor=1)
+        yield self.manager.start('stream', replay_client)
+        self.assertEqual(replay_client.sent_contents(), ['b', 'c'])
+        self.assertFalse(replay_client.replaying)
+
+    @inlineCallbacks
+    def test_paused_client(self):
+        client = FakeStreamClient()
+        yield self.manager.start('stream', client)
+        client.paused = True
+        yield self.publish('a', 'b', 'c')
+        self.assertEqual(client.sent, [])
+        client.paused = False
+        yield self.manager.flush('stream', client)
+        self.assertEqual(client.sent_contents(), ['a', 'b', 'c'])
+
+    @inlineCallbacks
+    def test_publish_skips_paused_clients(self):
+        client1 = FakeStreamClient()
+        client2 = FakeStreamClient()
+        yield self.manager.start('stream', client1)
+        yield self.manager.start('stream', client2)
+        client1.paused = True
+        yield self.publish('a', 'b')
+        self.assertEqual(client1.sent, [])
+        self.assertEqual(client2.sent_contents(), ['a', 'b'])
+        # Nothing is left for the paused client to catch up on.
+        client1.paused = False
+        yield self.manager.flush('stream', client1)
+        self.assertEqual(client1.sent, [])
+
+
 class TestStreamingHTTPWorker(VumiTestCase):
 
     @inlineCallbacks
@@ -498,6 +651,36 @@ class TestStreamingHTTPWorker(VumiTestCase):
 
         receiver.disconnect()
 
+    @inlineCallbacks
+    def test_replay_from_cursor(self):
+        for i in range(3):
+            yield self.app_helper.make_dispatch_inbound(
+                'in %s' % (i,), message_id=str(i), conv=self.conversation)
+
+        queue = DeferredQueue()
+        url = '%s/%s/messages.json?cursor=1' % (
+            self.url, self.conversation.key)
+        receiver = self.client.stream(
+            TransportUserMessage, queue.put, queue.put, url,
+            Headers(self.auth_headers))
+
+        for i in range(1, 3):
+            received = yield queue.get()
+            self.assertEqual(received['message_id'], str(i))
+            self.assertEqual(
+                received['helper_metadata']['http_api'],
+                {'stream_offset': i + 1})
+
+        receiver.disconnect()
+
+    @inlineCallbacks
+    def test_invalid_cursor(self):
+        url = '%s/%s/messages.json?cursor=foo' % (
+            self.url, self.conversation.key)
+        response = yield http_request_full(
+            url, method='GET', headers=self.auth_headers)
+        self.assert_bad_request(response, 'Invalid cursor')
+
     @inlineCallbacks
     def test_health_response(self):
         health_url = 'http://%s:%s%s' % (
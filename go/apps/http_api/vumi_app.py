@@ -2,10 +2,15 @@
 from collections import defaultdict
 import random
 
-from twisted.internet.defer import inlineCallbacks, maybeDeferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, gatherResults)
+
+from vumi.config import ConfigInt
+from vumi.message import to_json
 
 from go.apps.http_api_nostream.auth import AuthorizedResource
-from go.apps.http_api_nostream.vumi_app import NoStreamingHTTPWorker
+from go.apps.http_api_nostream.vumi_app import (
+    NoStreamingHTTPWorker, HTTPWorkerConfig)
 from go.apps.http_api.resource import (
     MessageStream, EventStream, StreamingConversationResource)
 
@@ -14,63 +19,209 @@ from go.apps.http_api.resource import (
 
 
 class StreamingClientManager(object):
+    """Delivers the messages for each stream to the stream's clients.
+
+    Every message is appended to a log for its stream in Redis and given an
+    offset, which is included in the streamed message's ``helper_metadata``
+    as ``http_api.stream_offset``. The log holds the most recent
+    `backlog_size` messages. A client that connects with a cursor is sent
+    everything in the log after that offset. Other clients are sent whatever
+    hasn't been delivered to a client of the stream yet.
+
+    Each message is sent to one of the stream's clients. A client whose
+    connection isn't keeping up is paused until its write buffer drains, and
+    paused clients aren't sent anything. Messages that arrive while every
+    client is paused wait in the log. They're sent in batches of
+    `flush_batch_size` once a client resumes.
+
+    Clients must have ``paused``, ``flushing``, ``replaying`` and ``cursor``
+    attributes and a ``send(data)`` method. See
+    :class:`go.apps.http_api.resource.StreamResourceMixin`.
+
+    :param redis:
+        Redis manager to keep the stream logs in.
+    :param int backlog_size:
+        Number of messages to keep in each stream's log.
+    :param int flush_batch_size:
+        Number of logged messages to fetch from Redis at a time when
+        sending a client the messages it missed.
+    """
 
-    MAX_BACKLOG_SIZE = 100
     CLIENT_PREFIX = 'clients'
 
-    def __init__(self, redis):
+    def __init__(self, redis, backlog_size=100, flush_batch_size=100):
         self.redis = redis
+        self.backlog_size = backlog_size
+        self.flush_batch_size = flush_batch_size
         self.clients = defaultdict(list)
+        # Our copy of the offset of the last message delivered for each
+        # stream.
+        self.cursors = {}
 
     def client_key(self, *args):
         return u':'.join([self.CLIENT_PREFIX] + map(unicode, args))
 
-    def backlog_key(self, key):
-        return self.client_key('backlog', key)
+    def log_key(self, key):
+        return self.client_key('log', key)
+
+    def offset_key(self, key):
+        return self.client_key('offset', key)
+
+    def cursor_key(self, key):
+        return self.client_key('cursor', key)
+
+    def encode(self, msg, offset):
+        """Return the JSON to send to clients for `msg` at `offset`."""
+        payload = msg.payload.copy()
+        helper_metadata = dict(payload.get('helper_metadata') or {})
+        helper_metadata['http_api'] = {'stream_offset': offset}
+        payload['helper_metadata'] = helper_metadata
+        return to_json(payload)
+
+    def store(self, key, offset, data):
+        """Add `data` to the stream's log and trim the log to
+        `backlog_size`.
+
+        The commands are sent together rather than one after the other.
+        """
+        log_key = self.log_key(key)
+        return gatherResults([
+            self.redis.zadd(log_key, **{data: offset}),
+            self.redis.zremrangebyrank(log_key, 0, -self.backlog_size - 1),
+        ], consumeErrors=True)
 
     @inlineCallbacks
-    def flush_backlog(self, key, message_class, callback):
-        backlog_key = self.backlog_key(key)
-        while True:
-            obj = yield self.redis.rpop(backlog_key)
-            if obj is None:
-                break
-            yield maybeDeferred(callback, message_class.from_json(obj))
+    def read(self, key, after, limit):
+        """Return up to `limit` ``(offset, data)`` pairs from the stream's
+        log, starting after offset `after`."""
+        items = yield self.redis.zrangebyscore(
+            self.log_key(key), '(%d' % (after,), '+inf', start=0, num=limit,
+            withscores=True)
+        returnValue([(int(offset), data) for data, offset in items])
 
-    def start(self, key, message_class, callback):
-        self.clients[key].append(callback)
+    @inlineCallbacks
+    def load_cursor(self, key):
+        items = yield self.redis.zrange(
+            self.cursor_key(key), -1, -1, withscores=True)
+        cursor = int(items[0][1]) if items else 0
+        self.cursors[key] = max(self.cursors.get(key, 0), cursor)
+        returnValue(self.cursors[key])
 
-    def stop(self, key, callback):
-        self.clients[key].remove(callback)
+    def advance_cursor(self, key, offset):
+        """Move the stream's cursor forward to `offset`.
 
-    def publish(self, key, msg):
-        callbacks = self.clients[key]
-        if callbacks:
-            callback = random.choice(callbacks)
-            return maybeDeferred(callback, msg)
-        else:
-            return self.queue_in_backlog(key, msg)
+        The shared cursor is the highest score in a sorted set rather than a
+        plain value, so a worker that's behind the others can't move it
+        backwards. Lower offsets are trimmed from the set as we go.
+        """
+        if offset <= self.cursors.get(key, 0):
+            return succeed(None)
+        self.cursors[key] = offset
+        cursor_key = self.cursor_key(key)
+        return gatherResults([
+            self.redis.zadd(cursor_key, **{str(offset): offset}),
+            self.redis.zremrangebyrank(cursor_key, 0, -2),
+        ], consumeErrors=True)
 
     @inlineCallbacks
-    def queue_in_backlog(self, key, msg):
-        backlog_key = self.backlog_key(key)
-        yield self.redis.lpush(backlog_key, msg.to_json())
-        yield self.redis.ltrim(backlog_key, 0, self.MAX_BACKLOG_SIZE - 1)
+    def start(self, key, client):
+        # The client counts as flushing until it has caught up, so that
+        # messages published while we load the cursor go to the log for the
+        # flush to pick up rather than straight to the client.
+        client.flushing = True
+        self.clients[key].append(client)
+        try:
+            cursor = yield self.load_cursor(key)
+        except Exception:
+            client.flushing = False
+            raise
+        if client.cursor is None:
+            client.cursor = cursor
+        yield self._flush(key, client)
+
+    def stop(self, key, client):
+        self.clients[key].remove(client)
+
+    def flush(self, key, client):
+        """Send `client` the logged messages after its cursor."""
+        if client.flushing:
+            return succeed(None)
+        client.flushing = True
+        return self._flush(key, client)
+
+    @inlineCallbacks
+    def _flush(self, key, client):
+        try:
+            while not client.paused:
+                after = client.cursor
+                if not client.replaying:
+                    # Skip anything other clients have been sent meanwhile.
+                    after = max(after, self.cursors.get(key, 0))
+                batch = yield self.read(key, after, self.flush_batch_size)
+                if not batch:
+                    client.replaying = False
+                    break
+                for offset, data in batch:
+                    if client.paused:
+                        break
+                    client.send(data)
+                    client.cursor = offset
+                yield self.advance_cursor(key, client.cursor)
+        finally:
+            client.flushing = False
+
+    @inlineCallbacks
+    def publish(self, key, msg):
+        offset = yield self.redis.incr(self.offset_key(key))
+        data = self.encode(msg, offset)
+        # Logging the message and advancing the cursor don't depend on each
+        # other, so they go to Redis together.
+        writes = [self.store(key, offset, data)]
+        # Clients that are catching up will find the message in the log.
+        clients = [client for client in self.clients[key]
+                   if not (client.paused or client.flushing)]
+        if clients:
+            client = random.choice(clients)
+            client.send(data)
+            client.cursor = offset
+            writes.append(self.advance_cursor(key, offset))
+        yield gatherResults(writes, consumeErrors=True)
+
+
+class StreamingHTTPWorkerConfig(HTTPWorkerConfig):
+    """Configuration options for StreamingHTTPWorker."""
+
+    stream_backlog_size = ConfigInt(
+        "Number of messages and events to keep for each conversation so "
+        "that clients can catch up on what they missed or replay them from "
+        "a cursor.",
+        default=100, static=True)
+    stream_flush_batch_size = ConfigInt(
+        "Number of messages or events to fetch at a time when sending a "
+        "client the ones it missed.",
+        default=100, static=True)
 
 
 class StreamingHTTPWorker(NoStreamingHTTPWorker):
 
     worker_name = 'http_api_worker'
+    CONFIG_CLASS = StreamingHTTPWorkerConfig
 
     @inlineCallbacks
     def setup_application(self):
         yield super(StreamingHTTPWorker, self).setup_application()
-
+        config = self.get_static_config()
         self.client_manager = StreamingClientManager(
-            self.redis.sub_manager('http_api:message_cache'))
+            self.redis.sub_manager('http_api:message_cache'),
+            config.stream_backlog_size, config.stream_flush_batch_size)
+
+    def check_concurrency_limit_config(self):
+        # Streaming clients are still limited by `concurrency_limit`.
+        pass
 
     def get_conversation_resource(self):
-        return AuthorizedResource(self, StreamingConversationResource)
+        return AuthorizedResource(
+            self, StreamingConversationResource, self.credential_cache)
 
     def get_api_config(self, conversation, key, default=None):
         return conversation.config.get('http_api', {}).get(key, default)
@@ -83,22 +234,24 @@ class StreamingHTTPWorker(NoStreamingHTTPWorker):
         }
         return self.client_manager.publish(rk, message)
 
-    def register_client(self, key, message_class, callback):
-        self.client_manager.start(key, message_class, callback)
-        return self.client_manager.flush_backlog(key, message_class, callback)
+    def register_client(self, key, client):
+        return self.client_manager.start(key, client)
+
+    def unregister_client(self, key, client):
+        self.client_manager.stop(key, client)
 
-    def unregister_client(self, conversation_key, callback):
-        self.client_manager.stop(conversation_key, callback)
+    def flush_client(self, key, client):
+        return self.client_manager.flush(key, client)
 
     def send_message_to_client(self, message, conversation, push_url):
         if push_url:
-            return self.push(push_url, message)
+            return self.push(push_url, message, conversation)
         else:
             return self.stream(MessageStream, conversation.key, message)
 
     def send_event_to_client(self, event, conversation, push_url):
         if push_url:
-            return self.push(push_url, event)
+            return self.push(push_url, event, conversation)
         else:
             return self.stream(EventStream, conversation.key, event)
 
@@ -1,3 +1,5 @@
+import hashlib
+
 from zope.interface import implements
 
 from twisted.cred import portal, checkers, credentials, error
@@ -5,6 +7,8 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.web import resource
 from twisted.web.guard import HTTPAuthSessionWrapper, BasicCredentialFactory
 
+from go.vumitools.cache import LRUCache
+
 
 # NOTE: Things in this module are used by go.apps.http_api.
 
@@ -21,37 +25,113 @@ class ConversationRealm(object):
         raise NotImplementedError()
 
 
+class CredentialCache(object):
+    """Remembers recently verified API credentials.
+
+    Entries are keyed on the account, conversation and a hash of the token
+    (so the tokens themselves aren't held as keys) and hold the conversation
+    the credentials were checked against.
+
+    :param int max_size:
+        The maximum number of credentials to cache.
+    :param float ttl:
+        The number of seconds verified credentials are trusted for. Zero
+        disables the cache.
+    :param clock:
+        An ``IReactorTime`` provider. Defaults to the global reactor.
+    """
+
+    def __init__(self, max_size=1000, ttl=5, clock=None):
+        self.cache = LRUCache(max_size, ttl, clock)
+
+    def _cache_key(self, user_account_key, conversation_key, token):
+        return (user_account_key, conversation_key,
+                hashlib.sha256(token).hexdigest())
+
+    def get(self, user_account_key, conversation_key, token):
+        """Return the conversation cached for the credentials or ``None``.
+        """
+        return self.cache.get(
+            self._cache_key(user_account_key, conversation_key, token))
+
+    def set(self, user_account_key, conversation_key, token, conversation):
+        self.cache.set(
+            self._cache_key(user_account_key, conversation_key, token),
+            conversation)
+
+    def revoke(self, user_account_key, conversation_key):
+        """Forget all cached credentials for a conversation."""
+        for key in self.cache.keys():
+            if key[:2] == (user_account_key, conversation_key):
+                self.cache.pop(key)
+
+
 class ConversationAccessChecker(object):
+    """Checks that the password is one of the conversation's API tokens.
+
+    :param worker:
+        The worker the API belongs to.
+    :param str conversation_key:
+        The key of the conversation being accessed.
+    :param CredentialCache credential_cache:
+        Optional cache of previously verified credentials.
+    :param resource:
+        Optional resource to give the resolved conversation to, as its
+        ``conversation`` attribute, once the credentials are verified.
+    """
     implements(checkers.ICredentialsChecker)
     credentialInterfaces = (credentials.IUsernamePassword,)
 
-    def __init__(self, worker, conversation_key):
+    def __init__(self, worker, conversation_key, credential_cache=None,
+                 resource=None):
         self.worker = worker
         self.conversation_key = conversation_key
+        self.credential_cache = credential_cache
+        self.resource = resource
+
+    @inlineCallbacks
+    def get_conversation(self, username, token):
+        if self.credential_cache is not None:
+            conversation = self.credential_cache.get(
+                username, self.conversation_key, token)
+            if conversation is not None:
+                returnValue(conversation)
+
+        user_exists = yield self.worker.vumi_api.user_exists(username)
+        if not user_exists:
+            returnValue(None)
+        user_api = self.worker.vumi_api.get_user_api(username)
+        conversation = yield user_api.get_wrapped_conversation(
+            self.conversation_key)
+        if conversation is None:
+            returnValue(None)
+        tokens = self.worker.get_api_config(conversation, 'api_tokens', [])
+        if token not in tokens:
+            returnValue(None)
+        if self.credential_cache is not None:
+            self.credential_cache.set(
+                username, self.conversation_key, token, conversation)
+        returnValue(conversation)
 
     @inlineCallbacks
     def requestAvatarId(self, credentials):
         username = credentials.username
-        token = credentials.password
-        user_exists = yield self.worker.vumi_api.user_exists(username)
-        if user_exists:
-            user_api = self.worker.vumi_api.get_user_api(username)
-            conversation = yield user_api.get_wrapped_conversation(
-                self.conversation_key)
-            if conversation is not None:
-                tokens = self.worker.get_api_config(
-                    conversation, 'api_tokens', [])
-                if token in tokens:
-                    returnValue(username)
-        raise error.UnauthorizedLogin()
+        conversation = yield self.get_conversation(
+            username, credentials.password)
+        if conversation is None:
+            raise error.UnauthorizedLogin()
+        if self.resource is not None:
+            self.resource.conversation = conversation
+        returnValue(username)
 
 
 class AuthorizedResource(resource.Resource):
 
-    def __init__(self, worker, resource_class):
+    def __init__(self, worker, resource_class, credential_cache=None):
         resource.Resource.__init__(self)
         self.worker = worker
         self.resource_class = resource_class
+        self.credential_cache = credential_cache
 
     def render(self, request):
         return resource.NoResource().render(request)
@@ -59,7 +139,8 @@ class AuthorizedResource(resource.Resource):
     def getChild(self, conversation_key, request):
         if conversation_key:
             res = self.resource_class(self.worker, conversation_key)
-            checker = ConversationAccessChecker(self.worker, conversation_key)
+            checker = ConversationAccessChecker(
+                self.worker, conversation_key, self.credential_cache, res)
             realm = ConversationRealm(res)
             p = portal.Portal(realm, [checker])
 
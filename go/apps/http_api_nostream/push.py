@@ -0,0 +1,50 @@
+# -*- test-case-name: go.apps.http_api_nostream.tests.test_push -*-
+
+"""Retry queue for pushing messages and events to customer URLs."""
+
+import json
+
+from twisted.internet.defer import returnValue
+from vumi.persist.redis_base import Manager
+
+
+class PushRetryQueue(object):
+    """Holds pushes that failed and are waiting to be retried.
+
+    Pushes are stored in a Redis sorted set scored by the time they're due
+    to be retried, so they survive worker restarts and can be picked up by
+    any worker sharing the queue.
+
+    :param redis:
+        Redis manager to store the queue in.
+    """
+
+    def __init__(self, redis):
+        self.manager = self.redis = redis
+
+    def _queue_key(self):
+        return "retries"
+
+    def add(self, push, due_at):
+        """Queue `push` (a JSON serializable dict) to be retried at `due_at`.
+        """
+        return self.redis.zadd(self._queue_key(), **{
+            json.dumps(push, sort_keys=True): due_at,
+        })
+
+    @Manager.calls_manager
+    def pop_due(self, now, limit):
+        """Remove and return up to `limit` pushes due at or before `now`."""
+        queue_key = self._queue_key()
+        items = yield self.redis.zrangebyscore(
+            queue_key, '-inf', now, start=0, num=limit)
+        pushes = []
+        for item in items:
+            # Only return the pushes we removed so that several workers can
+            # share the queue without retrying the same push twice.
+            if (yield self.redis.zrem(queue_key, item)):
+                pushes.append(json.loads(item))
+        returnValue(pushes)
+
+    def size(self):
+        return self.redis.zcard(self._queue_key())
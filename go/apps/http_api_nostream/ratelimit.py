@@ -0,0 +1,90 @@
+# -*- test-case-name: go.apps.http_api_nostream.tests.test_ratelimit -*-
+
+"""Fixed window rate limiting for the HTTP API."""
+
+import math
+
+from twisted.internet import reactor
+from twisted.internet.defer import returnValue
+from vumi.persist.redis_base import Manager
+
+
+class FixedWindowLimiter(object):
+    """Fixed window rate limits shared between workers through Redis.
+
+    Time is split into windows of ``burst / rate`` seconds and up to `burst`
+    tokens may be taken in each window, with a Redis counter recording how
+    many have been taken in the current one. Because the windows are fixed
+    rather than sliding, up to ``2 * burst`` tokens can be taken in quick
+    succession either side of a window boundary. Average use is still held
+    to `rate` a second.
+
+    Rather than going to Redis for every token, each worker leases tokens a
+    few at a time and hands them out locally. Window counters expire, so
+    tokens leased by a worker that goes away are only lost until the window
+    ends.
+
+    :param redis:
+        Redis manager to keep the window counters in.
+    :param int lease_size:
+        Maximum number of tokens to lease from Redis at a time.
+    :param clock:
+        An ``IReactorTime`` provider. Defaults to the global reactor.
+    """
+
+    def __init__(self, redis, lease_size=10, clock=None):
+        if clock is None:
+            clock = reactor
+        self.manager = self.redis = redis
+        self.lease_size = lease_size
+        self.clock = clock
+        # limit key -> [window, leased tokens left, exhausted]
+        self._leases = {}
+
+    def _counter_key(self, key, window):
+        return "window:%s:%s" % (key, window)
+
+    def _window_length(self, rate, burst):
+        return float(burst) / rate
+
+    def _current_lease(self, key, window):
+        lease = self._leases.get(key)
+        if lease is None or lease[0] != window:
+            lease = self._leases[key] = [window, 0, False]
+        return lease
+
+    @Manager.calls_manager
+    def lease(self, key, window, window_length, burst):
+        """Take up to :attr:`lease_size` of the tokens left in `window`.
+
+        Returns the number of tokens taken.
+        """
+        size = min(self.lease_size, burst)
+        counter_key = self._counter_key(key, window)
+        taken = yield self.redis.incr(counter_key, size)
+        yield self.redis.expire(
+            counter_key, int(math.ceil(window_length)) + 1)
+        returnValue(max(0, min(size, burst - (taken - size))))
+
+    @Manager.calls_manager
+    def consume(self, key, rate, burst):
+        """Take a token from the current window for `key`.
+
+        Returns ``True`` if there was a token to take and ``False`` if the
+        window's tokens have all been taken.
+        """
+        window_length = self._window_length(rate, burst)
+        window = int(self.clock.seconds() / window_length)
+        lease = self._current_lease(key, window)
+        if lease[1] <= 0 and not lease[2]:
+            granted = yield self.lease(key, window, window_length, burst)
+            # Other tokens may have been consumed or leased while we were
+            # waiting for Redis.
+            lease = self._current_lease(key, window)
+            lease[1] += granted
+            if not granted:
+                lease[2] = True
+        if lease[1] <= 0:
+            returnValue(False)
+        lease[1] -= 1
+        returnValue(True)
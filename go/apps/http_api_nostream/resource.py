@@ -5,11 +5,13 @@ import copy
 
 from twisted.web import resource, http, util
 from twisted.web.server import NOT_DONE_YET
-from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, DeferredList, inlineCallbacks, returnValue,
+    succeed)
 
 from vumi import errors
 from vumi.blinkenlights import metrics
-from vumi.message import TransportUserMessage
+from vumi.message import TransportUserMessage, JSONMessageEncoder
 from vumi.errors import InvalidMessage
 from vumi.config import ConfigContext
 from vumi import log
@@ -20,6 +22,9 @@ from go.apps.http_api_nostream.definition import DEFAULT_METRIC_STORE
 
 # NOTE: Things in this module are subclassed and used by go.apps.http_api.
 
+# Not defined by twisted.web.http in the versions we support.
+TOO_MANY_REQUESTS = 429
+
 
 class BaseResource(resource.Resource):
 
@@ -29,6 +34,9 @@ class BaseResource(resource.Resource):
         self.conversation_key = conversation_key
         self.vumi_api = self.worker.vumi_api
         self.user_apis = {}
+        # Set to the conversation the request was authorized against so that
+        # we don't need to load it again.
+        self.conversation = None
 
     def get_user_api(self, user_account):
         if user_account in self.user_apis:
@@ -40,6 +48,11 @@ class BaseResource(resource.Resource):
 
     def get_conversation(self, user_account, conversation_key=None):
         conversation_key = conversation_key or self.conversation_key
+        conversation = self.conversation
+        if (conversation is not None
+                and conversation.key == conversation_key
+                and conversation.user_account.key == user_account):
+            return succeed(conversation)
         user_api = self.get_user_api(user_account)
         return user_api.get_wrapped_conversation(conversation_key)
 
@@ -162,6 +175,12 @@ class MessageResource(BaseResource):
             self.client_error_response(request, 'Invalid Message')
             return
 
+        conversation = yield self.get_conversation(request.getUser())
+        if not (yield self.worker.check_rate_limit(conversation)):
+            self.client_error_response(
+                request, 'Rate limit exceeded', code=TOO_MANY_REQUESTS)
+            return
+
         in_reply_to = payload.get('in_reply_to')
         if in_reply_to:
             yield self.handle_PUT_in_reply_to(request, payload, in_reply_to)
@@ -224,6 +243,110 @@ class MessageResource(BaseResource):
         self.successful_send_response(request, msg)
 
 
+class MessageBatchResource(MessageResource):
+    """Sends many messages in one request.
+
+    The request body is either a JSON array of ``send_to`` payloads or
+    newline-delimited JSON with one payload per line. The response is
+    newline-delimited JSON with a line for each message, written once the
+    message is sent. Each line has the message's ``index`` in the batch and
+    either the sent ``message`` or the ``reason`` it was rejected. Lines may
+    arrive out of order.
+    """
+
+    encoding = 'utf-8'
+    content_type = 'application/json; charset=%s' % (encoding,)
+
+    def parse_payloads(self, content):
+        """Return an iterable of payloads from the request body.
+
+        Lines of newline-delimited JSON that can't be decoded are returned as
+        ``None`` so that they're rejected individually. A JSON array that
+        can't be decoded raises :class:`ValueError`.
+        """
+        head = content.read(1024).lstrip()
+        content.seek(0)
+        if head.startswith('['):
+            payloads = json.loads(content.read())
+            if not isinstance(payloads, list):
+                raise ValueError("Expected a JSON array.")
+            return payloads
+        return self.parse_lines(content)
+
+    def parse_lines(self, content):
+        for line in content:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+    @inlineCallbacks
+    def send_message(self, conversation, payload):
+        if not isinstance(payload, dict):
+            returnValue({'success': False, 'reason': 'Invalid Message'})
+        msg_options = SendToOptions(payload)
+        if not msg_options.is_valid:
+            returnValue({'success': False, 'reason': msg_options.error_msg})
+        if not (yield self.worker.check_rate_limit(conversation)):
+            returnValue({'success': False, 'reason': 'Rate limit exceeded'})
+
+        helper_metadata = conversation.set_go_helper_metadata()
+        helper_metadata.update(self.get_load_balancer_metadata(payload))
+        msg = yield self.worker.send_to(
+            msg_options.to_addr, msg_options.content,
+            endpoint='default', helper_metadata=helper_metadata)
+        returnValue({'success': True, 'message': msg.payload})
+
+    def send_failed(self, failure):
+        log.err(failure, "Error sending batched message")
+        return {'success': False, 'reason': 'Failed to send message'}
+
+    def write_result(self, result, request, index, finished):
+        if finished:
+            # The client has gone away.
+            return
+        result['index'] = index
+        line = u'%s\n' % (json.dumps(result, cls=JSONMessageEncoder),)
+        request.write(line.encode(self.encoding))
+
+    @inlineCallbacks
+    def handle_PUT(self, request):
+        try:
+            payloads = self.parse_payloads(request.content)
+        except ValueError:
+            self.client_error_response(request, 'Invalid Message')
+            return
+
+        user_account = request.getUser()
+        conversation = yield self.get_conversation(user_account)
+
+        request.setResponseCode(http.OK)
+        request.responseHeaders.addRawHeader('Content-Type', self.content_type)
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        config = self.worker.get_static_config()
+        semaphore = DeferredSemaphore(
+            max(config.batch_send_concurrency, 1))
+        pending = []
+        for index, payload in enumerate(payloads):
+            yield semaphore.acquire()
+            if finished:
+                semaphore.release()
+                break
+            d = self.send_message(conversation, payload)
+            d.addErrback(self.send_failed)
+            d.addCallback(self.write_result, request, index, finished)
+            d.addBoth(lambda r: semaphore.release())
+            pending.append(d)
+        yield DeferredList(pending)
+        if not finished:
+            request.finish()
+
+
 class MetricResource(BaseResource):
 
     def render_PUT(self, request):
@@ -269,11 +392,22 @@ class MetricResource(BaseResource):
 
 class ConversationResource(resource.Resource):
 
+    # Whether to limit the number of concurrent requests each account may
+    # make. Sending is rate limited instead, so this is only useful for
+    # long-lived requests.
+    concurrency_limited = False
+    # Concurrency counters are refreshed whenever they're changed and expire
+    # after this many seconds, so that requests a worker was handling when it
+    # died stop counting against the limit eventually.
+    CONCURRENCY_COUNTER_TTL = 24 * 60 * 60
+
     def __init__(self, worker, conversation_key):
         resource.Resource.__init__(self)
         self.worker = worker
         self.redis = worker.redis
         self.conversation_key = conversation_key
+        # Set by the access checker once the request is authorized.
+        self.conversation = None
 
     def get_worker_config(self, user_account_key):
         ctxt = ConfigContext(user_account=user_account_key)
@@ -289,11 +423,17 @@ class ConversationResource(resource.Resource):
         count = int((yield self.redis.get(self.key(user_id))) or 0)
         returnValue(count < config.concurrency_limit)
 
+    @inlineCallbacks
     def track_request(self, user_id):
-        return self.redis.incr(self.key(user_id))
+        yield self.redis.incr(self.key(user_id))
+        yield self.redis.expire(
+            self.key(user_id), self.CONCURRENCY_COUNTER_TTL)
 
+    @inlineCallbacks
     def release_request(self, err, user_id):
-        return self.redis.decr(self.key(user_id))
+        yield self.redis.decr(self.key(user_id))
+        yield self.redis.expire(
+            self.key(user_id), self.CONCURRENCY_COUNTER_TTL)
 
     def render(self, request):
         return resource.NoResource().render(request)
@@ -308,21 +448,27 @@ class ConversationResource(resource.Resource):
         if resource_class is None:
             returnValue(resource.NoResource())
 
-        user_id = request.getUser()
-        config = yield self.get_worker_config(user_id)
-        if (yield self.is_allowed(config, user_id)):
+        if self.concurrency_limited:
+            user_id = request.getUser()
+            config = yield self.get_worker_config(user_id)
+            if not (yield self.is_allowed(config, user_id)):
+                returnValue(resource.ErrorPage(
+                    http.FORBIDDEN, 'Forbidden',
+                    'Too many concurrent connections'))
 
             # remove track when request is closed
             finished = request.notifyFinish()
             finished.addBoth(self.release_request, user_id)
 
             yield self.track_request(user_id)
-            returnValue(resource_class(self.worker, self.conversation_key))
-        returnValue(resource.ErrorPage(http.FORBIDDEN, 'Forbidden',
-                                       'Too many concurrent connections'))
+
+        child = resource_class(self.worker, self.conversation_key)
+        child.conversation = self.conversation
+        returnValue(child)
 
     def get_child_resource(self, path):
         return {
             'messages.json': MessageResource,
+            'messages_batch.json': MessageBatchResource,
             'metrics.json': MetricResource,
         }.get(path)
@@ -0,0 +1,41 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from go.apps.http_api_nostream.auth import CredentialCache
+
+
+class TestCredentialCache(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = CredentialCache(max_size=10, ttl=5, clock=self.clock)
+
+    def test_get_missing(self):
+        self.assertEqual(self.cache.get('acc-1', 'conv-1', 'token-1'), None)
+
+    def test_set_and_get(self):
+        self.cache.set('acc-1', 'conv-1', 'token-1', 'conversation')
+        self.assertEqual(
+            self.cache.get('acc-1', 'conv-1', 'token-1'), 'conversation')
+        self.assertEqual(self.cache.get('acc-1', 'conv-1', 'token-2'), None)
+        self.assertEqual(self.cache.get('acc-2', 'conv-1', 'token-1'), None)
+
+    def test_tokens_not_stored_in_keys(self):
+        self.cache.set('acc-1', 'conv-1', 'token-1', 'conversation')
+        [key] = self.cache.cache.keys()
+        self.assertFalse('token-1' in key)
+
+    def test_entries_expire(self):
+        self.cache.set('acc-1', 'conv-1', 'token-1', 'conversation')
+        self.clock.advance(5)
+        self.assertEqual(self.cache.get('acc-1', 'conv-1', 'token-1'), None)
+
+    def test_revoke(self):
+        self.cache.set('acc-1', 'conv-1', 'token-1', 'conversation')
+        self.cache.set('acc-1', 'conv-1', 'token-2', 'conversation')
+        self.cache.set('acc-1', 'conv-2', 'token-1', 'other')
+        self.cache.revoke('acc-1', 'conv-1')
+        self.assertEqual(self.cache.get('acc-1', 'conv-1', 'token-1'), None)
+        self.assertEqual(self.cache.get('acc-1', 'conv-1', 'token-2'), None)
+        self.assertEqual(
+            self.cache.get('acc-1', 'conv-2', 'token-1'), 'other')
@@ -0,0 +1,60 @@
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.apps.http_api_nostream.push import PushRetryQueue
+
+
+class TestPushRetryQueue(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.queue = PushRetryQueue(self.redis.sub_manager('push_retries'))
+
+    def mk_push(self, url, attempts=1):
+        return {
+            'url': url,
+            'data': u'{}',
+            'conversation_key': u'conv-1',
+            'attempts': attempts,
+        }
+
+    @inlineCallbacks
+    def test_add(self):
+        yield self.queue.add(self.mk_push(u'http://a/'), 10)
+        yield self.queue.add(self.mk_push(u'http://b/'), 20)
+        self.assertEqual((yield self.queue.size()), 2)
+
+    @inlineCallbacks
+    def test_pop_due(self):
+        yield self.queue.add(self.mk_push(u'http://b/'), 20)
+        yield self.queue.add(self.mk_push(u'http://a/'), 10)
+        yield self.queue.add(self.mk_push(u'http://c/'), 30)
+        pushes = yield self.queue.pop_due(20, 10)
+        self.assertEqual(
+            pushes, [self.mk_push(u'http://a/'), self.mk_push(u'http://b/')])
+        self.assertEqual((yield self.queue.size()), 1)
+
+    @inlineCallbacks
+    def test_pop_due_limit(self):
+        yield self.queue.add(self.mk_push(u'http://a/'), 10)
+        yield self.queue.add(self.mk_push(u'http://b/'), 20)
+        pushes = yield self.queue.pop_due(30, 1)
+        self.assertEqual(pushes, [self.mk_push(u'http://a/')])
+        self.assertEqual((yield self.queue.size()), 1)
+
+    @inlineCallbacks
+    def test_pop_due_nothing_due(self):
+        yield self.queue.add(self.mk_push(u'http://a/'), 10)
+        self.assertEqual((yield self.queue.pop_due(5, 10)), [])
+        self.assertEqual((yield self.queue.size()), 1)
+
+    @inlineCallbacks
+    def test_pop_due_shared_queue(self):
+        other_queue = PushRetryQueue(self.redis.sub_manager('push_retries'))
+        yield self.queue.add(self.mk_push(u'http://a/'), 10)
+        pushes = yield self.queue.pop_due(10, 10)
+        self.assertEqual(len(pushes), 1)
+        self.assertEqual((yield other_queue.pop_due(10, 10)), [])
@@ -0,0 +1,85 @@
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.apps.http_api_nostream.ratelimit import FixedWindowLimiter
+
+
+class TestFixedWindowLimiter(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = Clock()
+
+    def mk_limiter(self, lease_size=2):
+        return FixedWindowLimiter(
+            self.redis.sub_manager('rate_limits'), lease_size, self.clock)
+
+    @inlineCallbacks
+    def consume_many(self, limiter, count, key='key', rate=1, burst=5):
+        results = []
+        for _ in range(count):
+            results.append((yield limiter.consume(key, rate, burst)))
+        returnValue(results)
+
+    @inlineCallbacks
+    def test_consume_up_to_burst(self):
+        limiter = self.mk_limiter()
+        results = yield self.consume_many(limiter, 6)
+        self.assertEqual(results, [True] * 5 + [False])
+
+    @inlineCallbacks
+    def test_next_window(self):
+        limiter = self.mk_limiter()
+        yield self.consume_many(limiter, 6)
+        self.clock.advance(5)
+        results = yield self.consume_many(limiter, 6)
+        self.assertEqual(results, [True] * 5 + [False])
+
+    @inlineCallbacks
+    def test_burst_either_side_of_window_boundary(self):
+        limiter = self.mk_limiter()
+        self.clock.advance(4.9)
+        results = yield self.consume_many(limiter, 5)
+        self.clock.advance(0.2)
+        results.extend((yield self.consume_many(limiter, 6)))
+        self.assertEqual(results, [True] * 10 + [False])
+
+    @inlineCallbacks
+    def test_keys_are_separate(self):
+        limiter = self.mk_limiter()
+        yield self.consume_many(limiter, 6, key='a')
+        self.assertTrue((yield limiter.consume('b', 1, 5)))
+
+    @inlineCallbacks
+    def test_leases_tokens(self):
+        limiter = self.mk_limiter(lease_size=3)
+        self.assertTrue((yield limiter.consume('key', 1, 5)))
+        counter_key = limiter._counter_key('key', 0)
+        self.assertEqual((yield limiter.redis.get(counter_key)), '3')
+        yield self.consume_many(limiter, 2)
+        self.assertEqual((yield limiter.redis.get(counter_key)), '3')
+        self.assertTrue(
+            0 < (yield limiter.redis.ttl(counter_key)) <= 6)
+
+    @inlineCallbacks
+    def test_shared_between_workers(self):
+        limiter1 = self.mk_limiter()
+        limiter2 = self.mk_limiter()
+        results1 = yield self.consume_many(limiter1, 3)
+        results2 = yield self.consume_many(limiter2, 3)
+        # The first worker holds an unused token from its second lease.
+        self.assertEqual(results1, [True, True, True])
+        self.assertEqual(results2, [True, False, False])
+
+    @inlineCallbacks
+    def test_exhausted_window_avoids_redis(self):
+        limiter = self.mk_limiter()
+        yield self.consume_many(limiter, 6)
+        counter_key = limiter._counter_key('key', 0)
+        taken = yield limiter.redis.get(counter_key)
+        self.assertFalse((yield limiter.consume('key', 1, 5)))
+        self.assertEqual((yield limiter.redis.get(counter_key)), taken)
@@ -5,6 +5,7 @@ from urlparse import urlparse, urlunparse
 
 from twisted.internet.defer import inlineCallbacks, DeferredQueue, returnValue
 from twisted.internet.error import DNSLookupError, ConnectionRefusedError
+from twisted.internet.task import Clock
 from twisted.web.error import SchemeNotSupported
 from twisted.web import http
 from twisted.web.server import NOT_DONE_YET
@@ -21,6 +22,8 @@ from go.apps.tests.helpers import AppWorkerHelper
 
 class TestNoStreamingHTTPWorkerBase(VumiTestCase):
 
+    extra_config = {}
+
     @inlineCallbacks
     def setUp(self):
         self.app_helper = self.add_helper(
@@ -32,6 +35,7 @@ class TestNoStreamingHTTPWorkerBase(VumiTestCase):
             'web_port': 0,
             'metrics_prefix': 'metrics_prefix.',
         }
+        self.config.update(self.extra_config)
         self.app = yield self.app_helper.get_app_worker(self.config)
         self.addr = self.app.webserver.getHost()
         self.url = 'http://%s:%s%s' % (
@@ -148,6 +152,56 @@ class TestNoStreamingHTTPWorker(TestNoStreamingHTTPWorkerBase):
         self.assertEqual(response.headers.getRawHeaders('www-authenticate'), [
             'basic realm="Conversation Realm"'])
 
+    @inlineCallbacks
+    def test_auth_cached(self):
+        url = '%s/%s/metrics.json' % (self.url, self.conversation.key)
+        metrics = json.dumps([['vumi.test.v1', 1234, 'SUM']])
+        response = yield http_request_full(
+            url, metrics, self.auth_headers, method='PUT')
+        self.assertEqual(response.code, http.OK)
+
+        user_exists_calls = []
+        orig_user_exists = self.app.vumi_api.user_exists
+
+        def user_exists(*args):
+            user_exists_calls.append(args)
+            return orig_user_exists(*args)
+        self.patch(self.app.vumi_api, 'user_exists', user_exists)
+
+        response = yield http_request_full(
+            url, metrics, self.auth_headers, method='PUT')
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(user_exists_calls, [])
+
+    @inlineCallbacks
+    def test_auth_revoked_on_config_changed(self):
+        url = '%s/%s/metrics.json' % (self.url, self.conversation.key)
+        metrics = json.dumps([['vumi.test.v1', 1234, 'SUM']])
+        response = yield http_request_full(
+            url, metrics, self.auth_headers, method='PUT')
+        self.assertEqual(response.code, http.OK)
+
+        self.conversation.config['http_api_nostream'].update({
+            'api_tokens': ['token-2'],
+        })
+        yield self.conversation.save()
+        yield self.conversation.notify_config_changed()
+        yield self.app_helper.dispatch_commands_to_app()
+
+        response = yield http_request_full(
+            url, metrics, self.auth_headers, method='PUT')
+        self.assertEqual(response.code, http.UNAUTHORIZED)
+
+    @inlineCallbacks
+    def test_send_to_not_rate_limited_by_default(self):
+        url = '%s/%s/messages.json' % (self.url, self.conversation.key)
+        for i in range(30):
+            msg = {'to_addr': '+2345', 'content': 'foo %s' % (i,)}
+            response = yield http_request_full(
+                url, json.dumps(msg), self.auth_headers, method='PUT')
+            self.assertEqual(response.code, http.OK)
+        self.assertEqual(len(self.app_helper.get_dispatched_outbound()), 30)
+
     @inlineCallbacks
     def test_send_to(self):
         msg = {
@@ -180,6 +234,71 @@ class TestNoStreamingHTTPWorker(TestNoStreamingHTTPWorkerBase):
         self.assertEqual(sent_msg['to_addr'], msg['to_addr'])
         self.assertEqual(sent_msg['from_addr'], None)
 
+    def parse_batch_response(self, response):
+        results = [json.loads(line)
+                   for line in response.delivered_body.splitlines()]
+        return sorted(results, key=lambda result: result['index'])
+
+    @inlineCallbacks
+    def test_send_batch(self):
+        msgs = [{'to_addr': '+234%s' % (i,), 'content': 'foo %s' % (i,)}
+                for i in range(3)]
+        url = '%s/%s/messages_batch.json' % (
+            self.url, self.conversation.key)
+        response = yield http_request_full(
+            url, json.dumps(msgs), self.auth_headers, method='PUT')
+        self.assertEqual(response.code, http.OK)
+
+        results = self.parse_batch_response(response)
+        sent_msgs = self.app_helper.get_dispatched_outbound()
+        self.assertEqual(
+            sorted(msg['to_addr'] for msg in sent_msgs),
+            ['+2340', '+2341', '+2342'])
+        self.assertEqual([r['index'] for r in results], [0, 1, 2])
+        self.assertTrue(all(r['success'] for r in results))
+        self.assertEqual(
+            sorted(r['message']['message_id'] for r in results),
+            sorted(msg['message_id'] for msg in sent_msgs))
+        for sent_msg in sent_msgs:
+            self.assertEqual(
+                sent_msg['helper_metadata']['go']['conversation_key'],
+                self.conversation.key)
+
+    @inlineCallbacks
+    def test_send_batch_lines(self):
+        lines = [
+            json.dumps({'to_addr': '+2340', 'content': 'foo'}),
+            'not json',
+            '',
+            json.dumps({'to_addr': 1234, 'content': 'foo'}),
+            json.dumps({'to_addr': '+2341', 'content': 'bar'}),
+        ]
+        url = '%s/%s/messages_batch.json' % (
+            self.url, self.conversation.key)
+        response = yield http_request_full(
+            url, '\n'.join(lines), self.auth_headers, method='PUT')
+        self.assertEqual(response.code, http.OK)
+
+        [r0, r1, r2, r3] = self.parse_batch_response(response)
+        self.assertEqual(r0['message']['to_addr'], '+2340')
+        self.assertEqual(r1, {
+            'index': 1, 'success': False, 'reason': 'Invalid Message'})
+        self.assertEqual(r2, {
+            'index': 2, 'success': False,
+            'reason': "Invalid or missing value for payload key 'to_addr'"})
+        self.assertEqual(r3['message']['to_addr'], '+2341')
+        self.assertEqual(
+            len(self.app_helper.get_dispatched_outbound()), 2)
+
+    @inlineCallbacks
+    def test_send_batch_invalid_array(self):
+        url = '%s/%s/messages_batch.json' % (
+            self.url, self.conversation.key)
+        response = yield http_request_full(
+            url, '[{"to_addr": ', self.auth_headers, method='PUT')
+        self.assert_bad_request(response, 'Invalid Message')
+        self.assertEqual(self.app_helper.get_dispatched_outbound(), [])
+
     @inlineCallbacks
     def test_in_send_to_with_evil_content(self):
         msg = {
@@ -377,6 +496,17 @@ class TestNoStreamingHTTPWorker(TestNoStreamingHTTPWorkerBase):
         posted_msg = TransportUserMessage.from_json(posted_json)
         self.assertEqual(posted_msg['message_id'], msg['message_id'])
 
+    @inlineCallbacks
+    def test_push_semaphore_released_when_idle(self):
+        msg_d = self.app_helper.make_dispatch_inbound(
+            'in 1', message_id='1', conv=self.conversation)
+        req = yield self.push_calls.get()
+        self.assertEqual(self.app.push_semaphores.keys(),
+                         [self.conversation.key])
+        req.finish()
+        yield msg_d
+        self.assertEqual(self.app.push_semaphores, {})
+
     @inlineCallbacks
     def test_post_inbound_message_ignored(self):
         self.conversation.config['http_api_nostream'].update({
@@ -414,6 +544,68 @@ class TestNoStreamingHTTPWorker(TestNoStreamingHTTPWorkerBase):
         self.assertTrue(self.get_message_url() in warning_log)
         self.assertTrue('500' in warning_log)
 
+    @inlineCallbacks
+    def test_post_inbound_message_500_response_queues_retry(self):
+        self.app.clock = Clock()
+        msg_d = self.app_helper.make_dispatch_inbound(
+            'in 1', message_id='1', conv=self.conversation)
+        req = yield self.push_calls.get()
+        req.setResponseCode(500)
+        req.finish()
+        yield msg_d
+        self.assertEqual((yield self.app.push_retry_queue.size()), 1)
+
+        # Not due yet.
+        yield self.app.retry_pushes()
+        self.assertEqual((yield self.app.push_retry_queue.size()), 1)
+
+        self.app.clock.advance(2)
+        retry_d = self.app.retry_pushes()
+        req = yield self.push_calls.get()
+        self.assertEqual(json.loads(req.content.read())['message_id'], '1')
+        req.finish()
+        yield retry_d
+        self.assertEqual((yield self.app.push_retry_queue.size()), 0)
+
+    @inlineCallbacks
+    def test_post_inbound_message_400_response_not_retried(self):
+        msg_d = self.app_helper.make_dispatch_inbound(
+            'in 1', message_id='1', conv=self.conversation)
+        req = yield self.push_calls.get()
+        req.setResponseCode(400)
+        req.finish()
+        yield msg_d
+        self.assertEqual((yield self.app.push_retry_queue.size()), 0)
+
+    @inlineCallbacks
+    def test_post_inbound_message_retries_exhausted(self):
+        self._patch_http_request_full(HttpTimeoutError)
+        with LogCatcher(message='Giving up') as lc:
+            yield self.app.deliver_push(
+                self.mock_push_server.url, '{}', self.conversation.key,
+                attempts=self.app.get_static_config().push_max_retries)
+            [giving_up_log] = lc.messages()
+        self.assertTrue(self.mock_push_server.url in giving_up_log)
+        self.assertEqual((yield self.app.push_retry_queue.size()), 0)
+
+    @inlineCallbacks
+    def test_post_inbound_messages_batched(self):
+        self.conversation.config['http_api_nostream'].update({
+            'push_batch_size': 2,
+        })
+        yield self.conversation.save()
+
+        yield self.app_helper.make_dispatch_inbound(
+            'in 1', message_id='1', conv=self.conversation)
+        msg_d = self.app_helper.make_dispatch_inbound(
+            'in 2', message_id='2', conv=self.conversation)
+        req = yield self.push_calls.get()
+        posted = json.loads(req.content.read())
+        self.assertEqual(
+            [msg['message_id'] for msg in posted], ['1', '2'])
+        req.finish()
+        yield msg_d
+
     def _patch_http_request_full(self, exception_class):
         from go.apps.http_api_nostream import vumi_app
 
@@ -661,3 +853,62 @@ class TestNoStreamingHTTPWorkerWithAuth(TestNoStreamingHTTPWorkerBase):
         [header] = req.requestHeaders.getRawHeaders('Authorization')
         self.assertEqual(
             header, 'Basic %s' % (base64.b64encode('username:password')))
+
+
+class TestNoStreamingHTTPWorkerRateLimits(TestNoStreamingHTTPWorkerBase):
+
+    # A slow enough rate that the window doesn't end during the test.
+    extra_config = {
+        'conversation_rate_limit': 0.001,
+        'conversation_rate_burst': 2,
+    }
+
+    def send_to(self, content):
+        url = '%s/%s/messages.json' % (self.url, self.conversation.key)
+        msg = {'to_addr': '+2345', 'content': content}
+        return http_request_full(
+            url, json.dumps(msg), self.auth_headers, method='PUT')
+
+    @inlineCallbacks
+    def test_send_to_rate_limited(self):
+        response = yield self.send_to('foo 1')
+        self.assertEqual(response.code, http.OK)
+        response = yield self.send_to('foo 2')
+        self.assertEqual(response.code, http.OK)
+        response = yield self.send_to('foo 3')
+        self.assertEqual(response.code, 429)
+        self.assertEqual(json.loads(response.delivered_body), {
+            'success': False,
+            'reason': 'Rate limit exceeded',
+        })
+        sent_msgs = self.app_helper.get_dispatched_outbound()
+        self.assertEqual(
+            [msg['content'] for msg in sent_msgs], ['foo 1', 'foo 2'])
+
+    def test_account_rate_limit_default(self):
+        config = self.app.get_static_config()
+        self.assertEqual(config.account_rate_limit, 0)
+
+    @inlineCallbacks
+    def test_concurrency_limit_ignored(self):
+        config = dict(self.config, concurrency_limit=5)
+        with LogCatcher(message='concurrency_limit is ignored') as lc:
+            yield self.app_helper.get_app_worker(config)
+            [warning] = lc.messages()
+        self.assertTrue('account_rate_limit' in warning)
+
+    @inlineCallbacks
+    def test_send_batch_rate_limited(self):
+        msgs = [{'to_addr': '+234%s' % (i,), 'content': 'foo'}
+                for i in range(3)]
+        url = '%s/%s/messages_batch.json' % (
+            self.url, self.conversation.key)
+        response = yield http_request_full(
+            url, json.dumps(msgs), self.auth_headers, method='PUT')
+        results = [json.loads(line)
+                   for line in response.delivered_body.splitlines()]
+        self.assertEqual(
+            sorted(r['success'] for r in results), [False, True, True])
+        [rejected] = [r for r in results if not r['success']]
+        self.assertEqual(rejected['reason'], 'Rate limit exceeded')
+        self.assertEqual(len(self.app_helper.get_dispatched_outbound()), 2)
@@ -1,16 +1,25 @@
 # -*- test-case-name: go.apps.http_api_nostream.tests.test_vumi_app -*-
 import base64
+import math
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, DeferredSemaphore, gatherResults)
 from twisted.internet.error import DNSLookupError, ConnectionRefusedError
+from twisted.internet.task import LoopingCall
+from twisted.web.client import Agent, HTTPConnectionPool
 from twisted.web.error import SchemeNotSupported
 
-from vumi.config import ConfigInt, ConfigText
+from vumi.blinkenlights.metrics import (
+    MetricManager, Metric, Count, Timer, LAST)
+from vumi.config import ConfigInt, ConfigText, ConfigFloat, ConfigDict
 from vumi.utils import http_request_full, HttpTimeoutError
 from vumi.transports.httprpc import httprpc
 from vumi import log
 
-from go.apps.http_api_nostream.auth import AuthorizedResource
+from go.apps.http_api_nostream.auth import AuthorizedResource, CredentialCache
+from go.apps.http_api_nostream.push import PushRetryQueue
+from go.apps.http_api_nostream.ratelimit import FixedWindowLimiter
 from go.apps.http_api_nostream.resource import ConversationResource
 from go.base.utils import extract_auth_from_url
 from go.vumitools.app_worker import GoApplicationWorker
@@ -32,18 +41,90 @@ class HTTPWorkerConfig(GoApplicationWorker.CONFIG_CLASS):
         "The path the resource should receive health checks on.",
         default='/health/', static=True)
     concurrency_limit = ConfigInt(
-        "Maximum number of clients per account. A value less than "
-        "zero disables the limit",
+        "Maximum number of concurrent streaming clients per account. Only "
+        "used by the streaming HTTP API, the non-streaming HTTP API limits "
+        "sending with `account_rate_limit` instead. A value less than zero "
+        "disables the limit",
         default=10)
+    account_rate_limit = ConfigFloat(
+        "Maximum number of messages per second each account may send. Zero "
+        "disables the limit. Disabled by default.",
+        default=0, static=True)
+    account_rate_limits = ConfigDict(
+        "Per-account overrides of `account_rate_limit`, keyed by account "
+        "key.", default={}, static=True)
+    account_rate_burst = ConfigInt(
+        "Number of messages an account may send in each rate limit window. "
+        "Up to twice this many may be sent in quick succession either side "
+        "of a window boundary. Defaults to a second's worth of messages.",
+        default=0, static=True)
+    conversation_rate_limit = ConfigFloat(
+        "Maximum number of messages per second each conversation may send. "
+        "Zero disables the limit.",
+        default=0, static=True)
+    conversation_rate_burst = ConfigInt(
+        "Number of messages a conversation may send in each rate limit "
+        "window. Up to twice this many may be sent in quick succession "
+        "either side of a window boundary. Defaults to a second's worth of "
+        "messages.",
+        default=0, static=True)
+    rate_limit_lease_size = ConfigInt(
+        "Number of rate limit tokens each worker claims from Redis at a "
+        "time. Larger leases mean fewer trips to Redis but let a worker hold "
+        "on to tokens that other workers could have used.",
+        default=10, static=True)
     timeout = ConfigInt(
         "How long to wait for a response from a server when posting "
         "messages or events", default=5, static=True)
+    batch_send_concurrency = ConfigInt(
+        "Maximum number of messages from a single messages_batch.json "
+        "request to send at the same time.",
+        default=10, static=True)
+    auth_cache_size = ConfigInt(
+        "Maximum number of verified API credentials to cache.",
+        default=1000, static=True)
+    auth_cache_ttl = ConfigFloat(
+        "Number of seconds verified API credentials are trusted for before "
+        "they're checked against the conversation again. Cached credentials "
+        "are discarded sooner when this worker processes a config_changed "
+        "command for the conversation. Set to zero to disable caching.",
+        default=5, static=True)
+    metrics_prefix = ConfigText(
+        "Prefix for push delivery metrics published by this worker. Defaults "
+        "to the worker name.", static=True, required=False)
+    push_persistent_per_host = ConfigInt(
+        "Maximum number of idle keep-alive connections to hold open to each "
+        "host messages and events are pushed to. Zero disables keep-alive.",
+        default=2, static=True)
+    push_concurrency_limit = ConfigInt(
+        "Maximum number of pushes in flight for each conversation. Zero or "
+        "less disables the limit.",
+        default=10, static=True)
+    push_max_retries = ConfigInt(
+        "Number of times to retry a push that failed because of a timeout, "
+        "connection error or 5xx response. Zero disables retries.",
+        default=5, static=True)
+    push_retry_delay = ConfigFloat(
+        "Number of seconds to wait before the first retry of a failed push. "
+        "The delay doubles for each following retry.",
+        default=2, static=True)
+    push_retry_interval = ConfigFloat(
+        "Number of seconds between checks for pushes that are due to be "
+        "retried.", default=1, static=True)
+    push_retry_batch_size = ConfigInt(
+        "Maximum number of pushes to retry on each check.",
+        default=100, static=True)
+    push_batch_interval = ConfigFloat(
+        "Maximum number of seconds to hold messages or events for "
+        "conversations with a `push_batch_size` before POSTing them.",
+        default=1, static=True)
 
 
 class NoStreamingHTTPWorker(GoApplicationWorker):
 
     worker_name = 'http_api_nostream_worker'
     CONFIG_CLASS = HTTPWorkerConfig
+    clock = reactor
 
     @inlineCallbacks
     def setup_application(self):
@@ -58,19 +139,113 @@ class NoStreamingHTTPWorker(GoApplicationWorker):
         self._event_handlers = {}
         self._session_handlers = {}
 
+        self.credential_cache = CredentialCache(
+            config.auth_cache_size, config.auth_cache_ttl, self.clock)
+        self.check_concurrency_limit_config()
+        self.rate_limiter = FixedWindowLimiter(
+            self.redis.sub_manager('%s:rate_limits' % (self.worker_name,)),
+            config.rate_limit_lease_size, self.clock)
         self.webserver = self.start_web_resources([
             (self.get_conversation_resource(), self.web_path),
             (httprpc.HttpRpcHealthResource(self), self.health_path),
         ], self.web_port)
+        self._setup_push_delivery(config)
+
+    def check_concurrency_limit_config(self):
+        """Warn about a `concurrency_limit` that this worker ignores."""
+        if 'concurrency_limit' in self.config:
+            log.warning(
+                "The non-streaming HTTP API no longer limits concurrent "
+                "requests, so concurrency_limit is ignored. Use "
+                "account_rate_limit to limit sending instead.")
+
+    def _setup_push_delivery(self, config):
+        self.push_pool = HTTPConnectionPool(
+            reactor, persistent=config.push_persistent_per_host > 0)
+        self.push_pool.maxPersistentPerHost = config.push_persistent_per_host
+        self.push_semaphores = {}
+        self.push_batches = {}
+        self.push_retry_queue = PushRetryQueue(
+            self.redis.sub_manager('%s:push_retries' % (self.worker_name,)))
+
+        metrics_prefix = config.metrics_prefix or self.worker_name
+        self.push_metrics = MetricManager(
+            metrics_prefix + '.', publisher=self.metric_publisher)
+        self.push_metrics.register(Timer('push.latency'))
+        self.push_metrics.register(
+            Metric('push.retry_queue_depth', [LAST]))
+        self.push_metrics.register(Count('push.retries'))
+        self.push_metrics.register(Count('push.failures'))
+        self.push_metrics.start_polling()
+
+        self.push_retry_loop = LoopingCall(self.retry_pushes)
+        self.push_retry_loop.clock = self.clock
+        self.push_retry_loop.start(config.push_retry_interval, now=False)
 
     def get_conversation_resource(self):
-        return AuthorizedResource(self, ConversationResource)
+        return AuthorizedResource(
+            self, ConversationResource, self.credential_cache)
 
     @inlineCallbacks
     def teardown_application(self):
+        yield self._teardown_push_delivery()
         yield super(NoStreamingHTTPWorker, self).teardown_application()
         yield self.webserver.loseConnection()
 
+    @inlineCallbacks
+    def _teardown_push_delivery(self):
+        if self.push_retry_loop.running:
+            self.push_retry_loop.stop()
+        # Hand any batches we're still holding to the retry queue so that
+        # they're sent once a worker is running again.
+        for batch_key, (delayed_call, pushes) in self.push_batches.items():
+            delayed_call.cancel()
+            conversation_key, url = batch_key
+            yield self.push_retry_queue.add({
+                'url': url,
+                'data': self.push_batch_data(pushes).decode('utf-8'),
+                'conversation_key': conversation_key,
+                'attempts': 0,
+            }, self.clock.seconds())
+        self.push_batches.clear()
+        self.push_metrics.stop_polling()
+        yield self.push_pool.closeCachedConnections()
+
+    def process_command_config_changed(self, user_account_key,
+                                       conversation_key):
+        """Discard cached credentials along with the cached conversation, in
+        case the conversation's API tokens have changed."""
+        self.credential_cache.revoke(user_account_key, conversation_key)
+        return super(
+            NoStreamingHTTPWorker, self).process_command_config_changed(
+                user_account_key, conversation_key)
+
+    @inlineCallbacks
+    def check_rate_limit(self, conversation):
+        """Take a token from the conversation's and its account's limits.
+
+        Returns ``False`` if either limit has been reached and the message
+        shouldn't be sent.
+        """
+        config = self.get_static_config()
+        account_key = conversation.user_account.key
+        limits = [
+            ('conversation:%s' % (conversation.key,),
+             config.conversation_rate_limit, config.conversation_rate_burst),
+            ('account:%s' % (account_key,),
+             config.account_rate_limits.get(
+                 account_key, config.account_rate_limit),
+             config.account_rate_burst),
+        ]
+        for key, rate, burst in limits:
+            if rate <= 0:
+                continue
+            allowed = yield self.rate_limiter.consume(
+                key, rate, burst or int(math.ceil(rate)))
+            if not allowed:
+                returnValue(False)
+        returnValue(True)
+
     def get_api_config(self, conversation, key, default=None):
         return conversation.config.get(
             'http_api_nostream', {}).get(key, default)
@@ -94,7 +269,7 @@ class NoStreamingHTTPWorker(GoApplicationWorker):
                 "push_message_url not configured for conversation: %s" % (
                     conversation.key))
             return
-        return self.push(push_url, message)
+        return self.push(push_url, message, conversation)
 
     @inlineCallbacks
     def consume_unknown_event(self, event):
@@ -120,12 +295,118 @@ class NoStreamingHTTPWorker(GoApplicationWorker):
                 "push_event_url not configured for conversation: %s" % (
                     conversation.key))
             return
-        return self.push(push_url, event)
+        return self.push(push_url, event, conversation)
+
+    def push(self, url, vumi_message, conversation):
+        """Push a message or event to `url`.
+
+        Conversations with a `push_batch_size` greater than one have their
+        messages and events collected and POSTed as JSON arrays of up to that
+        many items.
+        """
+        batch_size = self.get_api_config(conversation, 'push_batch_size', 1)
+        if batch_size > 1:
+            return self.add_to_push_batch(
+                url, vumi_message, conversation.key, batch_size)
+        data = vumi_message.to_json().encode('utf-8')
+        return self.deliver_push(url, data, conversation.key)
+
+    def add_to_push_batch(self, url, vumi_message, conversation_key,
+                          batch_size):
+        batch_key = (conversation_key, url)
+        if batch_key not in self.push_batches:
+            config = self.get_static_config()
+            delayed_call = self.clock.callLater(
+                config.push_batch_interval, self.flush_push_batch, batch_key)
+            self.push_batches[batch_key] = (delayed_call, [])
+        delayed_call, pushes = self.push_batches[batch_key]
+        pushes.append(vumi_message.to_json())
+        if len(pushes) >= batch_size:
+            delayed_call.cancel()
+            return self.flush_push_batch(batch_key)
+
+    def push_batch_data(self, pushes):
+        # The messages are already JSON encoded, so we build the array by hand
+        # instead of decoding and encoding them again.
+        return (u'[%s]' % (u','.join(pushes),)).encode('utf-8')
+
+    def flush_push_batch(self, batch_key):
+        conversation_key, url = batch_key
+        _delayed_call, pushes = self.push_batches.pop(batch_key)
+        return self.deliver_push(
+            url, self.push_batch_data(pushes), conversation_key)
+
+    def get_push_semaphore(self, conversation_key):
+        semaphore = self.push_semaphores.get(conversation_key)
+        if semaphore is None:
+            semaphore = DeferredSemaphore(
+                self.get_static_config().push_concurrency_limit)
+            self.push_semaphores[conversation_key] = semaphore
+        return semaphore
+
+    def release_push_semaphore(self, conversation_key, semaphore):
+        """Forget a conversation's push semaphore once nothing holds it or
+        waits on it, so that semaphores don't pile up for conversations that
+        have stopped pushing."""
+        if semaphore.tokens == semaphore.limit and not semaphore.waiting:
+            if self.push_semaphores.get(conversation_key) is semaphore:
+                del self.push_semaphores[conversation_key]
+
+    @inlineCallbacks
+    def deliver_push(self, url, data, conversation_key, attempts=0):
+        """POST `data` to `url`, queuing it for a retry if it fails."""
+        config = self.get_static_config()
+        if config.push_concurrency_limit <= 0:
+            retry = yield self.post_push(url, data)
+        else:
+            semaphore = self.get_push_semaphore(conversation_key)
+            try:
+                retry = yield semaphore.run(self.post_push, url, data)
+            finally:
+                self.release_push_semaphore(conversation_key, semaphore)
+        if not retry:
+            return
+        if attempts >= config.push_max_retries:
+            self.push_metrics['push.failures'].inc()
+            if config.push_max_retries > 0:
+                log.warning("Giving up pushing to %s after %s retries." % (
+                    url, attempts))
+            return
+        delay = config.push_retry_delay * (2 ** attempts)
+        yield self.push_retry_queue.add({
+            'url': url,
+            'data': data.decode('utf-8'),
+            'conversation_key': conversation_key,
+            'attempts': attempts + 1,
+        }, self.clock.seconds() + delay)
 
     @inlineCallbacks
-    def push(self, url, vumi_message):
+    def retry_pushes(self):
         config = self.get_static_config()
-        data = vumi_message.to_json().encode('utf-8')
+        pushes = yield self.push_retry_queue.pop_due(
+            self.clock.seconds(), config.push_retry_batch_size)
+        for push in pushes:
+            self.push_metrics['push.retries'].inc()
+        yield gatherResults([
+            self.deliver_push(
+                push['url'], push['data'].encode('utf-8'),
+                push['conversation_key'], push['attempts'])
+            for push in pushes])
+        depth = yield self.push_retry_queue.size()
+        self.push_metrics['push.retry_queue_depth'].set(depth)
+
+    def _push_agent(self, reactor, contextFactory):
+        return Agent(reactor, contextFactory=contextFactory,
+                     pool=self.push_pool)
+
+    @inlineCallbacks
+    def post_push(self, url, data):
+        """POST `data` to `url`.
+
+        Returns ``True`` if the push failed in a way that's worth retrying.
+        """
+        config = self.get_static_config()
+        retry = False
         try:
             auth, url = extract_auth_from_url(url.encode('utf-8'))
             headers = {
@@ -144,20 +425,28 @@ class NoStreamingHTTPWorker(GoApplicationWorker):
                     'Authorization': 'Basic %s' % (
                         base64.b64encode('%s:%s' % (username, password)),)
                 })
-            resp = yield http_request_full(
-                url, data=data, headers=headers, timeout=config.timeout)
+            with self.push_metrics['push.latency'].timeit():
+                resp = yield http_request_full(
+                    url, data=data, headers=headers, timeout=config.timeout,
+                    agent_class=self._push_agent)
             if not (200 <= resp.code < 300):
                 # We didn't get a 2xx response.
                 log.warning('Got unexpected response code %s from %s' % (
                     resp.code, url))
+                # Client errors won't go away if we try again.
+                retry = resp.code >= 500
         except SchemeNotSupported:
             log.warning('Unsupported scheme for URL: %s' % (url,))
         except HttpTimeoutError:
             log.warning("Timeout pushing message to %s" % (url,))
+            retry = True
         except DNSLookupError:
             log.warning("DNS lookup error pushing message to %s" % (url,))
+            retry = True
         except ConnectionRefusedError:
             log.warning("Connection refused pushing message to %s" % (url,))
+            retry = True
+        returnValue(retry)
 
     def get_health_response(self):
         return "OK"
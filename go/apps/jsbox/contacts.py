@@ -393,7 +393,7 @@ class ContactsResource(SandboxResource):
             contact_store = self._contact_store_for_api(api)
 
             # raise an exception if the contact does not exist
-            yield contact_store.get_contact_by_key(key)
+            old_contact = yield contact_store.get_contact_by_key(key)
 
             contact = contact_store.contacts(
                 key,
@@ -406,6 +406,12 @@ class ContactsResource(SandboxResource):
                 contact.add_to_group(group)
 
             yield contact.save()
+            old_group_keys = set(old_contact.groups.keys())
+            new_group_keys = set(contact.groups.keys())
+            yield contact_store.update_group_membership(
+                key,
+                added_group_keys=new_group_keys - old_group_keys,
+                removed_group_keys=old_group_keys - new_group_keys)
         except (SandboxError, ContactError) as e:
             returnValue(self.reply(command, success=False, reason=unicode(e)))
 
@@ -164,8 +164,9 @@ class JsBoxApplication(GoApplicationMixin, JsSandbox):
                 conversation_key, user_account_key))
             return
 
+        concurrency = self.get_contact_load_concurrency(user_account_key)
         for contacts in (yield conv.get_opted_in_contact_bunches(
-                delivery_class)):
+                delivery_class, concurrency=concurrency)):
             for contact in (yield contacts):
                 to_addr = contact.addr_for(delivery_class)
                 yield self.send_inbound_push_trigger(
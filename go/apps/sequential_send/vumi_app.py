@@ -150,8 +150,10 @@ class SequentialSendApplication(GoApplicationWorker):
         conv.set_go_helper_metadata(
             message_options.setdefault('helper_metadata', {}))
 
+        concurrency = self.get_contact_load_concurrency(
+            conv.user_account.key)
         for contacts in (yield conv.get_opted_in_contact_bunches(
-                conv.delivery_class)):
+                conv.delivery_class, concurrency=concurrency)):
             for contact in (yield contacts):
                 index_key = 'scheduled_message_index_%s' % (conv.key,)
                 message_index = int(contact.extra[index_key] or '0')
@@ -7,10 +7,11 @@ from vxpolls.manager import PollManager
 from vumi.message import TransportUserMessage
 from vumi import log
 
-from go.vumitools.app_worker import GoApplicationMixin, GoWorkerConfigMixin
+from go.vumitools.app_worker import (
+    GoApplicationMixin, GoApplicationConfigMixin)
 
 
-class SurveyConfig(PollApplication.CONFIG_CLASS, GoWorkerConfigMixin):
+class SurveyConfig(PollApplication.CONFIG_CLASS, GoApplicationConfigMixin):
     pass
 
 
@@ -116,8 +117,9 @@ class SurveyApplication(PollApplication, GoApplicationMixin):
                 conversation_key, user_account_key))
             return
 
+        concurrency = self.get_contact_load_concurrency(user_account_key)
         for contacts in (yield conv.get_opted_in_contact_bunches(
-                delivery_class)):
+                delivery_class, concurrency=concurrency)):
             for contact in (yield contacts):
                 to_addr = contact.addr_for(delivery_class)
                 # Set some fake msg_options in case we didn't get real ones.
@@ -0,0 +1,98 @@
+"""Zipped exports stored for download."""
+
+import os
+from datetime import datetime, timedelta
+from tempfile import TemporaryFile
+from uuid import uuid4
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+
+class StoredExport(object):
+    """
+    Base class for exports that are zipped into a temporary file and may
+    be saved to the default file storage for download.
+
+    Subclasses set :attr:`ZIP_NAME` and :attr:`STORAGE_PATH` and call
+    :meth:`zip_data_file` once they've written their data.
+    """
+
+    ZIP_NAME = None
+    STORAGE_PATH = None
+
+    zip_file = None
+
+    def zip_data_file(self, data_file_name, arcname):
+        """Zip the file at `data_file_name` into a temporary file."""
+        self.zip_file = TemporaryFile()
+        zf = ZipFile(self.zip_file, 'w', ZIP_DEFLATED)
+        zf.write(data_file_name, arcname)
+        zf.close()
+
+    def size(self):
+        self.zip_file.seek(0, os.SEEK_END)
+        return self.zip_file.tell()
+
+    def read(self):
+        self.zip_file.seek(0)
+        return self.zip_file.read()
+
+    def close(self):
+        if self.zip_file is not None:
+            self.zip_file.close()
+            self.zip_file = None
+
+    @classmethod
+    def storage_path(cls, account_key, export_id):
+        return os.path.join(
+            cls.STORAGE_PATH, account_key, '%s.zip' % (export_id,))
+
+    def store(self, account_key):
+        """
+        Save the export to the default file storage and return its export
+        id. Stored exports are deleted by :func:`delete_expired_exports`
+        after ``settings.EXPORT_EXPIRY_DAYS`` days.
+        """
+        export_id = uuid4().hex
+        self.zip_file.seek(0)
+        default_storage.save(
+            self.storage_path(account_key, export_id), File(self.zip_file))
+        return export_id
+
+    @classmethod
+    def open_stored(cls, account_key, export_id):
+        """
+        Return a file object for a stored export or ``None`` if it doesn't
+        exist (or has expired).
+        """
+        path = cls.storage_path(account_key, export_id)
+        if not default_storage.exists(path):
+            return None
+        return default_storage.open(path)
+
+
+def delete_expired_exports(export_class, now=None):
+    """
+    Delete the stored exports of `export_class` that are older than
+    ``settings.EXPORT_EXPIRY_DAYS``. Returns the number deleted.
+    """
+    if now is None:
+        now = datetime.now()
+    cutoff = now - timedelta(days=settings.EXPORT_EXPIRY_DAYS)
+    root = export_class.STORAGE_PATH
+    if not default_storage.exists(root):
+        return 0
+    deleted = 0
+    account_dirs, _files = default_storage.listdir(root)
+    for account_dir in account_dirs:
+        _dirs, files = default_storage.listdir(
+            os.path.join(root, account_dir))
+        for file_name in files:
+            path = os.path.join(root, account_dir, file_name)
+            if default_storage.modified_time(path) < cutoff:
+                default_storage.delete(path)
+                deleted += 1
+    return deleted
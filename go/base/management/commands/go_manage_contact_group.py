@@ -134,6 +134,8 @@ class Command(BaseCommand):
             contact = user_api.contact_store.get_contact_by_key(contact_key)
             contact.groups.remove(group)
             contact.save()
+            user_api.contact_store.update_group_membership(
+                contact.key, removed_group_keys=[group.key])
             self.stdout.write('.')
         self.stdout.write('\nDone.\n')
-        group.delete()
+        user_api.contact_store.delete_group(group)
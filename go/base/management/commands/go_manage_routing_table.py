@@ -75,7 +75,7 @@ class Command(BaseCommand):
     def handle_clear(self, user_api, options):
         account = user_api.get_user_account()
         account.routing_table = RoutingTable()
-        account.save()
+        user_api.save_routing_table(account)
         self.stdout.write("Routing table cleared.\n")
 
     def handle_add(self, user_api, options):
@@ -87,7 +87,7 @@ class Command(BaseCommand):
             user_api.validate_routing_table(account)
         except Exception as e:
             raise CommandError(e)
-        account.save()
+        user_api.save_routing_table(account)
         self.stdout.write("Routing table entry added.\n")
 
     def handle_remove(self, user_api, options):
@@ -108,7 +108,7 @@ class Command(BaseCommand):
             user_api.validate_routing_table(account)
         except Exception as e:
             raise CommandError(e)
-        account.save()
+        user_api.save_routing_table(account)
         self.stdout.write("Routing table entry removed.\n")
 
     def print_routing_table(self, routing_table):
@@ -362,9 +362,10 @@ class Command(BaseCommand):
             rt.add_entry(
                 str(connectors[src]), src_ep, str(connectors[dst]), dst_ep)
 
-        user_account = vumi_api_for_user(user).get_user_account()
+        user_api = vumi_api_for_user(user)
+        user_account = user_api.get_user_account()
         user_account.routing_table = rt
-        user_account.save()
+        user_api.save_routing_table(user_account)
 
         self.stdout.write('Routing table for %s built\n' % (user.email,))
 
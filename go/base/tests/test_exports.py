@@ -0,0 +1,62 @@
+"""Tests for go.base.exports."""
+
+from datetime import datetime, timedelta
+from tempfile import NamedTemporaryFile
+
+from django.core.files.storage import default_storage
+
+from go.base.exports import StoredExport, delete_expired_exports
+from go.base.tests.helpers import GoDjangoTestCase
+
+
+class DummyExport(StoredExport):
+    ZIP_NAME = 'dummy-export.zip'
+    STORAGE_PATH = 'dummy-exports'
+
+    def spool(self, data):
+        with NamedTemporaryFile() as data_file:
+            data_file.write(data)
+            data_file.flush()
+            self.zip_data_file(data_file.name, 'dummy.txt')
+        return self
+
+
+class TestStoredExport(GoDjangoTestCase):
+
+    def mk_stored_export(self, account_key=u'acc-1'):
+        export = DummyExport().spool('foo')
+        self.add_cleanup(export.close)
+        export_id = export.store(account_key)
+        path = DummyExport.storage_path(account_key, export_id)
+        self.add_cleanup(self.delete_if_exists, path)
+        return export, export_id, path
+
+    def delete_if_exists(self, path):
+        if default_storage.exists(path):
+            default_storage.delete(path)
+
+    def test_store_and_open(self):
+        export, export_id, _path = self.mk_stored_export()
+        stored = DummyExport.open_stored(u'acc-1', export_id)
+        self.assertEqual(stored.read(), export.read())
+        stored.close()
+
+    def test_open_missing(self):
+        self.assertEqual(DummyExport.open_stored(u'acc-1', 'missing'), None)
+
+    def test_open_other_account(self):
+        _export, export_id, _path = self.mk_stored_export()
+        self.assertEqual(DummyExport.open_stored(u'acc-2', export_id), None)
+
+    def test_delete_expired_exports(self):
+        _export, _export_id, path = self.mk_stored_export()
+        with self.settings(EXPORT_EXPIRY_DAYS=7):
+            self.assertEqual(delete_expired_exports(DummyExport), 0)
+            self.assertTrue(default_storage.exists(path))
+
+            later = datetime.now() + timedelta(days=8)
+            self.assertEqual(delete_expired_exports(DummyExport, later), 1)
+            self.assertFalse(default_storage.exists(path))
+
+    def test_delete_expired_exports_nothing_stored(self):
+        self.assertEqual(delete_expired_exports(DummyExport), 0)
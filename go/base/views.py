@@ -1,7 +1,8 @@
 import requests
 
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.core.servers.basehttp import FileWrapper
+from django.http import Http404, HttpResponse
 from django.contrib.auth.decorators import login_required
 
 from go.base.utils import extract_auth_from_url
@@ -20,3 +21,17 @@ def cross_domain_xhr(request):
     return HttpResponse(
         response.content,
         status=response.status_code)
+
+
+@login_required
+def export_download(request, export_id, export_class):
+    """Send an export stored by a :class:`StoredExport` to the browser."""
+    export_file = export_class.open_stored(
+        request.user_api.user_account_key, export_id)
+    if export_file is None:
+        raise Http404
+    response = HttpResponse(
+        FileWrapper(export_file), mimetype='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=%s' % (
+        export_class.ZIP_NAME,)
+    return response
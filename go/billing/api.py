@@ -1,15 +1,22 @@
 import json
+import base64
+import calendar
+import datetime
 
 from twisted.python import log
-from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.internet import defer, reactor
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
+from psycopg2 import IntegrityError, errorcodes
+
 from django.contrib.auth.hashers import make_password
 
 from go.billing import settings as app_settings
 from go.billing.models import MessageCost
-from go.billing.utils import JSONEncoder, JSONDecoder, BillingError
+from go.billing.utils import (
+    JSONEncoder, JSONDecoder, BillingError, DictRowConnection)
 
 
 class BaseResource(Resource):
@@ -313,7 +320,9 @@ class AccountResource(BaseResource):
                         message_direction, credit_amount, status,
                         created, last_modified)
                    VALUES (%(account_number)s, '', '', '', %(credit_amount)s,
-                          'Completed', now(), now())"""
+                          'Completed', now(), now())
+                   RETURNING account_number, tag_pool_name, tag_name,
+                             message_direction, credit_amount, created"""
 
         params = {
             'account_number': account_number,
@@ -321,6 +330,8 @@ class AccountResource(BaseResource):
         }
 
         cursor = yield cursor.execute(query, params)
+        transaction = yield cursor.fetchone()
+        yield update_transaction_rollups(cursor, [transaction])
 
         # Update the account's credit balance
         query = """
@@ -358,11 +369,466 @@ class AccountResource(BaseResource):
         defer.returnValue(result)
 
 
+@defer.inlineCallbacks
+def check_credit_balance_alert(credit_balance, alert_credit_balance,
+                               credit_amount):
+    """Check whether deducting ``credit_amount`` took an account's credit
+    balance below its alert threshold.
+
+    Returns ``True`` if it did.
+    """
+    if (credit_balance < alert_credit_balance and
+            credit_balance + credit_amount > alert_credit_balance):
+        # TODO: Raise a Low Credits alert; somehow
+        return True
+    return False
+
+
+def update_transaction_rollups(cursor, transactions):
+    """Add newly created `transactions` to their accounts' daily totals."""
+    totals = {}
+    for transaction in transactions:
+        key = (transaction['account_number'],
+               transaction['created'].date(),
+               transaction['tag_pool_name'] or '',
+               transaction['tag_name'] or '',
+               transaction['message_direction'] or '')
+        count, credit_amount = totals.get(key, (0, 0))
+        totals[key] = (count + 1, credit_amount + transaction['credit_amount'])
+
+    # The UPDATE and INSERT race with other transactions adding the same
+    # rollup. If another transaction inserts it first, our INSERT fails with
+    # a unique violation once theirs commits. We then roll back to the
+    # savepoint and try again, and this time the UPDATE finds their rollup.
+    # The savepoint is set and released in the same round trip as the upsert.
+    query = """
+        SAVEPOINT update_rollup;
+        WITH updated AS (
+            UPDATE billing_transactionrollup
+            SET transaction_count = transaction_count + %(transaction_count)s,
+                credit_amount = credit_amount + %(credit_amount)s
+            WHERE account_number = %(account_number)s
+            AND day = %(day)s
+            AND tag_pool_name = %(tag_pool_name)s
+            AND tag_name = %(tag_name)s
+            AND message_direction = %(message_direction)s
+            RETURNING id)
+        INSERT INTO billing_transactionrollup
+            (account_number, day, tag_pool_name, tag_name,
+             message_direction, transaction_count, credit_amount)
+        SELECT %(account_number)s, %(day)s, %(tag_pool_name)s, %(tag_name)s,
+               %(message_direction)s, %(transaction_count)s,
+               %(credit_amount)s
+        WHERE NOT EXISTS (SELECT * FROM updated);
+        RELEASE SAVEPOINT update_rollup;
+    """
+
+    for key in sorted(totals):
+        (account_number, day, tag_pool_name, tag_name,
+         message_direction) = key
+        transaction_count, credit_amount = totals[key]
+        params = {
+            'account_number': account_number,
+            'day': day,
+            'tag_pool_name': tag_pool_name,
+            'tag_name': tag_name,
+            'message_direction': message_direction,
+            'transaction_count': transaction_count,
+            'credit_amount': credit_amount,
+        }
+        while True:
+            try:
+                yield cursor.execute(query, params)
+            except IntegrityError, e:
+                if e.pgcode != errorcodes.UNIQUE_VIOLATION:
+                    raise
+                yield cursor.execute("ROLLBACK TO SAVEPOINT update_rollup")
+            else:
+                break
+
+
+class MessageCostCache(object):
+    """An in-memory index of message costs.
+
+    Costs hardly ever change but are needed for every transaction, so all of
+    them are loaded at once and looked up here instead of being queried for
+    each message. The costs are reloaded after a change is announced on
+    :attr:`MessageCost.NOTIFY_CHANNEL` (see :meth:`listen`) and every
+    ``reload_interval`` seconds in case an announcement was missed.
+
+    :param connection_pool:
+        The txpostgres connection pool to load costs with.
+    :param float reload_interval:
+        Maximum number of seconds to keep costs for.
+    :param clock:
+        An ``IReactorTime`` provider. Defaults to the global reactor.
+    """
+
+    def __init__(self, connection_pool, reload_interval=None, clock=None):
+        if reload_interval is None:
+            reload_interval = app_settings.COST_CACHE_RELOAD_INTERVAL
+        if clock is None:
+            clock = reactor
+        self._connection_pool = connection_pool
+        self.reload_interval = reload_interval
+        self.clock = clock
+        # (account_number, tag_pool_name, message_direction) -> cost
+        self._costs = None
+        self._loaded_at = None
+        self._generation = 0
+        self._waiting = []
+        self._listener = None
+
+    @defer.inlineCallbacks
+    def _load(self):
+        query = """
+            SELECT a.account_number, t.name AS tag_pool_name,
+                   c.message_direction, c.message_cost,
+                   c.session_cost, c.markup_percent
+            FROM billing_messagecost c
+                 LEFT OUTER JOIN billing_tagpool t ON (c.tag_pool_id = t.id)
+                 LEFT OUTER JOIN billing_account a ON (c.account_id = a.id)
+        """
+        loaded_at = self.clock.seconds()
+        result = yield self._connection_pool.runQuery(query)
+        costs = {}
+        for cost in result:
+            key = (cost['account_number'], cost['tag_pool_name'],
+                   cost['message_direction'])
+            costs[key] = cost
+        defer.returnValue((costs, loaded_at))
+
+    def _is_stale(self):
+        if self._costs is None:
+            return True
+        return self.clock.seconds() - self._loaded_at >= self.reload_interval
+
+    def load(self):
+        """Load all the message costs.
+
+        Returns a deferred that fires with a dict mapping
+        ``(account_number, tag_pool_name, message_direction)`` to costs.
+        Concurrent calls share a single query, unless the costs are
+        invalidated while it's running. Calls made after that wait for a
+        query that started after the invalidation.
+        """
+        d = defer.Deferred()
+        self._waiting.append((d, self._generation))
+        if len(self._waiting) == 1:
+            self._start_load()
+        return d
+
+    def _start_load(self):
+        self._load().addBoth(self._loaded, self._generation)
+
+    def _loaded(self, result, generation):
+        waiting = [d for d, g in self._waiting if g <= generation]
+        self._waiting = [(d, g) for d, g in self._waiting if g > generation]
+        if self._waiting:
+            self._start_load()
+        if isinstance(result, Failure):
+            for d in waiting:
+                d.errback(result)
+            return
+        costs, loaded_at = result
+        # Costs that changed while we were loading them may be out of date.
+        if generation == self._generation:
+            self._costs, self._loaded_at = costs, loaded_at
+        for d in waiting:
+            d.callback(costs)
+
+    def invalidate(self):
+        """Reload the costs before they're next used."""
+        self._generation += 1
+        self._costs = None
+
+    @defer.inlineCallbacks
+    def get_cost(self, account_number, tag_pool_name, message_direction):
+        """Return the message cost for the given parameters.
+
+        An account's cost override for the tag pool is used if there is one.
+        Otherwise the tag pool's cost is used, falling back to the default
+        cost for the message direction. Returns ``None`` if there's no
+        applicable cost.
+        """
+        costs = self._costs
+        if self._is_stale():
+            costs = yield self.load()
+        candidates = [
+            (account_number, tag_pool_name, message_direction),
+            (None, tag_pool_name, message_direction),
+            (None, None, message_direction),
+        ]
+        for key in candidates:
+            cost = costs.get(key)
+            if cost is not None:
+                defer.returnValue(dict(cost))
+        defer.returnValue(None)
+
+    @defer.inlineCallbacks
+    def listen(self, connection_string):
+        """Invalidate the costs whenever they're announced to have changed.
+
+        This opens a database connection of its own, since notifications are
+        only delivered to the connection that is listening for them.
+        """
+        connection = DictRowConnection()
+        yield connection.connect(connection_string)
+        connection.addNotifyObserver(lambda notify: self.invalidate())
+        yield connection.runOperation(
+            "LISTEN %s" % (MessageCost.NOTIFY_CHANNEL,))
+        self._listener = connection
+        defer.returnValue(connection)
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+
+class TransactionBatcher(object):
+    """Writes transactions in batches.
+
+    Transactions received within ``max_delay`` seconds of each other (up to
+    ``max_batch_size`` of them) are written together in a single database
+    transaction: one multi-row INSERT and a single credit balance UPDATE for
+    each account. This keeps busy accounts' rows locked far less often than
+    writing each transaction separately. If a batch can't be written, its
+    transactions are retried one at a time so that a single bad transaction
+    doesn't fail the rest.
+
+    :param connection_pool:
+        The txpostgres connection pool to write transactions with.
+    :param MessageCostCache cost_cache:
+        The message costs to bill transactions with.
+    :param int max_batch_size:
+        Maximum number of transactions to write at once.
+    :param float max_delay:
+        Maximum number of seconds to wait for more transactions before
+        writing a batch.
+    :param clock:
+        An ``IReactorTime`` provider. Defaults to the global reactor.
+    """
+
+    TRANSACTION_FIELDS = (
+        'account_number', 'message_id', 'tag_pool_name', 'tag_name',
+        'message_direction', 'message_cost', 'session_created',
+        'session_cost', 'markup_percent', 'credit_factor', 'credit_amount')
+
+    def __init__(self, connection_pool, cost_cache, max_batch_size=None,
+                 max_delay=None, clock=None):
+        if max_batch_size is None:
+            max_batch_size = app_settings.API_TRANSACTION_BATCH_SIZE
+        if max_delay is None:
+            max_delay = app_settings.API_TRANSACTION_BATCH_DELAY
+        if clock is None:
+            clock = reactor
+        self._connection_pool = connection_pool
+        self._cost_cache = cost_cache
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.clock = clock
+        self._pending = []
+        self._delayed_flush = None
+
+    @defer.inlineCallbacks
+    def add(self, account_number, message_id, tag_pool_name, tag_name,
+            message_direction, session_created):
+        """Queue a transaction to be written with the next batch.
+
+        Returns a deferred that fires with the created transaction once its
+        batch has been written.
+        """
+        cost = yield self._cost_cache.get_cost(
+            account_number, tag_pool_name, message_direction)
+        if cost is None:
+            raise BillingError(
+                "Unable to determine %s message cost for account %s"
+                " and tag pool %s" % (
+                    message_direction, account_number, tag_pool_name))
+
+        credit_amount = MessageCost.calculate_credit_cost(
+            cost['message_cost'], cost['markup_percent'],
+            cost['session_cost'], session_created=session_created)
+        params = {
+            'account_number': account_number,
+            'message_id': message_id,
+            'tag_pool_name': tag_pool_name,
+            'tag_name': tag_name,
+            'message_direction': message_direction,
+            'message_cost': cost['message_cost'],
+            'session_created': session_created,
+            'session_cost': cost['session_cost'],
+            'markup_percent': cost['markup_percent'],
+            'credit_factor': app_settings.CREDIT_CONVERSION_FACTOR,
+            'credit_amount': -credit_amount,
+        }
+        d = defer.Deferred()
+        self._pending.append((params, d))
+        if len(self._pending) >= self.max_batch_size:
+            self.flush()
+        elif self._delayed_flush is None:
+            self._delayed_flush = self.clock.callLater(
+                self.max_delay, self.flush)
+        transaction = yield d
+        defer.returnValue(transaction)
+
+    def flush(self):
+        """Write the pending transactions."""
+        if self._delayed_flush is not None:
+            if self._delayed_flush.active():
+                self._delayed_flush.cancel()
+            self._delayed_flush = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return defer.succeed(None)
+        return self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        d = self._connection_pool.runInteraction(
+            self.write_batch_interaction, batch)
+        d.addCallbacks(self._batch_written, self._batch_failed,
+                       callbackArgs=[batch], errbackArgs=[batch])
+        return d
+
+    def _batch_written(self, results, batch):
+        for (_, d), result in zip(batch, results):
+            if isinstance(result, Exception):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _batch_failed(self, failure, batch):
+        if len(batch) == 1:
+            [(_, d)] = batch
+            d.errback(failure)
+            return
+        # One bad transaction fails the whole batch, so write them one at a
+        # time to find out which. The rest still get written.
+        log.err(failure, "Failed to write a batch of %d transactions, "
+                "writing them individually." % (len(batch),))
+        return defer.gatherResults(
+            [self._write_batch([item]) for item in batch])
+
+    @defer.inlineCallbacks
+    def write_batch_interaction(self, cursor, batch):
+        """Write a batch of transactions.
+
+        Returns a list with the created transaction, or the error, for each
+        item in the batch.
+        """
+        credit_amounts = {}
+        for params, _ in batch:
+            account_number = params['account_number']
+            credit_amounts[account_number] = (
+                credit_amounts.get(account_number, 0) -
+                params['credit_amount'])
+
+        # Update the credit balances in a consistent order so that
+        # concurrent batches can't deadlock, and check each account's
+        # credit balance against its alert threshold.
+        query = """
+            UPDATE billing_account
+            SET credit_balance = credit_balance - %(credit_amount)s
+            WHERE account_number = %(account_number)s
+            RETURNING credit_balance, alert_credit_balance
+        """
+        missing_accounts = set()
+        for account_number in sorted(credit_amounts):
+            credit_amount = credit_amounts[account_number]
+            params = {
+                'credit_amount': credit_amount,
+                'account_number': account_number,
+            }
+            cursor = yield cursor.execute(query, params)
+            result = yield cursor.fetchone()
+            if result is None:
+                missing_accounts.add(account_number)
+                continue
+
+            check_credit_balance_alert(
+                result.get('credit_balance'),
+                result.get('alert_credit_balance'), credit_amount)
+
+        errors = []
+        rows = []
+        for params, _ in batch:
+            if params['account_number'] in missing_accounts:
+                errors.append(BillingError(
+                    "Unable to find billing account %s while checking"
+                    " credit balance. Message was %s to/from tag pool %s." % (
+                        params['account_number'],
+                        params['message_direction'],
+                        params['tag_pool_name'])))
+            else:
+                errors.append(None)
+                rows.append(params)
+
+        transactions = yield self._insert_transactions(cursor, rows)
+        yield update_transaction_rollups(cursor, transactions)
+        transactions = iter(transactions)
+        defer.returnValue([
+            error if error is not None else transactions.next()
+            for error in errors])
+
+    @defer.inlineCallbacks
+    def _insert_transactions(self, cursor, rows):
+        """Insert `rows` and return the created transactions in order."""
+        if not rows:
+            defer.returnValue([])
+
+        values = []
+        params = {}
+        for i, row in enumerate(rows):
+            placeholders = []
+            for field in self.TRANSACTION_FIELDS:
+                name = '%s_%d' % (field, i)
+                params[name] = row[field]
+                placeholders.append('%%(%s)s' % (name,))
+            values.append(
+                "(%s, 'Completed', now(), now())" % (', '.join(placeholders),))
+
+        query = """
+            INSERT INTO billing_transaction
+                (%s, status, created, last_modified)
+            VALUES
+                %s
+            RETURNING id, account_number, message_id,
+                      tag_pool_name, tag_name,
+                      message_direction, message_cost,
+                      session_cost, session_created,
+                      markup_percent, credit_factor, credit_amount, status,
+                      created, last_modified
+        """ % (', '.join(self.TRANSACTION_FIELDS), ',\n'.join(values))
+
+        cursor = yield cursor.execute(query, params)
+        created = yield cursor.fetchall()
+
+        # Match the created transactions up with the rows they were created
+        # from rather than relying on the order they're returned in.
+        by_message = {}
+        for transaction in created:
+            by_message.setdefault(
+                self._transaction_key(transaction), []).append(transaction)
+        defer.returnValue([
+            by_message[self._transaction_key(row)].pop(0) for row in rows])
+
+    def _transaction_key(self, transaction):
+        return (transaction['account_number'], transaction['message_id'],
+                transaction['tag_pool_name'], transaction['tag_name'],
+                transaction['message_direction'],
+                transaction['session_created'])
+
+
 class CostResource(BaseResource):
     """Expose a REST interface for a message cost"""
 
     isLeaf = True
 
+    def __init__(self, connection_pool, cost_cache=None):
+        BaseResource.__init__(self, connection_pool)
+        self._cost_cache = cost_cache
+
     def render_GET(self, request):
         """Handle an HTTP GET request"""
         account_number = request.args.get('account_number', [None])
@@ -536,6 +1002,10 @@ class CostResource(BaseResource):
         cursor = yield cursor.execute(query, params)
         result = yield cursor.fetchone()
 
+        # Let the billing servers know that they need to reload their costs.
+        # The notification is only sent once the transaction commits.
+        yield cursor.execute("NOTIFY %s" % (MessageCost.NOTIFY_CHANNEL,))
+
         defer.returnValue(result)
 
     @defer.inlineCallbacks
@@ -552,6 +1022,8 @@ class CostResource(BaseResource):
             tag_pool_name, message_direction, message_cost, session_cost,
             markup_percent)
 
+        if self._cost_cache is not None:
+            self._cost_cache.invalidate()
         defer.returnValue(result)
 
 
@@ -560,12 +1032,34 @@ class TransactionResource(BaseResource):
 
     isLeaf = True
 
+    def __init__(self, connection_pool, cost_cache=None, batcher=None):
+        BaseResource.__init__(self, connection_pool)
+        if cost_cache is None:
+            cost_cache = MessageCostCache(connection_pool)
+        self._cost_cache = cost_cache
+        self._batcher = batcher
+
     def render_GET(self, request):
         """Handle an HTTP GET request"""
+        params = filter(None, request.postpath)
+        if params == ['summary']:
+            return self.render_summary_GET(request)
+
         account_number = request.args.get('account_number', [])
         page_number = request.args.get('page_number', [0])
         items_per_page = request.args.get('items_per_page', [20])
-        if len(account_number) > 0:
+        cursor = request.args.get('cursor', [None])
+        if len(account_number) > 0 and cursor[0] is not None:
+            try:
+                d = self.get_transaction_page(
+                    account_number[0], cursor[0], items_per_page[0])
+            except ValueError:
+                self._handle_bad_request(request)
+            else:
+                d.addCallbacks(self._render_to_json, self._handle_error,
+                               callbackArgs=[request], errbackArgs=[request])
+
+        elif len(account_number) > 0:
             d = self.get_transaction_list(
                 account_number[0], page_number[0], items_per_page[0])
 
@@ -576,6 +1070,25 @@ class TransactionResource(BaseResource):
             self._handle_bad_request(request)
         return NOT_DONE_YET
 
+    def render_summary_GET(self, request):
+        """Handle an HTTP GET request for a transaction summary"""
+        account_number = request.args.get('account_number', [None])
+        from_date = request.args.get('from_date', [None])
+        to_date = request.args.get('to_date', [None])
+        if account_number[0] is not None:
+            try:
+                d = self.get_transaction_summary(
+                    account_number[0], from_date[0], to_date[0])
+            except ValueError:
+                self._handle_bad_request(request)
+            else:
+                d.addCallbacks(self._render_to_json, self._handle_error,
+                               callbackArgs=[request], errbackArgs=[request])
+
+        else:
+            self._handle_bad_request(request)
+        return NOT_DONE_YET
+
     def render_POST(self, request):
         """Handle an HTTP POST request"""
         data = self._parse_json(request)
@@ -604,49 +1117,9 @@ class TransactionResource(BaseResource):
     def get_cost(self, account_number, tag_pool_name, message_direction,
                  session_created):
         """Return the message cost"""
-        query = """
-            SELECT t.account_number, t.tag_pool_name, t.message_direction,
-                   t.message_cost, t.session_cost, t.markup_percent
-            FROM (SELECT a.account_number, t.name AS tag_pool_name,
-                         c.message_direction, c.message_cost,
-                         c.session_cost, c.markup_percent
-                  FROM billing_messagecost c
-                  INNER JOIN billing_tagpool t ON (c.tag_pool_id = t.id)
-                  INNER JOIN billing_account a ON (c.account_id = a.id)
-                  WHERE a.account_number = %(account_number)s
-                  AND t.name = %(tag_pool_name)s
-                  AND c.message_direction = %(message_direction)s
-                  UNION
-                  SELECT NULL AS account_number, t.name AS tag_pool_name,
-                         c.message_direction, c.message_cost,
-                         c.session_cost, c.markup_percent
-                  FROM billing_messagecost c
-                  INNER JOIN billing_tagpool t ON (c.tag_pool_id = t.id)
-                  WHERE c.account_id IS NULL
-                  AND t.name = %(tag_pool_name)s
-                  AND c.message_direction = %(message_direction)s
-                  UNION
-                  SELECT NULL AS account_number, NULL AS tag_pool_name,
-                         c.message_direction, c.message_cost,
-                         c.session_cost, c.markup_percent
-                  FROM billing_messagecost c
-                  WHERE c.account_id IS NULL
-                  AND c.tag_pool_id IS NULL
-                  AND c.message_direction = %(message_direction)s
-            ) as t
-            ORDER BY t.account_number
-            LIMIT 1
-            """
-
-        params = {
-            'account_number': account_number,
-            'tag_pool_name': tag_pool_name,
-            'message_direction': message_direction
-        }
-
-        result = yield self._connection_pool.runQuery(query, params)
-        if len(result) > 0:
-            message_cost = result[0]
+        message_cost = yield self._cost_cache.get_cost(
+            account_number, tag_pool_name, message_direction)
+        if message_cost is not None:
             message_cost['credit_amount'] = MessageCost.calculate_credit_cost(
                 message_cost['message_cost'],
                 message_cost['markup_percent'],
@@ -699,6 +1172,126 @@ class TransactionResource(BaseResource):
         else:
             defer.returnValue(None)
 
+    def _encode_cursor(self, transaction):
+        # The position is encoded as microseconds since the epoch so that
+        # the cursor doesn't depend on the timestamp's time zone.
+        created = transaction['created']
+        timestamp = (calendar.timegm(created.utctimetuple()) * 1000000 +
+                     created.microsecond)
+        data = json.dumps([timestamp, transaction['id']])
+        return base64.urlsafe_b64encode(data)
+
+    def _decode_cursor(self, cursor):
+        """Return the ``(created, id)`` encoded in `cursor`, with `created`
+        in microseconds since the epoch.
+
+        Raises ``ValueError`` if `cursor` isn't a valid cursor.
+        """
+        try:
+            created, id = json.loads(base64.urlsafe_b64decode(cursor))
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor: %r" % (cursor,))
+        for value in (created, id):
+            if not isinstance(value, (int, long)):
+                raise ValueError("Invalid cursor: %r" % (cursor,))
+        return created, id
+
+    def get_transaction_page(self, account_number, cursor, items_per_page):
+        """Return a page of transactions and the cursor for the next page.
+
+        Pages are found by seeking to the position `cursor` in the
+        ``(account_number, created, id)`` index, so later pages are as
+        cheap to fetch as the first. An empty `cursor` fetches the first
+        page.
+
+        Raises ``ValueError`` if `cursor` isn't a valid cursor.
+        """
+        params = {'account_number': account_number}
+        try:
+            params['limit'] = max(1, int(items_per_page))
+        except (TypeError, ValueError):
+            params['limit'] = 20
+        position = ""
+        if cursor:
+            params['created'], params['id'] = self._decode_cursor(cursor)
+            position = """
+                AND (created, id) < (
+                    TIMESTAMP WITH TIME ZONE 'epoch'
+                    + %(created)s * INTERVAL '1 microsecond',
+                    %(id)s)
+            """
+
+        query = """
+            SELECT id, account_number, message_id,
+                   tag_pool_name, tag_name,
+                   message_direction, message_cost,
+                   session_created, session_cost,
+                   markup_percent, credit_factor, credit_amount,
+                   status, created, last_modified
+            FROM billing_transaction
+            WHERE account_number = %%(account_number)s
+            %s
+            ORDER BY created DESC, id DESC
+            LIMIT %%(limit)s
+        """ % (position,)
+
+        d = self._connection_pool.runQuery(query, params)
+        d.addCallback(self._transaction_page, params['limit'])
+        return d
+
+    def _transaction_page(self, transactions, limit):
+        next_cursor = None
+        if transactions and len(transactions) == limit:
+            next_cursor = self._encode_cursor(transactions[-1])
+        return {
+            'transactions': transactions,
+            'next_cursor': next_cursor,
+        }
+
+    def _parse_date(self, value):
+        """Return the ``YYYY-MM-DD`` date `value` as a ``date``.
+
+        Raises ``ValueError`` if `value` isn't a valid date.
+        """
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            raise ValueError("Invalid date: %r" % (value,))
+
+    def get_transaction_summary(self, account_number, from_date=None,
+                                to_date=None):
+        """Return an account's daily transaction totals for each tag pool.
+
+        The totals come from the transaction rollups rather than the
+        transactions themselves. `from_date` and `to_date` are inclusive
+        ``YYYY-MM-DD`` dates.
+
+        Raises ``ValueError`` if either date isn't a valid date.
+        """
+        conditions = ""
+        params = {'account_number': account_number}
+        if from_date:
+            conditions += " AND day >= %(from_date)s"
+            params['from_date'] = self._parse_date(from_date)
+        if to_date:
+            conditions += " AND day <= %(to_date)s"
+            params['to_date'] = self._parse_date(to_date)
+
+        query = """
+            SELECT to_char(day, 'YYYY-MM-DD') AS day, tag_pool_name,
+                   message_direction,
+                   CAST(SUM(transaction_count) AS integer)
+                       AS transaction_count,
+                   SUM(credit_amount) AS credit_amount
+            FROM billing_transactionrollup
+            WHERE account_number = %%(account_number)s
+            %s
+            GROUP BY day, tag_pool_name, message_direction
+            ORDER BY day, tag_pool_name, message_direction
+        """ % (conditions,)
+
+        return self._connection_pool.runQuery(query, params)
+
     @defer.inlineCallbacks
     def create_transaction_interaction(self, cursor, account_number,
                                        message_id, tag_pool_name, tag_name,
@@ -791,11 +1384,11 @@ class TransactionResource(BaseResource):
                 " credit balance. Message was %s to/from tag pool %s." % (
                     account_number, message_direction, tag_pool_name))
 
-        credit_balance = result.get('credit_balance')
-        alert_credit_balance = result.get('alert_credit_balance')
-        if (credit_balance < alert_credit_balance and
-                credit_balance + credit_amount > alert_credit_balance):
-            pass  # TODO: Raise a Low Credits alert; somehow
+        check_credit_balance_alert(
+            result.get('credit_balance'), result.get('alert_credit_balance'),
+            credit_amount)
+
+        yield update_transaction_rollups(cursor, [transaction])
 
         defer.returnValue(transaction)
 
@@ -803,6 +1396,12 @@ class TransactionResource(BaseResource):
     def create_transaction(self, account_number, message_id, tag_pool_name,
                            tag_name, message_direction, session_created):
         """Create a new transaction for the given ``account_number``"""
+        if self._batcher is not None:
+            result = yield self._batcher.add(
+                account_number, message_id, tag_pool_name, tag_name,
+                message_direction, session_created)
+            defer.returnValue(result)
+
         result = yield self._connection_pool.runInteraction(
             self.create_transaction_interaction, account_number, message_id,
             tag_pool_name, tag_name, message_direction, session_created)
@@ -813,12 +1412,20 @@ class TransactionResource(BaseResource):
 class Root(BaseResource):
     """The root resource"""
 
-    def __init__(self, connection_pool):
+    def __init__(self, connection_pool, cost_cache=None):
         BaseResource.__init__(self, connection_pool)
+        if cost_cache is None:
+            cost_cache = MessageCostCache(connection_pool)
+        self.cost_cache = cost_cache
+        self.transaction_batcher = None
+        if app_settings.API_BATCH_TRANSACTIONS:
+            self.transaction_batcher = TransactionBatcher(
+                connection_pool, cost_cache)
         self.putChild('users', UserResource(connection_pool))
         self.putChild('accounts', AccountResource(connection_pool))
-        self.putChild('costs', CostResource(connection_pool))
-        self.putChild('transactions', TransactionResource(connection_pool))
+        self.putChild('costs', CostResource(connection_pool, cost_cache))
+        self.putChild('transactions', TransactionResource(
+            connection_pool, cost_cache, self.transaction_batcher))
 
     def getChild(self, name, request):
         if name == '':
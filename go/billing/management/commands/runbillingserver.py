@@ -22,6 +22,8 @@ class Command(BaseCommand):
         def connection_established(connection_pool):
             from twisted.web.server import Site
             root = api.Root(connection_pool)
+            d = root.cost_cache.listen(connection_string)
+            d.addErrback(log.err, "Unable to listen for message cost changes")
             site = Site(root)
             endpoint = serverFromString(
                 reactor, app_settings.ENDPOINT_DESCRIPTION_STRING)
@@ -1,7 +1,7 @@
 from decimal import Decimal
 
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, connections, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
@@ -66,6 +66,10 @@ class MessageCost(models.Model):
         (DIRECTION_OUTBOUND, DIRECTION_OUTBOUND),
     )
 
+    # Billing servers cache message costs and reload them when notified on
+    # this channel.
+    NOTIFY_CHANNEL = 'billing_messagecost_changed'
+
     @classmethod
     def apply_markup_and_convert_to_credits(cls, cost, markup_percent,
                                             context=None):
@@ -162,6 +166,24 @@ class MessageCost(models.Model):
         return u"%s (%s)" % (self.tag_pool, self.message_direction)
 
 
+def notify_message_costs_changed(sender, instance, using, **kwargs):
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    cursor = connection.cursor()
+    cursor.execute("NOTIFY %s" % (MessageCost.NOTIFY_CHANNEL,))
+    transaction.commit_unless_managed(using=using)
+
+
+for model in (MessageCost, TagPool, Account):
+    post_save.connect(
+        notify_message_costs_changed, sender=model,
+        dispatch_uid='go.billing.models.notify_message_costs_changed')
+    post_delete.connect(
+        notify_message_costs_changed, sender=model,
+        dispatch_uid='go.billing.models.notify_message_costs_changed')
+
+
 class Transaction(models.Model):
     """Represents a credit transaction"""
 
@@ -215,10 +237,86 @@ class Transaction(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        index_together = [
+            ['account_number', 'created', 'id'],
+        ]
+
     def __unicode__(self):
         return unicode(self.pk)
 
 
+class TransactionRollup(models.Model):
+    """Daily totals of an account's transactions.
+
+    The billing API keeps these up to date as it creates transactions so
+    that summaries and statements don't need to scan every transaction.
+
+    """
+
+    account_number = models.CharField(max_length=100)
+    tag_pool_name = models.CharField(max_length=100, blank=True, default='')
+    tag_name = models.CharField(max_length=100, blank=True, default='')
+    message_direction = models.CharField(max_length=20, blank=True,
+                                         default='')
+    day = models.DateField()
+
+    transaction_count = models.IntegerField(default=0)
+    credit_amount = models.DecimalField(max_digits=20, decimal_places=6,
+                                        default=Decimal('0.0'))
+
+    class Meta:
+        unique_together = [
+            ['account_number', 'day', 'tag_pool_name', 'tag_name',
+             'message_direction'],
+        ]
+
+    @classmethod
+    def add_transaction(cls, billing_transaction):
+        """Add a newly created ``Transaction`` to its rollup."""
+        fields = {
+            'account_number': billing_transaction.account_number,
+            'day': billing_transaction.created.date(),
+            'tag_pool_name': billing_transaction.tag_pool_name or '',
+            'tag_name': billing_transaction.tag_name or '',
+            'message_direction': billing_transaction.message_direction or '',
+        }
+        credit_amount = billing_transaction.credit_amount
+        while True:
+            updated = cls.objects.filter(**fields).update(
+                transaction_count=models.F('transaction_count') + 1,
+                credit_amount=models.F('credit_amount') + credit_amount)
+            if updated:
+                return
+            # Someone else may create the rollup after our update, in which
+            # case the create fails and the next update finds their rollup.
+            sid = transaction.savepoint()
+            try:
+                cls.objects.create(
+                    transaction_count=1, credit_amount=credit_amount,
+                    **fields)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+                return
+
+    def __unicode__(self):
+        return u"%s %s (%s)" % (self.account_number, self.day,
+                                self.tag_pool_name)
+
+
+def roll_up_transaction(sender, instance, created, raw=False, **kwargs):
+    # The billing API maintains the rollups for the transactions it
+    # creates, this catches the ones created through the ORM.
+    if created and not raw:
+        TransactionRollup.add_transaction(instance)
+
+
+post_save.connect(roll_up_transaction, sender=Transaction,
+    dispatch_uid='go.billing.models.roll_up_transaction')
+
+
 class Statement(models.Model):
     """Account statement for a period of time"""
 
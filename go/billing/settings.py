@@ -18,6 +18,23 @@ if hasattr(settings, 'BILLING_QUANTIZATION_EXPONENT'):
 
 API_MIN_CONNECTIONS = getattr(settings, 'BILLING_API_MIN_CONNECTIONS', 10)
 
+# If enabled, the billing server writes transactions in batches of up to
+# BILLING_API_TRANSACTION_BATCH_SIZE, waiting at most
+# BILLING_API_TRANSACTION_BATCH_DELAY seconds for a batch to fill up.
+API_BATCH_TRANSACTIONS = getattr(
+    settings, 'BILLING_API_BATCH_TRANSACTIONS', False)
+
+API_TRANSACTION_BATCH_SIZE = getattr(
+    settings, 'BILLING_API_TRANSACTION_BATCH_SIZE', 100)
+
+API_TRANSACTION_BATCH_DELAY = getattr(
+    settings, 'BILLING_API_TRANSACTION_BATCH_DELAY', 0.05)
+
+# Maximum number of seconds the billing server keeps message costs in memory
+# for before reloading them.
+COST_CACHE_RELOAD_INTERVAL = getattr(
+    settings, 'BILLING_COST_CACHE_RELOAD_INTERVAL', 5 * 60)
+
 ENDPOINT_DESCRIPTION_STRING = getattr(
     settings, 'BILLING_ENDPOINT_DESCRIPTION_STRING',
     "tcp:9090:interface=127.0.0.1")
@@ -25,6 +42,10 @@ ENDPOINT_DESCRIPTION_STRING = getattr(
 MONTHLY_STATEMENT_TITLE = getattr(
     settings, 'BILLING_MONTHLY_STATEMENT_TITLE', "Monthly Statement")
 
+# Maximum number of monthly statements to generate at once.
+STATEMENT_CONCURRENCY = getattr(
+    settings, 'BILLING_STATEMENT_CONCURRENCY', 10)
+
 STATEMENTS_PER_PAGE = getattr(
     settings, 'BILLING_STATEMENTS_PER_PAGE', 12)
 
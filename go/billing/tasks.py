@@ -1,25 +1,48 @@
+import logging
 from datetime import date
 
 from dateutil.relativedelta import relativedelta
 
+from celery import chain
 from celery.task import task, group
 
+from django.db.transaction import commit_on_success
 from django.db.models import Sum
 
 from go.billing import settings
-from go.billing.models import Account, Transaction, Statement, LineItem
+from go.billing.models import Account, TransactionRollup, Statement, LineItem
+
+logger = logging.getLogger(__name__)
 
 
 @task()
 def generate_monthly_statement(account_id, from_date, to_date):
     """Generate a new *Monthly* ``Statement`` for the given ``account_id``
        between the given ``from_date`` and ``to_date``.
+
+       Errors are logged rather than raised, so that one account's failure
+       doesn't stop the statements chained after it. Returns ``None`` if
+       the statement couldn't be generated.
     """
+    try:
+        return _generate_monthly_statement(account_id, from_date, to_date)
+    except Exception:
+        logger.exception(
+            "Failed to generate monthly statement for account %s." % (
+                account_id,))
+        return None
+
+
+@commit_on_success
+def _generate_monthly_statement(account_id, from_date, to_date):
+    # The statement and its line items are saved together so that a failure
+    # doesn't leave behind a statement that stops the account's statement
+    # from being generated again.
     account = Account.objects.get(id=account_id)
-    transaction_list = Transaction.objects\
+    transaction_list = TransactionRollup.objects\
         .filter(account_number=account.account_number,
-                created__gte=from_date,
-                created__lt=(to_date + relativedelta(days=1)))\
+                day__gte=from_date,
+                day__lte=to_date)\
         .values('tag_pool_name', 'tag_name', 'message_direction')\
         .annotate(total_cost=Sum('credit_amount'))
 
@@ -49,6 +72,9 @@ def generate_monthly_statement(account_id, from_date, to_date):
 def generate_monthly_account_statements():
     """Spawn sub-tasks to generate a *Monthly* ``Statement`` for accounts
        without a *Monthly* statement.
+
+       The sub-tasks are split into ``STATEMENT_CONCURRENCY`` chains so that
+       only that many statements are generated at once.
     """
     today = date.today()
     last_month = today - relativedelta(months=1)
@@ -59,9 +85,11 @@ def generate_monthly_account_statements():
         statement__from_date=from_date,
         statement__to_date=to_date)
 
-    task_list = []
-    for account in account_list:
-        task_list.append(
-            generate_monthly_statement.s(account.id, from_date, to_date))
+    chain_count = max(settings.STATEMENT_CONCURRENCY, 1)
+    task_lists = [[] for _ in range(chain_count)]
+    for i, account in enumerate(account_list):
+        task_lists[i % chain_count].append(
+            generate_monthly_statement.si(account.id, from_date, to_date))
 
-    return group(task_list)()
+    return group(chain(*task_list) for task_list in task_lists
+                 if task_list)()
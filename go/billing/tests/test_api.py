@@ -3,14 +3,15 @@ import decimal
 
 import pytest
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList
 
 from vumi.tests.helpers import VumiTestCase
 
 from go.billing import settings as app_settings
 from go.billing import api
 from go.billing.models import MessageCost
-from go.billing.utils import DummySite, DictRowConnectionPool, JSONDecoder
+from go.billing.utils import (
+    DummySite, DictRowConnectionPool, JSONDecoder, BillingError)
 
 
 DB_SUPPORTED = False
@@ -44,6 +45,7 @@ class BillingApiTestCase(VumiTestCase):
             None, connection_string, min=app_settings.API_MIN_CONNECTIONS)
         self.connection_pool = yield connection_pool.start()
         root = api.Root(connection_pool)
+        self.cost_cache = root.cost_cache
         self.web = DummySite(root)
 
     @inlineCallbacks
@@ -343,6 +345,183 @@ class TestCost(BillingApiTestCase):
             all_costs, [cost_override, base_cost, fallback_cost])
 
 
+class TestMessageCostCache(BillingApiTestCase):
+
+    @inlineCallbacks
+    def test_get_cost_fallbacks(self):
+        yield self.create_api_user(email="test5@example.com")
+        yield self.create_api_account(
+            email="test5@example.com", account_number="22222")
+        yield self.create_api_cost(
+            message_direction="Inbound", message_cost=0.1,
+            session_cost=0.1, markup_percent=10.0)
+        yield self.create_api_cost(
+            tag_pool_name="pool1", message_direction="Inbound",
+            message_cost=0.2, session_cost=0.2, markup_percent=10.0)
+        yield self.create_api_cost(
+            account_number="22222", tag_pool_name="pool1",
+            message_direction="Inbound", message_cost=0.3,
+            session_cost=0.3, markup_percent=10.0)
+
+        def get_cost_amount(account_number, tag_pool_name, direction):
+            d = self.cost_cache.get_cost(
+                account_number, tag_pool_name, direction)
+            return d.addCallback(lambda cost: cost and cost['message_cost'])
+
+        self.assertEqual(
+            (yield get_cost_amount("22222", "pool1", "Inbound")),
+            decimal.Decimal('0.3'))
+        self.assertEqual(
+            (yield get_cost_amount("33333", "pool1", "Inbound")),
+            decimal.Decimal('0.2'))
+        self.assertEqual(
+            (yield get_cost_amount("22222", "pool2", "Inbound")),
+            decimal.Decimal('0.1'))
+        self.assertEqual(
+            (yield get_cost_amount("22222", "pool1", "Outbound")), None)
+
+    @inlineCallbacks
+    def test_new_costs_invalidate_cache(self):
+        yield self.create_api_cost(
+            tag_pool_name="pool1", message_direction="Inbound",
+            message_cost=0.2, session_cost=0.2, markup_percent=10.0)
+        cost = yield self.cost_cache.get_cost(None, "pool1", "Inbound")
+        self.assertEqual(cost['message_cost'], decimal.Decimal('0.2'))
+        cost = yield self.cost_cache.get_cost(None, "pool1", "Outbound")
+        self.assertEqual(cost, None)
+        yield self.create_api_cost(
+            tag_pool_name="pool1", message_direction="Outbound",
+            message_cost=0.4, session_cost=0.2, markup_percent=10.0)
+        cost = yield self.cost_cache.get_cost(None, "pool1", "Outbound")
+        self.assertEqual(cost['message_cost'], decimal.Decimal('0.4'))
+
+    @inlineCallbacks
+    def test_concurrent_loads_share_query(self):
+        yield self.create_api_cost(
+            message_direction="Inbound", message_cost=0.1,
+            session_cost=0.1, markup_percent=10.0)
+        d1 = self.cost_cache.load()
+        d2 = self.cost_cache.load()
+        costs1 = yield d1
+        costs2 = yield d2
+        self.assertTrue(costs1 is costs2)
+        self.assertEqual(costs1.keys(), [(None, None, u'Inbound')])
+
+    @inlineCallbacks
+    def test_load_after_invalidate_does_not_share_query(self):
+        yield self.create_api_cost(
+            message_direction="Inbound", message_cost=0.1,
+            session_cost=0.1, markup_percent=10.0)
+        d1 = self.cost_cache.load()
+        self.cost_cache.invalidate()
+        d2 = self.cost_cache.load()
+        d3 = self.cost_cache.load()
+        costs1 = yield d1
+        costs2 = yield d2
+        costs3 = yield d3
+        self.assertFalse(costs1 is costs2)
+        self.assertTrue(costs2 is costs3)
+        self.assertTrue(self.cost_cache._costs is costs2)
+
+
+class TestTransactionBatcher(BillingApiTestCase):
+
+    def mk_batcher(self, max_batch_size=3, max_delay=0.01):
+        return api.TransactionBatcher(
+            self.connection_pool, self.cost_cache,
+            max_batch_size=max_batch_size, max_delay=max_delay)
+
+    def add_transaction(self, batcher, account_number, message_id):
+        return batcher.add(
+            account_number=account_number, message_id=message_id,
+            tag_pool_name="pool1", tag_name="12345",
+            message_direction="Inbound", session_created=False)
+
+    @inlineCallbacks
+    def test_batch(self):
+        yield self.create_api_user(email="test6@example.com")
+        account = yield self.create_api_account(
+            email="test6@example.com", account_number="44444")
+        yield self.create_api_cost(
+            tag_pool_name="pool1", message_direction="Inbound",
+            message_cost=0.6, session_cost=0.3, markup_percent=10.0)
+        credit_amount = MessageCost.calculate_credit_cost(
+            decimal.Decimal('0.6'), decimal.Decimal('10.0'),
+            decimal.Decimal('0.3'), session_created=False)
+
+        batcher = self.mk_batcher()
+        transactions = yield DeferredList([
+            self.add_transaction(batcher, "44444", "msg-%s" % (i,))
+            for i in range(5)], fireOnOneErrback=True, consumeErrors=True)
+        self.assertEqual(
+            [t['message_id'] for _, t in transactions],
+            ["msg-%s" % (i,) for i in range(5)])
+        self.assertEqual(
+            set(t['credit_amount'] for _, t in transactions),
+            set([-credit_amount]))
+
+        account = yield self.get_api_account(account["account_number"])
+        self.assertEqual(account['credit_balance'], -5 * credit_amount)
+        transactions = yield self.get_api_transaction_list("44444")
+        self.assertEqual(len(transactions), 5)
+
+    @inlineCallbacks
+    def test_batch_with_missing_account(self):
+        yield self.create_api_user(email="test7@example.com")
+        yield self.create_api_account(
+            email="test7@example.com", account_number="55555")
+        yield self.create_api_cost(
+            tag_pool_name="pool1", message_direction="Inbound",
+            message_cost=0.6, session_cost=0.3, markup_percent=10.0)
+
+        batcher = self.mk_batcher(max_batch_size=2)
+        d1 = self.add_transaction(batcher, "55555", "msg-1")
+        d2 = self.add_transaction(batcher, "66666", "msg-2")
+        transaction = yield d1
+        self.assertEqual(transaction['message_id'], "msg-1")
+        yield self.assertFailure(d2, BillingError)
+
+    @inlineCallbacks
+    def test_batch_failure_written_individually(self):
+        yield self.create_api_user(email="test10@example.com")
+        account = yield self.create_api_account(
+            email="test10@example.com", account_number="99999")
+        yield self.create_api_cost(
+            tag_pool_name="pool1", message_direction="Inbound",
+            message_cost=0.6, session_cost=0.3, markup_percent=10.0)
+        credit_amount = MessageCost.calculate_credit_cost(
+            decimal.Decimal('0.6'), decimal.Decimal('10.0'),
+            decimal.Decimal('0.3'), session_created=False)
+
+        batcher = self.mk_batcher(max_batch_size=3)
+        d1 = self.add_transaction(batcher, "99999", "msg-1")
+        # The tag name is too long for its column, so the batch's INSERT
+        # fails.
+        d2 = batcher.add(
+            account_number="99999", message_id="msg-2",
+            tag_pool_name="pool1", tag_name="x" * 101,
+            message_direction="Inbound", session_created=False)
+        d3 = self.add_transaction(batcher, "99999", "msg-3")
+        transaction = yield d1
+        self.assertEqual(transaction['message_id'], "msg-1")
+        yield self.assertFailure(d2, Exception)
+        transaction = yield d3
+        self.assertEqual(transaction['message_id'], "msg-3")
+        self.flushLoggedErrors()
+
+        account = yield self.get_api_account(account["account_number"])
+        self.assertEqual(account['credit_balance'], -2 * credit_amount)
+        transactions = yield self.get_api_transaction_list("99999")
+        self.assertEqual(len(transactions), 2)
+
+    @inlineCallbacks
+    def test_unknown_cost(self):
+        batcher = self.mk_batcher()
+        d = self.add_transaction(batcher, "55555", "msg-1")
+        yield self.assertFailure(d, BillingError)
+        self.assertEqual(batcher._pending, [])
+
+
 class TestTransaction(BillingApiTestCase):
 
     @inlineCallbacks
@@ -559,3 +738,113 @@ class TestTransaction(BillingApiTestCase):
             ("Unable to find billing account unknown-account while"
              " checking credit balance. Message was Outbound to/from"
              " tag pool some-random-pool.",))
+
+    @inlineCallbacks
+    def create_transactions(self, account_number, count):
+        yield self.create_api_cost(
+            tag_pool_name="pool1", message_direction="Inbound",
+            message_cost=0.6, session_cost=0.3, markup_percent=10.0)
+        yield self.create_api_cost(
+            tag_pool_name="pool2", message_direction="Outbound",
+            message_cost=0.2, session_cost=0.3, markup_percent=10.0)
+        for i in range(count):
+            yield self.create_api_transaction(
+                account_number=account_number,
+                message_id='msg-id-%s' % (i,),
+                tag_pool_name="pool1" if i % 2 else "pool2",
+                tag_name="12345",
+                message_direction="Inbound" if i % 2 else "Outbound",
+                session_created=False)
+
+    @inlineCallbacks
+    def test_transaction_pages(self):
+        yield self.create_api_user(email="test8@example.com")
+        yield self.create_api_account(
+            email="test8@example.com", account_number="77777")
+        yield self.create_transactions("77777", 5)
+
+        pages = []
+        cursor = ''
+        while cursor is not None:
+            page = yield self.call_api('get', 'transactions', args={
+                'account_number': "77777",
+                'cursor': cursor,
+                'items_per_page': 2,
+            })
+            pages.append([t['message_id'] for t in page['transactions']])
+            cursor = page['next_cursor']
+        self.assertEqual(pages, [
+            ['msg-id-4', 'msg-id-3'],
+            ['msg-id-2', 'msg-id-1'],
+            ['msg-id-0'],
+        ])
+
+    @inlineCallbacks
+    def test_transaction_pages_invalid_cursor(self):
+        try:
+            yield self.call_api('get', 'transactions', args={
+                'account_number': "77777",
+                'cursor': 'foo',
+            })
+        except ApiCallError, e:
+            self.assertEqual(e.response.responseCode, 400)
+        else:
+            self.fail("Expected an invalid cursor to be rejected.")
+
+    @inlineCallbacks
+    def test_transaction_pages_negative_items_per_page(self):
+        yield self.create_api_user(email="test11@example.com")
+        yield self.create_api_account(
+            email="test11@example.com", account_number="12121")
+        yield self.create_transactions("12121", 3)
+        page = yield self.call_api('get', 'transactions', args={
+            'account_number': "12121",
+            'cursor': '',
+            'items_per_page': -1,
+        })
+        self.assertEqual(
+            [t['message_id'] for t in page['transactions']], ['msg-id-2'])
+        self.assertNotEqual(page['next_cursor'], None)
+
+    @inlineCallbacks
+    def test_transaction_summary(self):
+        yield self.create_api_user(email="test9@example.com")
+        yield self.create_api_account(
+            email="test9@example.com", account_number="88888")
+        yield self.create_transactions("88888", 5)
+        pool1_credits = MessageCost.calculate_credit_cost(
+            decimal.Decimal('0.6'), decimal.Decimal('10.0'),
+            decimal.Decimal('0.3'), session_created=False)
+        pool2_credits = MessageCost.calculate_credit_cost(
+            decimal.Decimal('0.2'), decimal.Decimal('10.0'),
+            decimal.Decimal('0.3'), session_created=False)
+
+        [transaction] = yield self.call_api('get', 'transactions', args={
+            'account_number': "88888", 'items_per_page': 1})
+        day = transaction['created'][:10]
+        summary = yield self.call_api('get', 'transactions/summary', args={
+            'account_number': "88888", 'from_date': day, 'to_date': day})
+        self.assertEqual(summary, [{
+            u'day': day,
+            u'tag_pool_name': u'pool1',
+            u'message_direction': u'Inbound',
+            u'transaction_count': 2,
+            u'credit_amount': -2 * pool1_credits,
+        }, {
+            u'day': day,
+            u'tag_pool_name': u'pool2',
+            u'message_direction': u'Outbound',
+            u'transaction_count': 3,
+            u'credit_amount': -3 * pool2_credits,
+        }])
+
+    @inlineCallbacks
+    def test_transaction_summary_invalid_date(self):
+        for args in [{'from_date': 'foo'}, {'to_date': '2014-13-01'}]:
+            args['account_number'] = "88888"
+            try:
+                yield self.call_api('get', 'transactions/summary', args=args)
+            except ApiCallError, e:
+                self.assertEqual(e.response.responseCode, 400)
+            else:
+                self.fail("Expected an invalid date to be rejected.")
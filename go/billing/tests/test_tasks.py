@@ -6,8 +6,11 @@ from decimal import Decimal
 
 from dateutil.relativedelta import relativedelta
 
+from django.db.models.query import QuerySet
+
 from go.base.tests.helpers import GoDjangoTestCase, DjangoVumiApiHelper
-from go.billing.models import MessageCost, Account, Transaction, Statement
+from go.billing.models import (
+    MessageCost, Account, Transaction, TransactionRollup, Statement)
 from go.billing import tasks
 
 
@@ -39,7 +42,7 @@ class TestMonthlyStatementTask(GoDjangoTestCase):
         transaction.save()
         return transaction
 
-    @mock.patch('go.billing.tasks.generate_monthly_statement.s',
+    @mock.patch('go.billing.tasks.generate_monthly_statement.si',
                 new_callable=mock.MagicMock)
     def test_generate_monthly_statements(self, s):
         today = date.today()
@@ -78,3 +81,100 @@ class TestMonthlyStatementTask(GoDjangoTestCase):
 
         self.assertEqual(result, statement)
         self.assertEqual(statement.lineitem_set.count(), 2)
+
+    @mock.patch('go.billing.tasks.logger')
+    def test_generate_monthly_statement_failure(self, logger):
+        self._mk_transaction(self.account.account_number)
+        today = date.today()
+        from_date = date(today.year, today.month, 1)
+        to_date = from_date + relativedelta(months=1, days=-1)
+
+        with mock.patch.object(
+                QuerySet, 'bulk_create', side_effect=ValueError('boom')):
+            result = tasks.generate_monthly_statement(
+                self.account.id, from_date, to_date)
+
+        self.assertEqual(result, None)
+        self.assertTrue(logger.exception.called)
+
+    @mock.patch('go.billing.tasks.logger')
+    def test_generate_monthly_statement_missing_account(self, logger):
+        today = date.today()
+        result = tasks.generate_monthly_statement(-1, today, today)
+        self.assertEqual(result, None)
+        self.assertTrue(logger.exception.called)
+
+    @mock.patch('go.billing.settings.STATEMENT_CONCURRENCY', 2)
+    @mock.patch('go.billing.tasks.group')
+    @mock.patch('go.billing.tasks.chain')
+    @mock.patch('go.billing.tasks.generate_monthly_statement.si',
+                new_callable=mock.MagicMock)
+    def test_generate_monthly_statements_concurrency(self, si, chain, group):
+        for i in range(2):
+            self.vumi_helper.make_django_user(
+                email='user%s@example.com' % (i,))
+        si.side_effect = lambda account_id, from_date, to_date: account_id
+
+        tasks.generate_monthly_account_statements()
+
+        account_ids = list(Account.objects.values_list('id', flat=True))
+        self.assertEqual(len(account_ids), 3)
+        self.assertEqual(chain.call_count, 2)
+        chained_ids = sum([list(args) for args, _ in chain.call_args_list],
+                          [])
+        self.assertEqual(sorted(chained_ids), sorted(account_ids))
+        [(chains,), _] = group.call_args
+        self.assertEqual(len(list(chains)), 2)
+
+    def test_transactions_rolled_up(self):
+        self._mk_transaction(self.account.account_number, credit_amount=28)
+        self._mk_transaction(self.account.account_number, credit_amount=14)
+        self._mk_transaction(
+            self.account.account_number,
+            message_direction=MessageCost.DIRECTION_OUTBOUND)
+
+        rollup = TransactionRollup.objects.get(
+            account_number=self.account.account_number,
+            message_direction=MessageCost.DIRECTION_INBOUND)
+        self.assertEqual(rollup.day, date.today())
+        self.assertEqual(rollup.tag_pool_name, 'pool1')
+        self.assertEqual(rollup.tag_name, 'tag1')
+        self.assertEqual(rollup.transaction_count, 2)
+        self.assertEqual(rollup.credit_amount, Decimal('42.0'))
+        self.assertEqual(TransactionRollup.objects.count(), 2)
+
+    def test_rollup_created_concurrently(self):
+        self._mk_transaction(self.account.account_number, credit_amount=28)
+        real_update = QuerySet.update
+        updates = []
+
+        def update(queryset, **kwargs):
+            # The first update runs as if before the rollup was created by
+            # someone else.
+            updates.append(kwargs)
+            if len(updates) == 1:
+                return 0
+            return real_update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', update):
+            self._mk_transaction(
+                self.account.account_number, credit_amount=14)
+
+        self.assertEqual(len(updates), 2)
+        rollup = TransactionRollup.objects.get(
+            account_number=self.account.account_number)
+        self.assertEqual(rollup.transaction_count, 2)
+        self.assertEqual(rollup.credit_amount, Decimal('42.0'))
+
+    def test_generate_monthly_statement_from_rollups(self):
+        self._mk_transaction(self.account.account_number, credit_amount=28)
+        self._mk_transaction(self.account.account_number, credit_amount=14)
+
+        today = date.today()
+        from_date = date(today.year, today.month, 1)
+        statement = tasks.generate_monthly_statement(
+            self.account.id, from_date, today)
+
+        [line_item] = statement.lineitem_set.all()
+        self.assertEqual(line_item.tag_pool_name, 'pool1')
+        self.assertEqual(line_item.total_cost, 42)
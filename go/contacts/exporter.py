@@ -0,0 +1,125 @@
+"""Streaming contact exports."""
+
+from tempfile import NamedTemporaryFile
+
+from go.base.exports import StoredExport
+from go.base.utils import UnicodeCSVWriter
+from go.contacts.importer import chunks
+
+
+CONTACT_FIELDS = [
+    'key',
+    'name',
+    'surname',
+    'email_address',
+    'msisdn',
+    'dob',
+    'twitter_handle',
+    'facebook_id',
+    'bbm_pin',
+    'gtalk_id',
+    'mxit_id',
+    'wechat_id',
+    'created_at',
+]
+
+
+def unique_keys(keys):
+    """Return `keys` with duplicates removed, keeping the first of each."""
+    seen = set()
+    unique = []
+    for key in keys:
+        if key not in seen:
+            seen.add(key)
+            unique.append(key)
+    return unique
+
+
+def scan_contacts(contact_store, contact_keys, include_extra=True):
+    """
+    Return the keys of the contacts that exist, ordered by creation time,
+    and the sorted names of the extra fields they use.
+
+    Contacts are loaded a bunch at a time and only their keys, creation
+    times and extra field names are kept, so this doesn't hold the
+    contacts themselves in memory.
+    """
+    created = []
+    extra_fields = set()
+    for contacts in contact_store.contacts.load_all_bunches(contact_keys):
+        for contact in contacts:
+            created.append((contact.created_at, contact.key))
+            if include_extra:
+                extra_fields.update(contact.extra.keys())
+    created.sort(key=lambda item: item[0])
+    return [key for _, key in created], sorted(extra_fields)
+
+
+def write_contacts_csv(contact_store, contact_keys, extra_fields, csv_file,
+                       chunk_size=100):
+    """
+    Write a CSV row to `csv_file` for each of `contact_keys`, in order,
+    loading `chunk_size` contacts at a time. Returns the number of rows
+    written.
+    """
+    writer = UnicodeCSVWriter(csv_file)
+
+    # Prepend extras with `extras-` if they happen to overlap with any of
+    # the existing contact's fields.
+    writer.writerow(CONTACT_FIELDS + [
+        ('extras-%s' % (f,) if f in CONTACT_FIELDS else f)
+        for f in extra_fields])
+
+    count = 0
+    for chunk in chunks(contact_keys, chunk_size):
+        # Bunches aren't guaranteed to come back in the order we asked for.
+        contacts = {}
+        for bunch in contact_store.contacts.load_all_bunches(chunk):
+            contacts.update((contact.key, contact) for contact in bunch)
+        for key in chunk:
+            contact = contacts.get(key)
+            if contact is None:
+                # Deleted since we scanned the contacts.
+                continue
+            row = [unicode(getattr(contact, field, None) or '')
+                   for field in CONTACT_FIELDS]
+            row.extend([unicode(contact.extra[extra_field] or '')
+                        for extra_field in extra_fields])
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+class ContactExport(StoredExport):
+    """
+    A zipped CSV export of contacts spooled to a temporary file.
+
+    :param ContactStore contact_store:
+        A contact store using synchronous managers.
+    :param list contact_keys:
+        The keys of the contacts to export.
+    :param bool include_extra:
+        Whether or not to include the extra data stored in the dynamic field.
+    """
+
+    CSV_NAME = 'contacts-export.csv'
+    ZIP_NAME = 'contacts-export.zip'
+    STORAGE_PATH = 'contact-exports'
+
+    def __init__(self, contact_store, contact_keys, include_extra=True):
+        self.contact_store = contact_store
+        self.contact_keys = unique_keys(contact_keys)
+        self.include_extra = include_extra
+        self.count = 0
+
+    def spool(self):
+        """Write the export to a temporary zip file."""
+        keys, extra_fields = scan_contacts(
+            self.contact_store, self.contact_keys, self.include_extra)
+
+        with NamedTemporaryFile(suffix='.csv') as csv_file:
+            self.count = write_contacts_csv(
+                self.contact_store, keys, extra_fields, csv_file)
+            csv_file.flush()
+            self.zip_data_file(csv_file.name, self.CSV_NAME)
+        return self
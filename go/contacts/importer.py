@@ -0,0 +1,180 @@
+"""Chunked, resumable contact imports."""
+
+import json
+from itertools import islice
+from uuid import uuid5, NAMESPACE_URL
+
+
+def chunks(iterable, size):
+    """Yield lists of up to `size` items from `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ImportCheckpoint(object):
+    """
+    Records the progress of a contact import in Redis.
+
+    The checkpoint is only advanced once a whole chunk of rows has been
+    written, so an import that is rerun after failing part of the way through
+    carries on from the start of the chunk it was working on.
+
+    :param redis:
+        A synchronous Redis manager.
+    :param str import_id:
+        A string identifying the import. Rerunning an import with the same
+        id resumes it.
+    """
+
+    # Abandoned checkpoints are cleaned up after a week.
+    CHECKPOINT_TTL = 7 * 24 * 60 * 60
+
+    def __init__(self, redis, import_id):
+        self.redis = redis
+        self.import_id = import_id
+
+    def _progress_key(self):
+        return "progress:%s" % (self.import_id,)
+
+    def _errors_key(self):
+        return "errors:%s" % (self.import_id,)
+
+    def _get_int(self, field):
+        return int(self.redis.hget(self._progress_key(), field) or 0)
+
+    def get_position(self):
+        """Return the number of rows that have been processed."""
+        return self._get_int('position')
+
+    def get_count(self):
+        """Return the number of contacts that have been written."""
+        return self._get_int('count')
+
+    def get_errors(self):
+        """Return a list of ``(contact_key, reason)`` pairs."""
+        return [tuple(json.loads(error))
+                for error in self.redis.lrange(self._errors_key(), 0, -1)]
+
+    def advance(self, rows, written, errors=()):
+        progress_key = self._progress_key()
+        self.redis.hincrby(progress_key, 'position', rows)
+        self.redis.hincrby(progress_key, 'count', written)
+        self.redis.expire(progress_key, self.CHECKPOINT_TTL)
+        if errors:
+            errors_key = self._errors_key()
+            for error in errors:
+                self.redis.rpush(errors_key, json.dumps(error))
+            self.redis.expire(errors_key, self.CHECKPOINT_TTL)
+
+    def clear(self):
+        self.redis.delete(self._progress_key())
+        self.redis.delete(self._errors_key())
+
+
+class ContactImporter(object):
+    """
+    Writes parsed contact rows to a contact store a chunk at a time,
+    recording progress in an :class:`ImportCheckpoint`.
+
+    New contacts are given keys derived from the import id and their row
+    number so that rewriting a chunk after a failure replaces the contacts
+    from the earlier attempt instead of duplicating them.
+
+    :param ContactStore contact_store:
+        A contact store using synchronous managers.
+    :param ImportCheckpoint checkpoint:
+        Where to record progress.
+    :param int chunk_size:
+        Number of rows to process between checkpoints. Defaults to
+        :attr:`CHUNK_SIZE`.
+    """
+
+    CHUNK_SIZE = 100
+
+    def __init__(self, contact_store, checkpoint, chunk_size=None):
+        self.contact_store = contact_store
+        self.checkpoint = checkpoint
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+
+    def contact_key_for_row(self, row_number):
+        return uuid5(NAMESPACE_URL, "contact-import:%s:%s" % (
+            self.checkpoint.import_id, row_number)).hex
+
+    def pending_chunks(self, contact_dictionaries):
+        """
+        Return chunks of ``(row_number, contact_dictionary)`` pairs for the
+        rows that haven't been processed yet.
+        """
+        # Rows before the checkpoint still need to be parsed, but they were
+        # written by an earlier attempt so we skip them here.
+        rows = islice(enumerate(contact_dictionaries),
+                      self.checkpoint.get_position(), None)
+        return chunks(rows, self.chunk_size)
+
+    def import_new_contacts(self, contact_dictionaries, group_key):
+        """
+        Create a contact in the group for each row. Returns the number of
+        contacts created.
+        """
+        for chunk in self.pending_chunks(contact_dictionaries):
+            for row_number, contact_dictionary in chunk:
+                # Make sure we set this group they're being uploaded in to
+                contact_dictionary['groups'] = [group_key]
+                self.contact_store.new_contact_with_key(
+                    self.contact_key_for_row(row_number),
+                    **contact_dictionary)
+            self.checkpoint.advance(len(chunk), len(chunk))
+        return self.checkpoint.get_count()
+
+    def rollback_new_contacts(self):
+        """Delete any contacts created by :meth:`import_new_contacts`."""
+        # The chunk after the checkpoint may have been partially written.
+        row_count = self.checkpoint.get_position() + self.chunk_size
+        keys = [self.contact_key_for_row(i) for i in range(row_count)]
+        for contacts in self.contact_store.contacts.load_all_bunches(keys):
+            for contact in contacts:
+                self.contact_store.delete_contact(contact)
+
+    def import_contact_updates(self, contact_dictionaries, contact_mangler):
+        """
+        Update the existing contact identified by the ``key`` in each row.
+
+        `contact_mangler` is called with the loaded contact and the row and
+        returns the fields to update the contact with. Rows that can't be
+        applied are recorded as errors in the checkpoint. Returns the number
+        of contacts updated.
+        """
+        for chunk in self.pending_chunks(contact_dictionaries):
+            keys = [contact_dictionary['key']
+                    for _, contact_dictionary in chunk
+                    if 'key' in contact_dictionary]
+            contacts = {}
+            for bunch in self.contact_store.contacts.load_all_bunches(keys):
+                contacts.update((contact.key, contact) for contact in bunch)
+
+            written = 0
+            errors = []
+            for _, contact_dictionary in chunk:
+                key = contact_dictionary.pop('key', None)
+                if key is None:
+                    errors.append((key, 'No key provided'))
+                    continue
+                contact = contacts.get(key)
+                if contact is None:
+                    errors.append(
+                        (key, "Contact with key '%s' not found." % (key,)))
+                    continue
+                try:
+                    contact_dictionary = contact_mangler(
+                        contact, contact_dictionary)
+                    self.contact_store.update_contact_fields(
+                        contact, **contact_dictionary)
+                    written += 1
+                except Exception, e:
+                    errors.append((key, str(e)))
+            self.checkpoint.advance(len(chunk), written, errors)
+        return self.checkpoint.get_count()
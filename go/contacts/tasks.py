@@ -1,22 +1,32 @@
 import sys
 import traceback
-from StringIO import StringIO
-from zipfile import ZipFile, ZIP_DEFLATED
 
+from celery import current_task
 from celery.task import task
 
 from django.conf import settings
+from django.contrib.sites.models import Site
 from django.core.mail import send_mail, EmailMessage
 from django.core.files.storage import default_storage
+from django.core.urlresolvers import reverse
 from django.template.loader import render_to_string
 from django.utils.safestring import mark_safe
 
 from go.vumitools.api import VumiUserApi
-from go.vumitools.contact.models import ContactNotFoundError
+from go.base.exports import delete_expired_exports
 from go.base.models import UserProfile
-from go.base.utils import UnicodeCSVWriter
-from go.contacts.parsers import ContactFileParser
-from go.contacts.utils import contacts_by_key
+from go.contacts.exporter import ContactExport
+from go.contacts.importer import ContactImporter, ImportCheckpoint
+from go.contacts.parsers import ContactFileParser, ContactParserException
+from go.contacts.parsers.base import FieldNormalizerException
+
+
+# Failed imports are retried and resume from where they stopped.
+IMPORT_MAX_RETRIES = 3
+IMPORT_RETRY_DELAY = 60
+# Errors caused by the file's contents. These will fail the same way every
+# time, so there's no point retrying them.
+IMPORT_DATA_ERRORS = (ContactParserException, FieldNormalizerException)
 
 
 @task(ignore_result=True)
@@ -37,7 +47,9 @@ def delete_group(account_key, group_key):
         contact = contact_store.get_contact_by_key(contact_key)
         contact.groups.remove(group)
         contact.save()
-    group.delete()
+        contact_store.update_group_membership(
+            contact.key, removed_group_keys=[group.key])
+    contact_store.delete_group(group)
 
 
 @task(ignore_result=True)
@@ -50,75 +62,62 @@ def delete_group_contacts(account_key, group_key):
     # and the boilerplate for fetching batches without having them all sit in
     # memory is ugly.
     for contact_key in contacts:
-        contact_store.get_contact_by_key(contact_key).delete()
-
-
-def zipped_file(filename, data):
-    zipio = StringIO()
-    zf = ZipFile(zipio, "a", ZIP_DEFLATED)
-    zf.writestr(filename, data)
-    zf.close()
-    return zipio.getvalue()
-
-
-_contact_fields = [
-    'key',
-    'name',
-    'surname',
-    'email_address',
-    'msisdn',
-    'dob',
-    'twitter_handle',
-    'facebook_id',
-    'bbm_pin',
-    'gtalk_id',
-    'mxit_id',
-    'wechat_id',
-    'created_at',
-]
-
-
-def contacts_to_csv(contacts, include_extra=True):
-    contacts = sorted(contacts, key=lambda c: c.created_at)
-
-    io = StringIO()
-    writer = UnicodeCSVWriter(io)
-
-    # Collect the possible field names for this set of contacts, depending
-    # the number of contacts found this could be potentially expensive.
-    extra_fields = set()
-    if include_extra:
-        for contact in contacts:
-            extra_fields.update(contact.extra.keys())
-    extra_fields = sorted(extra_fields)
-
-    # write the CSV header, prepend extras with `extra-` if it happens to
-    # overlap with any of the existing contact's fields.
-    writer.writerow(_contact_fields + [
-        ('extras-%s' % (f,) if f in _contact_fields else f)
-        for f in extra_fields])
-
-    # loop over the contacts and create the row populated with
-    # the values of the selected fields.
-    for contact in contacts:
-        row = [unicode(getattr(contact, field, None) or '')
-               for field in _contact_fields]
-
-        if include_extra:
-            row.extend([unicode(contact.extra[extra_field] or '')
-                        for extra_field in extra_fields])
-
-        writer.writerow(row)
-
-    return io.getvalue()
-
-
-def get_group_contacts(contact_store, *groups):
+        contact_store.delete_contact(
+            contact_store.get_contact_by_key(contact_key))
+
+
+def get_group_contact_keys(contact_store, *groups):
     contact_keys = []
     for group in groups:
         contact_keys.extend(contact_store.get_contacts_for_group(group))
+    return contact_keys
+
+
+def send_contacts_export(account_key, export, subject, description,
+                         details=''):
+    """
+    Email a spooled :class:`ContactExport` to the account holder.
+
+    Exports larger than ``settings.CONTACT_EXPORT_ATTACHMENT_LIMIT`` bytes
+    are saved to file storage and the email links to them instead.
 
-    return contacts_by_key(contact_store, *contact_keys)
+    :param str description:
+        What the export contains, e.g. ``'the CSV data for 2 contact(s)'``.
+    :param str details:
+        Extra text for the end of the email body.
+    """
+    # Get the profile for this user so we can email them when the export
+    # has been completed.
+    user_profile = UserProfile.objects.get(user_account=account_key)
+
+    if export.size() > settings.CONTACT_EXPORT_ATTACHMENT_LIMIT:
+        export_id = export.store(account_key)
+        body = render_to_string('contacts/export_download_mail.txt', {
+            'description': description,
+            'details': details,
+            'expiry_days': settings.EXPORT_EXPIRY_DAYS,
+            'download_url': 'http://%s%s' % (
+                Site.objects.get_current().domain,
+                reverse('contacts:export_download', kwargs={
+                    'export_id': export_id,
+                })),
+        })
+        attachment = None
+    else:
+        body = 'Please find %s attached.\n\n%s' % (description, details)
+        attachment = export.read()
+
+    email = EmailMessage(
+        subject, body, settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
+    if attachment is not None:
+        email.attach(ContactExport.ZIP_NAME, attachment, 'application/zip')
+    email.send()
+
+
+@task(ignore_result=True)
+def delete_expired_contact_exports():
+    """Delete stored contact exports whose download links have expired."""
+    delete_expired_exports(ContactExport)
 
 
 @task(ignore_result=True)
@@ -138,21 +137,14 @@ def export_contacts(account_key, contact_keys, include_extra=True):
     api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
     contact_store = api.contact_store
 
-    contacts = contacts_by_key(contact_store, *contact_keys)
-    data = contacts_to_csv(contacts, include_extra)
-    file = zipped_file('contacts-export.csv', data)
-
-    # Get the profile for this user so we can email them when the import
-    # has been completed.
-    user_profile = UserProfile.objects.get(user_account=account_key)
-
-    email = EmailMessage(
-        'Contacts export',
-        'Please find the CSV data for %s contact(s)' % len(contacts),
-        settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
-
-    email.attach('contacts-export.zip', file, 'application/zip')
-    email.send()
+    export = ContactExport(contact_store, contact_keys, include_extra)
+    try:
+        export.spool()
+        send_contacts_export(
+            account_key, export, 'Contacts export',
+            'the CSV data for %s contact(s)' % (export.count,))
+    finally:
+        export.close()
 
 
 @task(ignore_result=True)
@@ -191,24 +183,20 @@ def export_group_contacts(account_key, group_key, include_extra=True):
     contact_store = api.contact_store
 
     group = contact_store.get_group(group_key)
-    contacts = get_group_contacts(contact_store, group)
-    data = contacts_to_csv(contacts, include_extra)
-    file = zipped_file('contacts-export.csv', data)
-
-    # Get the profile for this user so we can email them when the import
-    # has been completed.
-    user_profile = UserProfile.objects.get(user_account=account_key)
-
-    email = EmailMessage(
-        '%s contacts export' % (group.name,),
-
-        'Please find the CSV data for %s contact(s) from '
-        'group "%s" attached.\n\n' % (len(contacts), group.name),
+    export = ContactExport(
+        contact_store, get_group_contact_keys(contact_store, group),
+        include_extra)
+    try:
+        export.spool()
+        send_contacts_export(
+            account_key, export,
 
-        settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
+            '%s contacts export' % (group.name,),
 
-    email.attach('contacts-export.zip', file, 'application/zip')
-    email.send()
+            'the CSV data for %s contact(s) from group "%s"' % (
+                export.count, group.name))
+    finally:
+        export.close()
 
 
 @task(ignore_result=True)
@@ -230,66 +218,83 @@ def export_many_group_contacts(account_key, group_keys, include_extra=True):
     contact_store = api.contact_store
 
     groups = [contact_store.get_group(k) for k in group_keys]
-    contacts = get_group_contacts(contact_store, *groups)
-    data = contacts_to_csv(contacts, include_extra)
-    file = zipped_file('contacts-export.csv', data)
+    export = ContactExport(
+        contact_store, get_group_contact_keys(contact_store, *groups),
+        include_extra)
+    try:
+        export.spool()
+        send_contacts_export(
+            account_key, export,
 
-    # Get the profile for this user so we can email them when the import
-    # has been completed.
-    user_profile = UserProfile.objects.get(user_account=account_key)
+            'Contacts export',
 
-    email = EmailMessage(
-        'Contacts export',
+            'the CSV data for %s contact(s) from the groups listed below' % (
+                export.count,),
 
-        'Please find the attached CSV data for %s contact(s) from the '
-        'following groups:\n%s\n' %
-        (len(contacts), '\n'.join('  - %s' % g.name for g in groups)),
+            'Groups:\n%s\n' % (
+                '\n'.join('  - %s' % g.name for g in groups),))
+    finally:
+        export.close()
 
-        settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
 
-    email.attach('contacts-export.zip', file, 'application/zip')
-    email.send()
+def get_import_checkpoint(api, account_key, group_key, file_path):
+    redis = api.api.redis.sub_manager('contact_imports')
+    return ImportCheckpoint(
+        redis, ':'.join([account_key, group_key, file_path]))
 
 
-@task(ignore_result=True)
+def retry_import(exc):
+    """
+    Retry the import task that is currently running. The retried task
+    resumes from the import's checkpoint.
+
+    Returns ``False`` if `exc` is caused by the file's contents or if the
+    task has no retries left.
+    """
+    if isinstance(exc, IMPORT_DATA_ERRORS):
+        return False
+    if current_task.request.retries >= current_task.max_retries:
+        return False
+    raise current_task.retry(exc=exc)
+
+
+@task(ignore_result=True, max_retries=IMPORT_MAX_RETRIES,
+      default_retry_delay=IMPORT_RETRY_DELAY)
 def import_new_contacts_file(account_key, group_key, file_name, file_path,
                              fields, has_header):
     api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
     contact_store = api.contact_store
     group = contact_store.get_group(group_key)
+    checkpoint = get_import_checkpoint(api, account_key, group_key, file_path)
+    importer = ContactImporter(contact_store, checkpoint)
 
     # Get the profile for this user so we can email them when the import
     # has been completed.
     user_profile = UserProfile.objects.get(user_account=account_key)
 
-    written_contacts = []
-
     try:
         extension, parser = ContactFileParser.get_parser(file_name)
 
         contact_dictionaries = parser.parse_file(file_path, fields, has_header)
-        for counter, contact_dictionary in enumerate(contact_dictionaries):
-
-            # Make sure we set this group they're being uploaded in to
-            contact_dictionary['groups'] = [group.key]
-
-            contact = contact_store.new_contact(**contact_dictionary)
-            written_contacts.append(contact)
+        count = importer.import_new_contacts(contact_dictionaries, group.key)
 
         send_mail(
             'Contact import completed successfully.',
             render_to_string('contacts/import_completed_mail.txt', {
-                'count': counter,
+                'count': count,
                 'group': group,
                 'user': user_profile.user,
             }), settings.DEFAULT_FROM_EMAIL, [user_profile.user.email],
             fail_silently=False)
 
-    except Exception:
+    except Exception, e:
+        # Failures that aren't caused by the file's contents may go away if
+        # we try again, in which case we'll carry on from the checkpoint.
+        retry_import(e)
+
         # Clean up if something went wrong, either everything is written
         # or nothing is written
-        for contact in written_contacts:
-            contact.delete()
+        importer.rollback_new_contacts()
 
         exc_type, exc_value, exc_traceback = sys.exc_info()
 
@@ -311,8 +316,9 @@ def import_new_contacts_file(account_key, group_key, file_name, file_path,
                 user_profile.user.email,
                 'support+contact-import@vumi.org',
             ], fail_silently=False)
-    finally:
-        default_storage.delete(file_path)
+
+    checkpoint.clear()
+    default_storage.delete(file_path)
 
 
 def import_and_update_contacts(contact_mangler, account_key, group_key,
@@ -321,25 +327,21 @@ def import_and_update_contacts(contact_mangler, account_key, group_key,
     contact_store = api.contact_store
     group = contact_store.get_group(group_key)
     user_profile = UserProfile.objects.get(user_account=account_key)
+    checkpoint = get_import_checkpoint(api, account_key, group_key, file_path)
+    importer = ContactImporter(contact_store, checkpoint)
     extension, parser = ContactFileParser.get_parser(file_name)
     contact_dictionaries = parser.parse_file(file_path, fields, has_header)
 
-    errors = []
-    counter = 0
-
-    for contact_dictionary in contact_dictionaries:
-        try:
-            key = contact_dictionary.pop('key')
-            contact = contact_store.get_contact_by_key(key)
-            contact_dictionary = contact_mangler(contact, contact_dictionary)
-            contact_store.update_contact(key, **contact_dictionary)
-            counter += 1
-        except KeyError, e:
-            errors.append((key, 'No key provided'))
-        except ContactNotFoundError, e:
-            errors.append((key, str(e)))
-        except Exception, e:
-            errors.append((key, str(e)))
+    try:
+        counter = importer.import_contact_updates(
+            contact_dictionaries, contact_mangler)
+        errors = checkpoint.get_errors()
+    except Exception, e:
+        retry_import(e)
+        # We can't get any further, so report what we managed and the error
+        # that stopped us.
+        counter = checkpoint.get_count()
+        errors = checkpoint.get_errors() + [(file_name, str(e))]
 
     email = render_to_string(
         'contacts/import_upload_is_truth_completed_mail.txt', {
@@ -353,10 +355,12 @@ def import_and_update_contacts(contact_mangler, account_key, group_key,
         'Contact import completed.',
         email, settings.DEFAULT_FROM_EMAIL, [user_profile.user.email],
         fail_silently=False)
+    checkpoint.clear()
     default_storage.delete(file_path)
 
 
-@task(ignore_result=True)
+@task(ignore_result=True, max_retries=IMPORT_MAX_RETRIES,
+      default_retry_delay=IMPORT_RETRY_DELAY)
 def import_upload_is_truth_contacts_file(account_key, group_key, file_name,
                                          file_path, fields, has_header):
 
@@ -382,7 +386,8 @@ def import_upload_is_truth_contacts_file(account_key, group_key, file_name,
         fields, has_header)
 
 
-@task(ignore_result=True)
+@task(ignore_result=True, max_retries=IMPORT_MAX_RETRIES,
+      default_retry_delay=IMPORT_RETRY_DELAY)
 def import_existing_is_truth_contacts_file(account_key, group_key, file_name,
                                            file_path, fields, has_header):
 
@@ -0,0 +1,94 @@
+from StringIO import StringIO
+from zipfile import ZipFile
+
+from django.core.files.storage import default_storage
+
+from go.base.tests.helpers import GoDjangoTestCase, DjangoVumiApiHelper
+from go.contacts.exporter import (
+    unique_keys, scan_contacts, write_contacts_csv, ContactExport)
+
+
+class TestUniqueKeys(GoDjangoTestCase):
+    def test_unique_keys(self):
+        self.assertEqual(unique_keys(['b', 'a', 'b', 'c', 'a']),
+                         ['b', 'a', 'c'])
+
+
+class ExporterTestCase(GoDjangoTestCase):
+    def setUp(self):
+        self.vumi_helper = self.add_helper(DjangoVumiApiHelper())
+        self.user_helper = self.vumi_helper.make_django_user()
+        self.user_api = self.user_helper.user_api
+        self.contact_store = self.user_api.contact_store
+
+    def mkcontact(self, msisdn, **extra):
+        contact = self.contact_store.new_contact(msisdn=msisdn)
+        contact.extra.update(extra)
+        contact.save()
+        return contact
+
+
+class TestScanContacts(ExporterTestCase):
+    def test_scan_contacts(self):
+        c1 = self.mkcontact(u'+27761234561', foo=u'1')
+        c2 = self.mkcontact(u'+27761234562', bar=u'2')
+        keys, extra_fields = scan_contacts(
+            self.contact_store, [c2.key, u'missing', c1.key])
+        self.assertEqual(keys, [c1.key, c2.key])
+        self.assertEqual(extra_fields, ['bar', 'foo'])
+
+    def test_scan_contacts_without_extras(self):
+        c1 = self.mkcontact(u'+27761234561', foo=u'1')
+        keys, extra_fields = scan_contacts(
+            self.contact_store, [c1.key], include_extra=False)
+        self.assertEqual(keys, [c1.key])
+        self.assertEqual(extra_fields, [])
+
+
+class TestWriteContactsCsv(ExporterTestCase):
+    def test_write_contacts_csv(self):
+        c1 = self.mkcontact(u'+27761234561', foo=u'1')
+        c2 = self.mkcontact(u'+27761234562')
+        c3 = self.mkcontact(u'+27761234563', foo=u'3')
+        self.contact_store.delete_contact(c2)
+
+        csv_file = StringIO()
+        count = write_contacts_csv(
+            self.contact_store, [c3.key, c2.key, c1.key], ['foo', 'msisdn'],
+            csv_file, chunk_size=2)
+        self.assertEqual(count, 2)
+
+        [header, c3_data, c1_data, _] = csv_file.getvalue().split('\r\n')
+        self.assertTrue(header.endswith('created_at,foo,extras-msisdn'))
+        self.assertTrue(c3_data.startswith(c3.key))
+        self.assertTrue(c3_data.endswith(',3,'))
+        self.assertTrue(c1_data.startswith(c1.key))
+        self.assertTrue(c1_data.endswith(',1,'))
+
+
+class TestContactExport(ExporterTestCase):
+    def test_spool(self):
+        c1 = self.mkcontact(u'+27761234561', foo=u'1')
+        c2 = self.mkcontact(u'+27761234562')
+        export = ContactExport(
+            self.contact_store, [c2.key, c1.key, c2.key]).spool()
+        self.add_cleanup(export.close)
+        self.assertEqual(export.count, 2)
+
+        zipfile = ZipFile(StringIO(export.read()), 'r')
+        csv_contents = zipfile.open('contacts-export.csv', 'r').read()
+        [header, c1_data, c2_data, _] = csv_contents.split('\r\n')
+        self.assertTrue(header.endswith('created_at,foo'))
+        self.assertTrue(c1_data.startswith(c1.key))
+        self.assertTrue(c2_data.startswith(c2.key))
+        self.assertEqual(export.size(), len(export.read()))
+
+    def test_store(self):
+        c1 = self.mkcontact(u'+27761234561')
+        export = ContactExport(self.contact_store, [c1.key]).spool()
+        self.add_cleanup(export.close)
+        account_key = self.user_api.user_account_key
+        export_id = export.store(account_key)
+        path = ContactExport.storage_path(account_key, export_id)
+        self.add_cleanup(default_storage.delete, path)
+        self.assertEqual(default_storage.open(path).read(), export.read())
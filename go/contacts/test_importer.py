@@ -0,0 +1,140 @@
+from go.base.tests.helpers import GoDjangoTestCase, DjangoVumiApiHelper
+from go.contacts.importer import chunks, ContactImporter, ImportCheckpoint
+
+
+class TestChunks(GoDjangoTestCase):
+    def test_chunks(self):
+        self.assertEqual(
+            list(chunks(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_chunks_empty(self):
+        self.assertEqual(list(chunks([], 2)), [])
+
+
+class ImporterTestCase(GoDjangoTestCase):
+    def setUp(self):
+        self.vumi_helper = self.add_helper(DjangoVumiApiHelper())
+        self.user_helper = self.vumi_helper.make_django_user()
+        self.user_api = self.user_helper.user_api
+        self.contact_store = self.user_api.contact_store
+        self.redis = self.user_api.api.redis.sub_manager('contact_imports')
+
+    def mk_checkpoint(self, import_id=u'import-1'):
+        return ImportCheckpoint(self.redis, import_id)
+
+    def mk_importer(self, checkpoint=None, chunk_size=2):
+        if checkpoint is None:
+            checkpoint = self.mk_checkpoint()
+        return ContactImporter(
+            self.contact_store, checkpoint, chunk_size=chunk_size)
+
+    def mk_rows(self, count):
+        return [{'msisdn': u'+2776123456%s' % (i,), 'name': u'Name %s' % (i,)}
+                for i in range(count)]
+
+    def list_contacts(self):
+        keys = self.contact_store.list_contacts()
+        contacts = []
+        for bunch in self.contact_store.contacts.load_all_bunches(keys):
+            contacts.extend(bunch)
+        return contacts
+
+
+class TestImportCheckpoint(ImporterTestCase):
+    def test_new_checkpoint(self):
+        checkpoint = self.mk_checkpoint()
+        self.assertEqual(checkpoint.get_position(), 0)
+        self.assertEqual(checkpoint.get_count(), 0)
+        self.assertEqual(checkpoint.get_errors(), [])
+
+    def test_advance(self):
+        checkpoint = self.mk_checkpoint()
+        checkpoint.advance(2, 1, [(u'key', u'error')])
+        checkpoint.advance(2, 2)
+        self.assertEqual(checkpoint.get_position(), 4)
+        self.assertEqual(checkpoint.get_count(), 3)
+        self.assertEqual(checkpoint.get_errors(), [(u'key', u'error')])
+
+    def test_clear(self):
+        checkpoint = self.mk_checkpoint()
+        checkpoint.advance(2, 1, [(u'key', u'error')])
+        checkpoint.clear()
+        self.assertEqual(checkpoint.get_position(), 0)
+        self.assertEqual(checkpoint.get_errors(), [])
+
+
+class TestContactImporter(ImporterTestCase):
+    def test_import_new_contacts(self):
+        group = self.contact_store.new_group(u'group')
+        importer = self.mk_importer()
+        count = importer.import_new_contacts(self.mk_rows(5), group.key)
+        self.assertEqual(count, 5)
+        self.assertEqual(importer.checkpoint.get_position(), 5)
+        contacts = self.list_contacts()
+        self.assertEqual(
+            sorted(c.msisdn for c in contacts),
+            [u'+2776123456%s' % (i,) for i in range(5)])
+        for contact in contacts:
+            self.assertEqual(contact.groups.keys(), [group.key])
+
+    def test_import_new_contacts_resumes(self):
+        group = self.contact_store.new_group(u'group')
+        importer = self.mk_importer()
+        rows = self.mk_rows(5)
+
+        def failing_rows():
+            for row in rows[:3]:
+                yield dict(row)
+            raise ValueError("Broken")
+
+        self.assertRaises(
+            ValueError, importer.import_new_contacts, failing_rows(),
+            group.key)
+        # The first chunk was checkpointed and the third row was written.
+        self.assertEqual(importer.checkpoint.get_position(), 2)
+        self.assertEqual(len(self.list_contacts()), 3)
+
+        importer = self.mk_importer()
+        count = importer.import_new_contacts(
+            [dict(row) for row in rows], group.key)
+        self.assertEqual(count, 5)
+        # The partially written chunk was rewritten, not duplicated.
+        self.assertEqual(len(self.list_contacts()), 5)
+
+    def test_rollback_new_contacts(self):
+        group = self.contact_store.new_group(u'group')
+        importer = self.mk_importer()
+        importer.import_new_contacts(self.mk_rows(3), group.key)
+        other = self.contact_store.new_contact(msisdn=u'+27761234599')
+        importer.rollback_new_contacts()
+        self.assertEqual(
+            [c.key for c in self.list_contacts()], [other.key])
+
+    def test_import_contact_updates(self):
+        contact1 = self.contact_store.new_contact(
+            msisdn=u'+27761234560', name=u'Old')
+        contact2 = self.contact_store.new_contact(
+            msisdn=u'+27761234561', name=u'Old')
+        rows = [
+            {'key': contact1.key, 'name': u'New 1'},
+            {'name': u'No key'},
+            {'key': u'missing', 'name': u'Missing'},
+            {'key': contact2.key, 'name': u'New 2'},
+        ]
+
+        def mangler(contact, contact_dictionary):
+            return contact_dictionary
+
+        importer = self.mk_importer()
+        count = importer.import_contact_updates(rows, mangler)
+        self.assertEqual(count, 2)
+        self.assertEqual(importer.checkpoint.get_errors(), [
+            (None, u'No key provided'),
+            (u'missing', u"Contact with key 'missing' not found."),
+        ])
+        self.assertEqual(
+            self.contact_store.get_contact_by_key(contact1.key).name,
+            u'New 1')
+        self.assertEqual(
+            self.contact_store.get_contact_by_key(contact2.key).name,
+            u'New 2')
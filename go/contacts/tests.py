@@ -13,6 +13,7 @@ from django.core.files.storage import default_storage
 from django.core.urlresolvers import reverse
 from django.utils.html import escape
 
+from go.contacts.exporter import ContactExport
 from go.contacts.parsers.base import FieldNormalizer
 from go.base.tests.helpers import GoDjangoTestCase, DjangoVumiApiHelper
 
@@ -532,6 +533,37 @@ class TestContacts(BaseContactsTestCase):
 
         os.unlink(csv.name)
 
+    def test_import_upload_is_truth_invalid_data(self):
+        group = self.contact_store.new_group(TEST_GROUP_NAME)
+        contact = self.mkcontact()
+        csv = self.create_csv(['key', 'msisdn'], [
+            {'key': contact.key, 'msisdn': 'not-a-number'},
+        ])
+
+        response = self.client.post(reverse('contacts:people'), {
+            'contact_group': group.key,
+            'file': csv,
+        })
+        self.assertRedirects(response, group_url(group.key))
+        # Normalisation errors aren't retried, so we hear about them
+        # straight away.
+        response = self.specify_columns(group.key, columns={
+            'column-0': 'key',
+            'column-1': 'msisdn',
+            'normalize-0': '',
+            'normalize-1': 'msisdn_za',
+        }, import_rule='upload_is_truth')
+        self.assertRedirects(response, group_url(group.key))
+
+        [email] = mail.outbox
+        self.assertEqual('Contact import completed.', email.subject)
+        self.assertTrue('Invalid MSISDN: not-a-number' in email.body)
+        self.assertEqual(default_storage.listdir("tmp"), ([], []))
+        contact = self.contact_store.get_contact_by_key(contact.key)
+        self.assertEqual(contact.msisdn, u'+1234567890')
+
+        os.unlink(csv.name)
+
     def test_import_existing_is_truth(self):
         group1 = self.contact_store.new_group(TEST_GROUP_NAME)
         group2 = self.contact_store.new_group(TEST_GROUP_NAME + ' 2')
@@ -827,6 +859,29 @@ class TestContacts(BaseContactsTestCase):
         })
         self.assertContains(response, person_url(contact.key))
 
+    def test_contact_surname_filter(self):
+        smith = self.mkcontact(surname='Smith')
+        jones = self.mkcontact(surname='Jones')
+        response = self.client.get(reverse('contacts:people'), {
+            'letter': 's',
+        })
+        self.assertContains(response, person_url(smith.key))
+        self.assertNotContains(response, person_url(jones.key))
+        self.assertNotContains(response, 'cursor=')
+
+    def test_contact_surname_filter_paging(self):
+        for i in range(3):
+            self.mkcontact(surname='Smith %s' % (i,))
+        people_url = reverse('contacts:people')
+        response = self.client.get(people_url, {'letter': 's', 'limit': 2})
+        self.assertEqual(len(response.context['selected_contacts']), 2)
+        next_cursor = response.context['next_cursor']
+        self.assertNotEqual(next_cursor, None)
+        response = self.client.get(people_url, {
+            'letter': 's', 'limit': 2, 'cursor': next_cursor})
+        self.assertEqual(len(response.context['selected_contacts']), 1)
+        self.assertEqual(response.context['next_cursor'], None)
+
     def test_contact_key_value_query(self):
         contact = self.mkcontact()
         people_url = reverse('contacts:people')
@@ -1101,6 +1156,45 @@ class TestGroups(BaseContactsTestCase):
         self.assertTrue(contents)
         self.assertEqual(mime_type, 'application/zip')
 
+    def test_group_contact_export_too_large_to_attach(self):
+        group = self.contact_store.new_group(TEST_GROUP_NAME)
+        contact = self.mkcontact(groups=[group])
+        group_url = reverse('contacts:group', kwargs={
+            'group_key': group.key,
+        })
+
+        with self.settings(CONTACT_EXPORT_ATTACHMENT_LIMIT=0):
+            response = self.client.post(group_url, {'_export': True})
+
+        self.assertRedirects(response, group_url)
+        [email] = mail.outbox
+        self.assertEqual(email.attachments, [])
+        self.assertTrue(
+            'The CSV data for 1 contact(s) from group "%s" is too large to '
+            'attach' % (group.name,) in email.body)
+        self.assertFalse('Please find' in email.body)
+        self.assertTrue('expire after 7 day(s)' in email.body)
+        [download_url] = [line for line in email.body.split('\n')
+                          if line.startswith('http://')]
+        download_path = download_url[download_url.index('/', 7):]
+
+        response = self.client.get(download_path)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        zipfile = ZipFile(StringIO(response.content), 'r')
+        csv_contents = zipfile.open('contacts-export.csv', 'r').read()
+        [_header, csv_contact, _] = csv_contents.split('\r\n')
+        self.assertTrue(csv_contact.startswith(contact.key))
+
+        export_id = download_path.rstrip('/').rsplit('/', 1)[-1]
+        default_storage.delete(ContactExport.storage_path(
+            self.user_helper.user_api.user_account_key, export_id))
+
+    def test_export_download_missing(self):
+        response = self.client.get(reverse('contacts:export_download', kwargs={
+            'export_id': 'missing',
+        }))
+        self.assertEqual(response.status_code, 404)
+
     def test_multiple_group_exportation(self):
         group_1 = self.contact_store.new_group(u'Test Group 1')
         contact_1 = self.mkcontact(groups=[group_1])
@@ -1,5 +1,7 @@
 from django.conf.urls import patterns, url
+from go.base import views as base_views
 from go.contacts import views
+from go.contacts.exporter import ContactExport
 
 urlpatterns = patterns('',
     url(r'^$', views.index, name='index'),
@@ -10,4 +12,6 @@ urlpatterns = patterns('',
     url(r'^people/$', views.people, name='people'),
     url(r'^people/new/$', views.new_person, name='new_person'),
     url(r'^people/(?P<person_key>\w+)/$', views.person, name='person'),
+    url(r'^exports/(?P<export_id>\w+)/$', base_views.export_download,
+        kwargs={'export_class': ContactExport}, name='export_download'),
 )
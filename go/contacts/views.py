@@ -1,4 +1,5 @@
 import re
+import string
 
 from urllib import urlencode
 
@@ -166,6 +167,8 @@ def _static_group(request, contact_store, group):
                 contact = contact_store.get_contact_by_key(person_key)
                 contact.groups.remove(group)
                 contact.save()
+                contact_store.update_group_membership(
+                    contact.key, removed_group_keys=[group.key])
             messages.info(
                 request,
                 '%d Contacts removed from group' % len(contacts))
@@ -349,7 +352,7 @@ def _people(request):
             contacts = request.POST.getlist('contact')
             for person_key in contacts:
                 contact = contact_store.get_contact_by_key(person_key)
-                contact.delete()
+                contact_store.delete_contact(contact)
             messages.info(request, '%d Contacts deleted' % len(contacts))
         elif '_export' in request.POST:
             tasks.export_contacts.delay(
@@ -404,22 +407,43 @@ def _people(request):
     #       the duplication.
     user_query = request.GET.get('q', '')
     query = user_query
-    if query:
-        if not ':' in query:
-            query = 'name:%s' % (query,)
-
-        keys = contact_store.contacts.raw_search(query).get_keys()
+    letter = request.GET.get('letter', '')
+    next_cursor = None
+    if letter:
+        # Surname filtering pages through the surname initial index so that
+        # we never load more than a page of matching keys.
+        limit = int(request.GET.get('limit', 100))
+        page = contact_store.surname_initial_keys_page(
+            letter, max_results=limit,
+            continuation=request.GET.get('cursor') or None)
+        keys = list(page)
+        if page.has_next_page():
+            next_cursor = page.continuation
+        messages.info(
+            request, "Showing %s contact(s) with surnames starting with '%s'"
+            % (len(keys), letter.upper()))
     else:
-        keys = contact_store.list_contacts()
+        if query:
+            if ':' not in query:
+                query = 'name:%s' % (query,)
 
-    limit = min(int(request.GET.get('limit', 100)), len(keys))
-    messages.info(request, "Showing %s of %s contact(s)" % (limit, len(keys)))
+            keys = contact_store.contacts.raw_search(query).get_keys()
+        else:
+            keys = contact_store.list_contacts()
+
+        limit = min(int(request.GET.get('limit', 100)), len(keys))
+        messages.info(
+            request, "Showing %s of %s contact(s)" % (limit, len(keys)))
+        keys = keys[:limit]
 
     smart_group_form = SmartGroupForm(initial={'query': query})
-    contacts = utils.contacts_by_key(contact_store, *keys[:limit])
+    contacts = utils.contacts_by_key(contact_store, *keys)
 
     return render(request, 'contacts/contact_list.html', {
         'query': user_query,
+        'letter': letter,
+        'letters': string.ascii_lowercase,
+        'next_cursor': next_cursor,
         'selected_contacts': contacts,
         'smart_group_form': smart_group_form,
         'upload_contacts_form': upload_contacts_form or UploadContactsForm(),
@@ -437,12 +461,13 @@ def person(request, person_key):
     groups = contact_store.list_groups()
     if request.method == 'POST':
         if '_delete' in request.POST:
-            contact.delete()
+            contact_store.delete_contact(contact)
             messages.info(request, 'Contact deleted')
             return redirect(reverse('contacts:people'))
         else:
             form = ContactForm(request.POST, groups=groups)
             if form.is_valid():
+                old_group_keys = set(contact.groups.keys())
                 for k, v in form.cleaned_data.items():
                     if k == 'groups':
                         contact.groups.clear()
@@ -451,6 +476,11 @@ def person(request, person_key):
                         continue
                     setattr(contact, k, v)
                 contact.save()
+                new_group_keys = set(contact.groups.keys())
+                contact_store.update_group_membership(
+                    contact.key,
+                    added_group_keys=new_group_keys - old_group_keys,
+                    removed_group_keys=old_group_keys - new_group_keys)
                 messages.add_message(request, messages.INFO, 'Profile Updated')
                 return redirect(reverse('contacts:person', kwargs={
                     'person_key': contact.key}))
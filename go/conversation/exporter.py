@@ -0,0 +1,213 @@
+"""Streaming conversation message exports."""
+
+import json
+from tempfile import NamedTemporaryFile
+
+from go.base.exports import StoredExport
+from go.base.utils import UnicodeDictWriter
+
+
+# The field names to export
+conversation_export_field_names = [
+    'timestamp',
+    'from_addr',
+    'to_addr',
+    'content',
+    'message_id',
+    'in_reply_to',
+    'session_event',
+    'transport_type',
+    'direction',
+    'network_handover_status',
+    'network_handover_reason',
+    'delivery_status',
+    'endpoint',
+]
+
+
+def get_delivery_status(delivery_reports):
+    if not delivery_reports:
+        return 'Unknown'
+    return delivery_reports[0]['delivery_status']
+
+
+def get_network_status(acks_or_nacks):
+    if not acks_or_nacks:
+        return 'Unknown', ''
+    event = acks_or_nacks[0]
+    return event['event_type'], event.get('nack_reason', '')
+
+
+def row_for_inbound_message(message):
+    row = dict((field, unicode(message.payload[field]))
+               for field in conversation_export_field_names
+               if field in message)
+    row['direction'] = 'inbound'
+    row['endpoint'] = message.get_routing_endpoint()
+    return row
+
+
+def row_for_outbound_message_with_events(message, events):
+    events = sorted(events, key=lambda event: event['timestamp'],
+                    reverse=True)
+    row = dict((field, unicode(message.payload[field]))
+               for field in conversation_export_field_names
+               if field in message)
+    row['direction'] = 'outbound'
+    delivery_reports = [event for event in events
+                        if event['event_type'] == 'delivery_report']
+    row['delivery_status'] = get_delivery_status(delivery_reports)
+    network_events = [event for event in events
+                      if event['event_type'] in ['ack', 'nack']]
+    status, reason = get_network_status(network_events)
+    row['network_handover_status'] = status
+    row['network_handover_reason'] = reason
+    row['endpoint'] = message.get_routing_endpoint()
+    return row
+
+
+def row_for_outbound_message(message, mdb):
+    return row_for_outbound_message_with_events(
+        message, mdb.get_events_for_message(message['message_id']))
+
+
+def load_events_for_messages(mdb, message_ids):
+    """
+    Return a dict mapping each of `message_ids` to a list of its events.
+
+    Events are only indexed by message, so this still does an index query
+    for each message, but the events for all the messages are then loaded
+    a bunch at a time rather than one at a time.
+    """
+    event_keys = []
+    for message_id in message_ids:
+        event_keys.extend(mdb.message_event_keys(message_id))
+
+    events = dict((message_id, []) for message_id in message_ids)
+    for bunch in mdb.events.load_all_bunches(event_keys):
+        for event in bunch:
+            events[event.message.key].append(event.event)
+    return events
+
+
+def load_messages_in_chunks(conversation, direction='inbound',
+                            include_sensitive=False, scrubber=None):
+    """
+    Load the conversation's messages in chunks of `size`.
+    Uses `proxy.load_all_bunches()` lower down but allows skipping and/or
+    scrubbing of messages depending on `include_sensitive` and `scrubber`.
+
+    :param Conversation conv:
+        The conversation.
+    :param str direction:
+        The direction, either ``'inbound'`` or ``'outbound'``.
+    :param bool include_sensitive:
+        If ``False`` then all messages marked as `sensitive` are skipped.
+        Defaults to ``False``.
+    :param callable scrubber:
+        If provided, this is called for every message allowing it to be
+        modified on the fly.
+    """
+    if direction == 'inbound':
+        bunches = conversation.mdb.inbound_messages.load_all_bunches(
+            conversation.inbound_keys())
+    elif direction == 'outbound':
+        bunches = conversation.mdb.outbound_messages.load_all_bunches(
+            conversation.outbound_keys())
+    else:
+        raise ValueError('Invalid value (%s) received for `direction`. '
+                         'Only `inbound` and `outbound` are allowed.' %
+                         (direction,))
+
+    for messages in bunches:
+        yield conversation.filter_and_scrub_messages(
+            messages, include_sensitive=include_sensitive, scrubber=scrubber)
+
+
+def iter_message_rows(conversation):
+    """
+    Yield an export row for each of the conversation's messages.
+
+    Inbound messages come first, followed by outbound messages. Each bunch
+    of messages is sorted by timestamp before it is written, so memory use
+    is bounded by the bunch size rather than the size of the conversation.
+    """
+    def by_timestamp(message):
+        return message['timestamp']
+
+    for messages in load_messages_in_chunks(conversation, 'inbound'):
+        for message in sorted(messages, key=by_timestamp):
+            yield row_for_inbound_message(message)
+
+    mdb = conversation.mdb
+    for messages in load_messages_in_chunks(conversation, 'outbound'):
+        events = load_events_for_messages(
+            mdb, [message['message_id'] for message in messages])
+        for message in sorted(messages, key=by_timestamp):
+            yield row_for_outbound_message_with_events(
+                message, events[message['message_id']])
+
+
+class CSVRowWriter(object):
+    extension = 'csv'
+
+    def __init__(self, fp):
+        self.writer = UnicodeDictWriter(fp, conversation_export_field_names)
+        self.writer.writeheader()
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+
+class JSONLinesRowWriter(object):
+    extension = 'jsonl'
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def writerow(self, row):
+        self.fp.write(json.dumps(row))
+        self.fp.write('\n')
+
+
+class MessageExport(StoredExport):
+    """
+    A zipped export of a conversation's messages spooled to a temporary
+    file.
+
+    :param ConversationWrapper conversation:
+        The conversation to export messages for. It must use synchronous
+        managers.
+    :param str export_format:
+        Either ``'csv'`` or ``'json'``. JSON exports have one JSON object
+        per line.
+    """
+
+    ROW_WRITERS = {
+        'csv': CSVRowWriter,
+        'json': JSONLinesRowWriter,
+    }
+    ZIP_NAME = 'messages-export.zip'
+    STORAGE_PATH = 'message-exports'
+
+    def __init__(self, conversation, export_format='csv'):
+        if export_format not in self.ROW_WRITERS:
+            raise ValueError('Invalid export format: %r' % (export_format,))
+        self.conversation = conversation
+        self.row_writer_class = self.ROW_WRITERS[export_format]
+        self.count = 0
+
+    @property
+    def file_name(self):
+        return 'messages-export.%s' % (self.row_writer_class.extension,)
+
+    def spool(self):
+        """Write the export to a temporary zip file."""
+        with NamedTemporaryFile(suffix='.' + self.file_name) as data_file:
+            writer = self.row_writer_class(data_file)
+            for row in iter_message_rows(self.conversation):
+                writer.writerow(row)
+                self.count += 1
+            data_file.flush()
+            self.zip_data_file(data_file.name, self.file_name)
+        return self
@@ -7,6 +7,7 @@ from zipfile import ZipFile
 
 from django import forms
 from django.core import mail
+from django.core.files.storage import default_storage
 from django.core.urlresolvers import reverse
 from django.utils.unittest import skip
 
@@ -17,7 +18,11 @@ from go.base.tests.helpers import GoDjangoTestCase, DjangoVumiApiHelper
 from go.conversation.templatetags import conversation_tags
 from go.conversation.view_definition import (
     ConversationViewDefinitionBase, EditConversationView)
-from go.conversation.tasks import export_conversation_messages_unsorted
+from go.conversation.exporter import (
+    MessageExport, load_events_for_messages)
+from go.conversation.tasks import (
+    export_conversation_messages_unsorted, export_conversation_messages,
+    delete_expired_message_exports)
 from go.vumitools.api import VumiApiCommand
 from go.vumitools.conversation.definition import (
     ConversationDefinitionBase, ConversationAction)
@@ -544,6 +549,17 @@ class TestConversationViews(BaseConversationViewTestCase):
             '',  # csv ends with a blank line
             ]))
 
+    def get_export_download(self, email):
+        [download_url] = [line for line in email.body.split('\n')
+                          if line.startswith('http://')]
+        download_path = download_url[download_url.index('/', 7):]
+        export_id = download_path.rstrip('/').rsplit('/', 1)[-1]
+        self.add_cleanup(default_storage.delete, MessageExport.storage_path(
+            self.user_helper.account_key, export_id))
+        response = self.client.get(download_path)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        return ZipFile(StringIO(response.content), 'r')
+
     def test_export_csv_messages(self):
         conv = self.user_helper.create_conversation(u'dummy', started=True)
         msgs = self.msg_helper.add_inbound_to_conv(
@@ -556,13 +572,39 @@ class TestConversationViews(BaseConversationViewTestCase):
             email.recipients(), [self.user_helper.get_django_user().email])
         self.assertTrue(conv.name in email.subject)
         self.assertTrue(conv.name in email.body)
-        [(file_name, zipcontent, mime_type)] = email.attachments
-        self.assertEqual(file_name, 'messages-export.zip')
-        zipfile = ZipFile(StringIO(zipcontent), 'r')
+        self.assertEqual(email.attachments, [])
+        zipfile = self.get_export_download(email)
         content = zipfile.open('messages-export.csv', 'r').read()
         # 1 header, 5 sent, 5 received, 1 trailing newline == 12
         self.assertEqual(12, len(content.split('\n')))
-        self.assertEqual(mime_type, 'application/zip')
+
+    def test_export_json_messages(self):
+        conv = self.user_helper.create_conversation(u'dummy', started=True)
+        msgs = self.msg_helper.add_inbound_to_conv(
+            conv, 5, start_date=date(2012, 1, 1), time_multiplier=12)
+        self.msg_helper.add_replies_to_conv(conv, msgs)
+        response = self.client.post(
+            self.get_view_url(conv, 'export_messages'), {'format': 'json'})
+        self.assertRedirects(response, self.get_view_url(conv, 'message_list'))
+        [email] = mail.outbox
+        zipfile = self.get_export_download(email)
+        lines = zipfile.open('messages-export.jsonl', 'r').read().splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual(
+            sorted(row['direction'] for row in rows),
+            ['inbound'] * 5 + ['outbound'] * 5)
+
+    def test_export_messages_invalid_format(self):
+        conv = self.user_helper.create_conversation(u'dummy', started=True)
+        response = self.client.post(
+            self.get_view_url(conv, 'export_messages'), {'format': 'xml'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(mail.outbox, [])
+
+    def test_export_download_missing(self):
+        response = self.client.get(reverse(
+            'conversations:export_download', kwargs={'export_id': 'missing'}))
+        self.assertEqual(response.status_code, 404)
 
     def test_download_json_messages_inbound(self):
         conv = self.user_helper.create_conversation(u'dummy', started=True)
@@ -1058,3 +1100,90 @@ class TestConversationTasks(GoDjangoTestCase):
         self.assertEqual(row1['endpoint'], 'bar')
         self.assertEqual(row2['direction'], 'outbound')
         self.assertEqual(row2['endpoint'], 'foo')
+
+    def test_export_conversation_messages(self):
+        conv = self.create_conversation()
+        export_conversation_messages(conv.user_account.key, conv.key)
+        [email] = mail.outbox
+        self.assertEqual(
+            email.recipients(), [self.user_helper.get_django_user().email])
+        self.assertTrue(conv.name in email.subject)
+        self.assertEqual(email.attachments, [])
+        self.assertTrue('expire after 7 day(s)' in email.body)
+        [download_url] = [line for line in email.body.split('\n')
+                          if line.startswith('http://')]
+        export_id = download_url.rstrip('/').rsplit('/', 1)[-1]
+        path = MessageExport.storage_path(conv.user_account.key, export_id)
+        self.add_cleanup(default_storage.delete, path)
+
+        zipfile = ZipFile(default_storage.open(path), 'r')
+        reader = csv.DictReader(zipfile.open('messages-export.csv', 'r'))
+        message_ids = [row['message_id'] for row in reader]
+        self.assertEqual(
+            sorted(message_ids),
+            sorted(conv.inbound_keys() + conv.outbound_keys()))
+
+    def test_delete_expired_message_exports(self):
+        conv = self.create_conversation()
+        export_conversation_messages(conv.user_account.key, conv.key)
+        [download_url] = [line for line in mail.outbox[0].body.split('\n')
+                          if line.startswith('http://')]
+        export_id = download_url.rstrip('/').rsplit('/', 1)[-1]
+        path = MessageExport.storage_path(conv.user_account.key, export_id)
+        self.add_cleanup(self.delete_if_exists, path)
+
+        with self.settings(EXPORT_EXPIRY_DAYS=0):
+            delete_expired_message_exports()
+        self.assertFalse(default_storage.exists(path))
+
+    def delete_if_exists(self, path):
+        if default_storage.exists(path):
+            default_storage.delete(path)
+
+    def test_message_export_sorted_within_bunches(self):
+        conv = self.create_conversation(reply_count=0)
+        self.msg_helper.add_inbound_to_conv(
+            conv, 5, start_date=date(2013, 1, 1), time_multiplier=12)
+
+        export = MessageExport(conv).spool()
+        self.add_cleanup(export.close)
+        zipfile = ZipFile(StringIO(export.read()), 'r')
+        reader = csv.DictReader(zipfile.open('messages-export.csv', 'r'))
+        timestamps = [row['timestamp'] for row in reader]
+        self.assertEqual(len(timestamps), 5)
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(export.count, 5)
+
+    def test_message_export_json(self):
+        conv = self.create_conversation(reply_count=0)
+        msg = self.msg_helper.make_stored_outbound(
+            conv, "outbound", to_addr='from-1')
+        self.msg_helper.make_stored_ack(msg=msg, conv=conv)
+
+        export = MessageExport(conv, 'json').spool()
+        self.add_cleanup(export.close)
+        zipfile = ZipFile(StringIO(export.read()), 'r')
+        [line] = zipfile.open('messages-export.jsonl', 'r').read().splitlines()
+        row = json.loads(line)
+        self.assertEqual(row['message_id'], msg['message_id'])
+        self.assertEqual(row['network_handover_status'], 'ack')
+
+    def test_message_export_invalid_format(self):
+        conv = self.create_conversation(reply_count=0)
+        self.assertRaises(ValueError, MessageExport, conv, 'xml')
+
+    def test_load_events_for_messages(self):
+        conv = self.create_conversation(reply_count=0)
+        msg1 = self.msg_helper.make_stored_outbound(
+            conv, "outbound", to_addr='from-1')
+        msg2 = self.msg_helper.make_stored_outbound(
+            conv, "outbound", to_addr='from-2')
+        ack = self.msg_helper.make_stored_ack(msg=msg1, conv=conv)
+        dr = self.msg_helper.make_stored_delivery_report(msg=msg1, conv=conv)
+
+        events = load_events_for_messages(
+            conv.mdb, [msg1['message_id'], msg2['message_id']])
+        self.assertEqual(
+            sorted(e['event_id'] for e in events[msg1['message_id']]),
+            sorted([ack['event_id'], dr['event_id']]))
+        self.assertEqual(events[msg2['message_id']], [])
@@ -1,10 +1,14 @@
 from django.conf.urls import patterns, url
+from go.base import views as base_views
 from go.conversation import views
+from go.conversation.exporter import MessageExport
 
 urlpatterns = patterns(
     '',
     url(r'^$', views.index, name='index'),
     url(r'^new/$', views.new_conversation, name='new_conversation'),
+    url(r'^exports/(?P<export_id>\w+)/$', base_views.export_download,
+        kwargs={'export_class': MessageExport}, name='export_download'),
     url(r'^(?P<conversation_key>\w+)/action/(?P<action_name>.*)$',
         views.conversation_action, name='conversation_action'),
     # TODO: Move the following to definition-based views.
@@ -22,7 +22,7 @@ from go.vumitools.exceptions import ConversationSendError
 from go.token.django_token_manager import DjangoTokenManager
 from go.conversation.forms import (ConfirmConversationForm, ReplyToMessageForm,
                                    ConversationDetailForm)
-from go.conversation.tasks import export_conversation_messages_unsorted
+from go.conversation.tasks import export_conversation_messages
 from go.conversation.utils import PagedMessageCache
 from go.dashboard.dashboard import Dashboard, ConversationReportsLayout
 
@@ -209,11 +209,16 @@ class ExportMessageView(ConversationApiView):
             conversation.key, direction))
 
     def post(self, request, conversation):
-        export_conversation_messages_unsorted.delay(
-            request.user_api.user_account_key, conversation.key)
-        messages.info(request, 'Conversation messages CSV file export '
-                                'scheduled. CSV file should arrive in '
-                                'your mailbox shortly.')
+        export_format = request.POST.get('format', 'csv')
+        if export_format not in ['csv', 'json']:
+            raise Http404()
+
+        export_conversation_messages.delay(
+            request.user_api.user_account_key, conversation.key,
+            export_format)
+        messages.info(request, 'Conversation messages export scheduled. '
+                               'A link to download it should arrive in '
+                               'your mailbox shortly.')
         return self.redirect_to(
             'message_list', conversation_key=conversation.key)
 
@@ -468,6 +473,7 @@ class EditConversationView(ConversationTemplateView):
         conversation.c.extra_endpoints = self.view_def.get_endpoints(config)
 
         conversation.save()
+        conversation.notify_config_changed()
 
 
 def check_action_is_enabled(f):
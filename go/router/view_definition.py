@@ -193,6 +193,9 @@ class EditRouterView(RouterTemplateView):
             config)
         router.config = config
         router.save()
+        router_api = request.user_api.get_router_api(
+            router.router_type, router.key)
+        router_api.notify_config_changed()
 
 
 class RouterViewDefinitionBase(object):
@@ -97,3 +97,31 @@ class TestGroupRouter(VumiTestCase):
                 for group in groups
             ]})
         yield self.assert_routed_inbound(contact.msisdn, router, 'group2_ep')
+
+    @inlineCallbacks
+    def test_inbound_contact_groups_cached(self):
+        """
+        The contact's groups are cached, but changes made through the contact
+        store are picked up.
+        """
+        group = yield self.router_helper.create_group(u"group")
+        contact = yield self.router_helper.create_contact(
+            u"+27831234567", groups=[group])
+        router = yield self.router_helper.create_router(started=True, config={
+            'rules': [
+                {'group': group.key, 'endpoint': 'group_ep'},
+            ]})
+        yield self.assert_routed_inbound(contact.msisdn, router, 'group_ep')
+
+        user_helper = yield self.router_helper.vumi_helper.get_or_create_user()
+        contact_store = user_helper.user_api.contact_store
+        self.assertEqual(
+            (yield contact_store.membership.get_addr_groups(
+                user_helper.account_key, 'msisdn', contact.msisdn)),
+            [group.key])
+
+        contact.groups.remove(group)
+        yield contact.save()
+        yield contact_store.update_group_membership(
+            contact.key, removed_group_keys=[group.key])
+        yield self.assert_routed_inbound(contact.msisdn, router, 'default')
@@ -1,12 +1,12 @@
 # -*- test-case-name: go.routers.group.tests.test_vumi_app -*-
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi import log
 from vumi.config import ConfigList
 
 from go.vumitools.app_worker import GoRouterWorker
-from go.vumitools.contact import ContactError, ContactNotFoundError
+from go.vumitools.contact import ContactError
 
 
 class GroupRouterConfig(GoRouterWorker.CONFIG_CLASS):
@@ -26,25 +26,44 @@ class GroupRouter(GoRouterWorker):
     def endpoint_for_contact(self, config, contact):
         if contact is None:
             return 'default'
-        contact_groups = set(contact.groups.keys())
+        return self.endpoint_for_groups(config, contact.groups.keys())
+
+    def endpoint_for_groups(self, config, group_keys):
+        contact_groups = set(group_keys)
         for rule in config.rules:
             if rule['group'] in contact_groups:
                 return rule['endpoint']
         return 'default'
 
+    @inlineCallbacks
+    def get_group_keys_for_message(self, msg):
+        """
+        Return the keys of the groups the message's contact belongs to.
+
+        The contact store caches these by address, so we only need to load
+        the contact from Riak if its groups aren't cached.
+        """
+        msg_mdh = self.get_metadata_helper(msg)
+        if not msg_mdh.has_user_account():
+            # If we have no user account we can't look up contacts.
+            returnValue([])
+        user_api = msg_mdh.get_user_api()
+        delivery_class = user_api.delivery_class_for_msg(msg)
+        group_keys = yield user_api.contact_store.group_keys_for_addr(
+            delivery_class, msg.user())
+        returnValue(group_keys)
+
     @inlineCallbacks
     def handle_inbound(self, config, msg, conn_name):
         log.msg("Handling inbound: %s" % (msg,))
 
         try:
-            contact = yield self.get_contact_for_message(msg, create=False)
-        except ContactNotFoundError:
-            contact = None
+            group_keys = yield self.get_group_keys_for_message(msg)
         except ContactError:
             log.err()
             return
 
-        endpoint = self.endpoint_for_contact(config, contact)
+        endpoint = self.endpoint_for_groups(config, group_keys)
         yield self.publish_inbound(msg, endpoint)
 
     def handle_outbound(self, config, msg, conn_name):
@@ -0,0 +1,40 @@
+"""Compare keyword lookups with and without :class:`KeywordMatcher`.
+
+Run with ``python -m go.routers.keyword.benchmark``.
+"""
+
+import timeit
+
+from go.routers.keyword.matcher import KeywordMatcher
+
+
+def linear_lookup(mapping, word):
+    for keyword, target in mapping.iteritems():
+        if keyword.lower() == word.lower():
+            return target
+    return None
+
+
+def mk_mapping(size):
+    return dict((u'keyword%d' % (i,), u'endpoint%d' % (i,))
+                for i in range(size))
+
+
+def main(sizes=(10, 100, 1000), number=10000):
+    print "%8s %14s %14s" % ("keywords", "linear (us)", "matcher (us)")
+    for size in sizes:
+        mapping = mk_mapping(size)
+        matcher = KeywordMatcher(mapping)
+        # The worst case for the linear scan is a word that doesn't match.
+        words = [u'KEYWORD%d' % (size - 1,), u'unknown']
+        linear = timeit.timeit(
+            lambda: [linear_lookup(mapping, w) for w in words],
+            number=number)
+        compiled = timeit.timeit(
+            lambda: [matcher.lookup(w) for w in words], number=number)
+        scale = 1e6 / (number * len(words))
+        print "%8d %14.2f %14.2f" % (size, linear * scale, compiled * scale)
+
+
+if __name__ == '__main__':
+    main()
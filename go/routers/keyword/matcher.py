@@ -0,0 +1,108 @@
+# -*- test-case-name: go.routers.keyword.tests.test_matcher -*-
+# -*- coding: utf-8 -*-
+
+"""Matching of message keywords to router endpoints."""
+
+import re
+
+
+# Keywords containing any of these are treated as regexes.
+REGEX_CHARS = frozenset('.^$*+?{}[]\\|()')
+# Numbered backreferences would refer to the wrong group once a pattern is
+# combined with others.
+BACKREFERENCE = re.compile(r'\\[1-9]')
+
+
+def is_pattern(keyword):
+    return any(c in REGEX_CHARS for c in keyword)
+
+
+class KeywordMatcher(object):
+    """Looks up the endpoint for the first word of a message.
+
+    Plain keywords are matched case-insensitively with a single dict lookup.
+    Keywords containing regex syntax are treated as case-insensitive regexes
+    that must match the whole word. They're compiled into a few combined
+    regexes so that a word is checked against many patterns in one go.
+    Plain keywords take precedence over patterns and patterns are tried in
+    sorted order. Keywords that aren't valid regexes are matched as plain
+    keywords.
+
+    :param dict keyword_endpoint_mapping:
+        Mapping from keyword to endpoint name.
+    """
+
+    # Python's re module supports at most 100 groups per regex.
+    PATTERNS_PER_REGEX = 50
+    FLAGS = re.IGNORECASE | re.UNICODE
+
+    def __init__(self, keyword_endpoint_mapping):
+        self.literals = {}
+        self.regexes = []
+        patterns = []
+        for keyword, endpoint in sorted(keyword_endpoint_mapping.items()):
+            if not (is_pattern(keyword) and self._is_valid_regex(keyword)):
+                self.literals.setdefault(keyword.lower(), endpoint)
+            elif BACKREFERENCE.search(keyword):
+                self._flush_patterns(patterns)
+                self.regexes.append(self._compile_single(keyword, endpoint))
+            else:
+                patterns.append((keyword, endpoint))
+        self._flush_patterns(patterns)
+
+    def _flush_patterns(self, patterns):
+        # Patterns are kept in order across regexes so that the first one
+        # (in sorted order) to match wins.
+        for i in range(0, len(patterns), self.PATTERNS_PER_REGEX):
+            self.regexes.extend(
+                self._compile(patterns[i:i + self.PATTERNS_PER_REGEX]))
+        del patterns[:]
+
+    def _is_valid_regex(self, keyword):
+        try:
+            re.compile(keyword, self.FLAGS)
+        except (re.error, AssertionError):
+            return False
+        return True
+
+    def _compile_single(self, keyword, endpoint):
+        regex = re.compile('(?:%s)\\Z' % (keyword,), self.FLAGS)
+        return (regex, {None: endpoint})
+
+    def _compile(self, patterns):
+        """Return a list of ``(regex, endpoints)`` pairs for `patterns`.
+
+        Each pattern is wrapped in a named group so that we can tell which
+        one matched.
+        """
+        if len(patterns) == 1:
+            return [self._compile_single(*patterns[0])]
+        endpoints = {}
+        alternatives = []
+        for i, (keyword, endpoint) in enumerate(patterns):
+            group = 'k%d' % (i,)
+            endpoints[group] = endpoint
+            alternatives.append('(?P<%s>%s)' % (group, keyword))
+        try:
+            regex = re.compile(
+                '(?:%s)\\Z' % ('|'.join(alternatives),), self.FLAGS)
+        except (re.error, AssertionError):
+            # Patterns with too many groups of their own can't be combined.
+            return [self._compile_single(keyword, endpoint)
+                    for keyword, endpoint in patterns]
+        return [(regex, endpoints)]
+
+    def lookup(self, word):
+        """Return the endpoint for `word` or ``None`` if nothing matches."""
+        endpoint = self.literals.get(word.lower())
+        if endpoint is not None:
+            return endpoint
+        for regex, endpoints in self.regexes:
+            match = regex.match(word)
+            if match is not None:
+                if None in endpoints:
+                    return endpoints[None]
+                # The keyword's group ends after any groups inside it, so
+                # it's the last one to match.
+                return endpoints[match.lastgroup]
+        return None
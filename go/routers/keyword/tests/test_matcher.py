@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+from vumi.tests.helpers import VumiTestCase
+
+from go.routers.keyword.matcher import KeywordMatcher, is_pattern
+
+
+class TestIsPattern(VumiTestCase):
+    def test_is_pattern(self):
+        self.assertFalse(is_pattern(u'foo'))
+        self.assertFalse(is_pattern(u'abc-123'))
+        self.assertTrue(is_pattern(u'foo.*'))
+        self.assertTrue(is_pattern(u'(foo|bar)'))
+
+
+class TestKeywordMatcher(VumiTestCase):
+    def test_empty(self):
+        matcher = KeywordMatcher({})
+        self.assertEqual(matcher.lookup(u'foo'), None)
+        self.assertEqual(matcher.lookup(u''), None)
+
+    def test_literals(self):
+        matcher = KeywordMatcher({u'foo': u'app1', u'AbC123': u'app2'})
+        self.assertEqual(matcher.lookup(u'foo'), u'app1')
+        self.assertEqual(matcher.lookup(u'FOO'), u'app1')
+        self.assertEqual(matcher.lookup(u'abc123'), u'app2')
+        self.assertEqual(matcher.lookup(u'food'), None)
+        self.assertEqual(matcher.regexes, [])
+
+    def test_unicode_literals(self):
+        matcher = KeywordMatcher({u'ÉCOLE': u'app1'})
+        self.assertEqual(matcher.lookup(u'école'), u'app1')
+
+    def test_patterns(self):
+        matcher = KeywordMatcher({
+            u'fo+': u'app1',
+            u'(bar|baz)[0-9]*': u'app2',
+        })
+        self.assertEqual(matcher.lookup(u'foooo'), u'app1')
+        self.assertEqual(matcher.lookup(u'FOO'), u'app1')
+        self.assertEqual(matcher.lookup(u'baz42'), u'app2')
+        # Patterns must match the whole word.
+        self.assertEqual(matcher.lookup(u'food'), None)
+        self.assertEqual(matcher.lookup(u'xfoo'), None)
+        self.assertEqual(len(matcher.regexes), 1)
+
+    def test_literals_before_patterns(self):
+        matcher = KeywordMatcher({u'foo': u'app1', u'f.*': u'app2'})
+        self.assertEqual(matcher.lookup(u'foo'), u'app1')
+        self.assertEqual(matcher.lookup(u'fab'), u'app2')
+
+    def test_patterns_in_sorted_order(self):
+        matcher = KeywordMatcher({u'b.*': u'app2', u'a?b.*': u'app1'})
+        self.assertEqual(matcher.lookup(u'bar'), u'app1')
+
+    def test_invalid_pattern_is_literal(self):
+        matcher = KeywordMatcher({u'c++': u'app1'})
+        self.assertEqual(matcher.lookup(u'C++'), u'app1')
+        self.assertEqual(matcher.lookup(u'c'), None)
+
+    def test_backreference(self):
+        matcher = KeywordMatcher({
+            u'(a)\\1': u'app1',
+            u'b+': u'app2',
+            u'c+': u'app3',
+        })
+        self.assertEqual(matcher.lookup(u'aa'), u'app1')
+        self.assertEqual(matcher.lookup(u'a'), None)
+        self.assertEqual(matcher.lookup(u'bb'), u'app2')
+        self.assertEqual(matcher.lookup(u'cc'), u'app3')
+
+    def test_many_patterns(self):
+        mapping = dict((u'kw%03d[0-9]' % (i,), u'app%d' % (i,))
+                       for i in range(250))
+        matcher = KeywordMatcher(mapping)
+        self.assertEqual(len(matcher.regexes), 5)
+        self.assertEqual(matcher.lookup(u'kw0007'), u'app0')
+        self.assertEqual(matcher.lookup(u'KW1233'), u'app123')
+        self.assertEqual(matcher.lookup(u'kw2499'), u'app249')
+        self.assertEqual(matcher.lookup(u'kw250'), None)
+
+    def test_patterns_with_groups(self):
+        mapping = dict((u'(x)(y)?kw%03d' % (i,), u'app%d' % (i,))
+                       for i in range(60))
+        matcher = KeywordMatcher(mapping)
+        self.assertEqual(matcher.lookup(u'xkw010'), u'app10')
+        self.assertEqual(matcher.lookup(u'xykw059'), u'app59')
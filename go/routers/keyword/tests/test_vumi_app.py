@@ -108,6 +108,18 @@ class TestKeywordRouter(VumiTestCase):
         yield self.assert_routed_inbound(" FoO bar", router, 'app1')
         yield self.assert_routed_inbound(" aBc123 baz", router, 'app2')
 
+    @inlineCallbacks
+    def test_inbound_keyword_regex(self):
+        router = yield self.router_helper.create_router(started=True, config={
+            'keyword_endpoint_mapping': {
+                'foo': 'app1',
+                'fo+': 'app2',
+            },
+        })
+        yield self.assert_routed_inbound("foo bar", router, 'app1')
+        yield self.assert_routed_inbound("FOOO bar", router, 'app2')
+        yield self.assert_routed_inbound("food bar", router, 'default')
+
     @inlineCallbacks
     def test_outbound_no_config(self):
         router = yield self.router_helper.create_router(started=True)
@@ -1,15 +1,20 @@
 # -*- test-case-name: go.routers.keyword.tests.test_vumi_app -*-
 # -*- coding: utf-8 -*-
 
+from weakref import WeakKeyDictionary
+
 from vumi import log
 from vumi.config import ConfigDict
 
+from go.routers.keyword.matcher import KeywordMatcher
 from go.vumitools.app_worker import GoRouterWorker
 
 
 class KeywordRouterConfig(GoRouterWorker.CONFIG_CLASS):
     keyword_endpoint_mapping = ConfigDict(
-        "Mapping from case-insensitive keyword regex to endpoint name.",
+        "Mapping from case-insensitive keyword to endpoint name. Keywords "
+        "containing regex syntax are matched as regexes against the whole "
+        "first word of the message.",
         default={})
 
 
@@ -21,12 +26,23 @@ class KeywordRouter(GoRouterWorker):
 
     worker_name = 'keyword_router'
 
+    def setup_router(self):
+        # Router configs are cached between messages, so we compile each
+        # one's keywords once and drop the matcher along with the config.
+        self.keyword_matchers = WeakKeyDictionary()
+        return super(KeywordRouter, self).setup_router()
+
+    def get_keyword_matcher(self, config):
+        matcher = self.keyword_matchers.get(config)
+        if matcher is None:
+            matcher = KeywordMatcher(config.keyword_endpoint_mapping)
+            self.keyword_matchers[config] = matcher
+        return matcher
+
     def lookup_target(self, config, msg):
         first_word = ((msg['content'] or '').strip().split() + [''])[0]
-        for keyword, target in config.keyword_endpoint_mapping.iteritems():
-            if keyword.lower() == first_word.lower():
-                return target
-        return 'default'
+        target = self.get_keyword_matcher(config).lookup(first_word)
+        return target or 'default'
 
     def handle_inbound(self, config, msg, conn_name):
         log.debug("Handling inbound: %s" % (msg,))
@@ -290,6 +290,12 @@ GO_BILLING_API_URL = 'http://localhost:9090/'
 
 DIAMONDASH_API_URL = 'http://localhost:7115/api/'
 
+# Contact exports larger than this many bytes (zipped) are stored for
+# download instead of being attached to the notification email.
+CONTACT_EXPORT_ATTACHMENT_LIMIT = 5 * 1024 * 1024
+# Exports stored for download are deleted after this many days.
+EXPORT_EXPIRY_DAYS = 7
+
 from celery.schedules import crontab
 CELERYBEAT_SCHEDULE = {
     'send-weekly-account-summary': {
@@ -302,6 +308,14 @@ CELERYBEAT_SCHEDULE = {
         'schedule': crontab(hour=0, minute=0),
         'args': ('daily',)
     },
+    'delete-expired-contact-exports': {
+        'task': 'go.contacts.tasks.delete_expired_contact_exports',
+        'schedule': crontab(hour=1, minute=0),
+    },
+    'delete-expired-message-exports': {
+        'task': 'go.conversation.tasks.delete_expired_message_exports',
+        'schedule': crontab(hour=1, minute=15),
+    },
 #    'generate-monthly-account-statements': {
 #        'task': 'go.billing.tasks.generate_monthly_account_statements',
 #        'schedule': crontab(day_of_month=1),
@@ -24,9 +24,11 @@ from go.config import (
     configured_conversations,
     configured_routers)
 from go.vumitools.account import AccountStore
+from go.vumitools.cache import RoutingTableVersionStore
 from go.vumitools.channel import ChannelStore
-from go.vumitools.contact import ContactStore
-from go.vumitools.conversation import ConversationStore
+from go.vumitools.contact import ContactStore, GroupMembershipStore
+from go.vumitools.conversation import (
+    ConversationStore, RunningConversationRegistry)
 from go.vumitools.opt_out import OptOutStore
 from go.vumitools.router import RouterStore
 from go.vumitools.conversation.utils import ConversationWrapper
@@ -93,7 +95,8 @@ class VumiUserApi(object):
         self.conversation_store = ConversationStore(self.api.manager,
                                                     self.user_account_key)
         self.contact_store = ContactStore(self.api.manager,
-                                          self.user_account_key)
+                                          self.user_account_key,
+                                          membership=self.api.group_membership)
         self.router_store = RouterStore(self.api.manager,
                                         self.user_account_key)
         self.channel_store = ChannelStore(self.api.manager,
@@ -297,6 +300,16 @@ class VumiUserApi(object):
                 "Routing table missing for account: %s" % (user_account.key,))
         returnValue(user_account.routing_table)
 
+    @Manager.calls_manager
+    def save_routing_table(self, user_account):
+        """Save an account after its routing table has been modified.
+
+        This also bumps the account's routing table version so that cached
+        copies of the old routing table are discarded.
+        """
+        yield user_account.save()
+        yield self.api.routing_table_versions.bump_version(user_account.key)
+
     @Manager.calls_manager
     def validate_routing_table(self, user_account=None):
         """Check that the routing table on this account is valid.
@@ -423,7 +436,7 @@ class VumiUserApi(object):
             routing_table = yield self.get_routing_table(user_account)
             routing_table.remove_transport_tag(tag)
 
-            yield user_account.save()
+            yield self.save_routing_table(user_account)
         yield self.api.tpm.release_tag(tag)
 
     def delivery_class_for_msg(self, msg):
@@ -468,7 +481,7 @@ class VumiRouterApi(object):
         user_account = yield self.user_api.get_user_account()
         routing_table = yield self.user_api.get_routing_table(user_account)
         routing_table.remove_router(router)
-        yield user_account.save()
+        yield self.user_api.save_routing_table(user_account)
 
     @Manager.calls_manager
     def start_router(self, router=None):
@@ -496,6 +509,12 @@ class VumiRouterApi(object):
         yield router.save()
         yield self.dispatch_router_command('stop')
 
+    def notify_config_changed(self):
+        """Tell this router's worker that its config has changed so that it
+        discards any cached copy.
+        """
+        return self.dispatch_router_command('config_changed')
+
     def dispatch_router_command(self, command, *args, **kwargs):
         """Send a command to this router's worker.
 
@@ -527,6 +546,12 @@ class VumiApi(object):
                                 self.redis.sub_manager('token_manager'))
         self.session_manager = SessionManager(
             self.redis.sub_manager('session_manager'))
+        self.routing_table_versions = RoutingTableVersionStore(
+            self.redis.sub_manager('routing_table_versions'))
+        self.group_membership = GroupMembershipStore(
+            self.redis.sub_manager('contact_group_membership'))
+        self.running_conversations = RunningConversationRegistry(
+            self.redis.sub_manager('running_conversations'))
         self.mapi = sender
         self.metric_publisher = metric_publisher
 
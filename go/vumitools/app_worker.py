@@ -1,3 +1,6 @@
+import time
+from collections import defaultdict
+
 from zope.interface import implements
 from twisted.internet.defer import (
     inlineCallbacks, returnValue, maybeDeferred, gatherResults)
@@ -6,10 +9,13 @@ from vumi import log
 from vumi.worker import BaseWorker
 from vumi.application import ApplicationWorker
 from vumi.blinkenlights.metrics import MetricPublisher, Metric
-from vumi.config import IConfigData, ConfigText, ConfigDict, ConfigField
+from vumi.blinkenlights.message20110818 import MetricMessage
+from vumi.config import (
+    IConfigData, ConfigText, ConfigDict, ConfigField, ConfigInt, ConfigFloat)
 from vumi.connectors import IgnoreMessage
 
 from go.config import get_conversation_definition
+from go.vumitools.cache import LRUCache
 from go.vumitools.api import (
     VumiApiCommand, VumiApi, VumiApiEvent, ApiCommandPublisher,
     ApiEventPublisher)
@@ -101,8 +107,12 @@ class GoWorkerMixin(object):
         yield self._go_setup_command_publisher(config)
         yield self._go_setup_event_publisher(config)
         yield self._go_setup_vumi_api(config)
+        self._go_setup_caches(config)
         yield self._go_setup_command_consumer(config)
 
+    def _go_setup_caches(self, config):
+        pass
+
     @inlineCallbacks
     def _go_teardown_worker(self):
         # Sometimes something else closes our Redis connection.
@@ -146,6 +156,29 @@ class GoWorkerMixin(object):
         yield self.collect_metrics(user_api, conversation_key)
         self._metrics_conversations.remove(key_tuple)
 
+    @inlineCallbacks
+    def process_command_collect_metrics_batch(self, conversations):
+        """Collect metrics for many conversations at once.
+
+        :param list conversations:
+            ``[user_account_key, conversation_key]`` pairs.
+        """
+        key_tuples = []
+        for user_account_key, conversation_key in conversations:
+            key_tuple = (conversation_key, user_account_key)
+            if key_tuple in self._metrics_conversations:
+                log.info("Ignoring conversation %s for user %s because the "
+                         "previous collection run is still going." % (
+                             conversation_key, user_account_key))
+                continue
+            self._metrics_conversations.add(key_tuple)
+            key_tuples.append(key_tuple)
+        try:
+            yield self.publish_conversation_metrics_batch(
+                [(acc_key, conv_key) for conv_key, acc_key in key_tuples])
+        finally:
+            self._metrics_conversations.difference_update(key_tuples)
+
     @inlineCallbacks
     def process_command_reconcile_cache(self, conversation_key,
                                         user_account_key):
@@ -302,6 +335,57 @@ class GoWorkerMixin(object):
     def collect_metrics(self, user_api, conversation_key):
         return self.publish_conversation_metrics(user_api, conversation_key)
 
+    @inlineCallbacks
+    def publish_conversation_metrics_batch(self, conversations):
+        """Publish metrics for many conversations in one metric message.
+
+        Conversations are loaded in bunches and the metric values for each
+        bunch are requested concurrently so that the message store cache
+        lookups are pipelined over the Redis connection.
+
+        :param list conversations:
+            ``(user_account_key, conversation_key)`` pairs.
+        """
+        conv_keys_by_account = defaultdict(list)
+        for user_account_key, conversation_key in conversations:
+            conv_keys_by_account[user_account_key].append(conversation_key)
+
+        msg = MetricMessage()
+        for user_account_key, conv_keys in conv_keys_by_account.iteritems():
+            user_api = self.get_user_api(user_account_key)
+            conv_store = user_api.conversation_store
+            for bunch in conv_store.load_all_bunches(conv_keys):
+                convs = yield bunch
+                datapoints = yield gatherResults([
+                    self.get_conversation_metric_datapoints(user_api, conv)
+                    for conv in convs])
+                for conv_datapoints in datapoints:
+                    msg.extend(conv_datapoints)
+
+        if msg.datapoints():
+            self.metric_publisher.publish_message(msg)
+
+    @inlineCallbacks
+    def get_conversation_metric_datapoints(self, user_api, conv):
+        try:
+            conv_def = get_conversation_definition(
+                conv.conversation_type, conv)
+            metrics = list(conv_def.get_metrics())
+            values = yield gatherResults([
+                maybeDeferred(metric.get_value, user_api)
+                for metric in metrics], consumeErrors=True)
+        except Exception:
+            log.err(None, "Error collecting metrics for conversation %s." % (
+                conv.key,))
+            returnValue([])
+
+        prefix = get_conversation_metric_prefix(conv)
+        timestamp = int(time.time())
+        returnValue([
+            (prefix + metric.metric.name, metric.metric.aggs,
+             [(timestamp, value)])
+            for metric, value in zip(metrics, values)])
+
     def add_conv_to_msg_options(self, conv, msg_options):
         helper_metadata = msg_options.setdefault('helper_metadata', {})
         conv.set_go_helper_metadata(helper_metadata)
@@ -309,11 +393,31 @@ class GoWorkerMixin(object):
 
 
 class GoApplicationMixin(GoWorkerMixin):
+    conversation_cache = None
+
+    def _go_setup_caches(self, config):
+        self.conversation_cache = LRUCache(
+            config.conversation_cache_size, config.conversation_cache_ttl)
+
+    def invalidate_cached_conversation(self, user_account_key,
+                                       conversation_key):
+        if self.conversation_cache is not None:
+            self.conversation_cache.pop((user_account_key, conversation_key))
+
     def get_config_data_for_conversation(self, conversation):
         config = conversation.config.copy()
         config["conversation"] = conversation
         return GoWorkerConfigData(self.config, config)
 
+    def get_contact_load_concurrency(self, user_account_key):
+        """
+        Return the number of contact bunches to load concurrently when
+        sending to the contacts of one of the given account's conversations.
+        """
+        config = self.get_static_config()
+        return config.account_contact_load_concurrency.get(
+            user_account_key, config.contact_load_concurrency)
+
     def get_config_for_conversation(self, conversation):
         # If the conversation isn't running, we want to ignore the message
         # instead of getting the config.
@@ -329,9 +433,20 @@ class GoApplicationMixin(GoWorkerMixin):
         # populated for us from the original message by the routing table
         # dispatcher.
         msg_mdh = self.get_metadata_helper(msg)
-        conversation = yield msg_mdh.get_conversation()
-
-        returnValue(self.get_config_for_conversation(conversation))
+        cache_key = (msg_mdh.get_account_key(), msg_mdh.get_conversation_key())
+        config = self.conversation_cache.get(cache_key)
+        if config is None:
+            conversation = yield msg_mdh.get_conversation()
+            # Conversations that aren't running raise IgnoreMessage here, so
+            # only running ones are cached.
+            config = self.get_config_for_conversation(conversation)
+            self.conversation_cache.set(cache_key, config)
+        returnValue(config)
+
+    def process_command_config_changed(self, user_account_key,
+                                       conversation_key):
+        """Discard any cached copy of a conversation and its config."""
+        self.invalidate_cached_conversation(user_account_key, conversation_key)
 
     @inlineCallbacks
     def process_command_start(self, user_account_key, conversation_key):
@@ -351,6 +466,9 @@ class GoApplicationMixin(GoWorkerMixin):
             return
         conv.set_status_started()
         yield conv.save()
+        yield self.vumi_api.running_conversations.add(
+            user_account_key, conversation_key, conv.worker_name)
+        self.invalidate_cached_conversation(user_account_key, conversation_key)
 
     @inlineCallbacks
     def process_command_stop(self, user_account_key, conversation_key):
@@ -368,6 +486,9 @@ class GoApplicationMixin(GoWorkerMixin):
             return
         conv.set_status_stopped()
         yield conv.save()
+        yield self.vumi_api.running_conversations.remove(
+            user_account_key, conversation_key)
+        self.invalidate_cached_conversation(user_account_key, conversation_key)
 
     @inlineCallbacks
     def process_command_send_message(self, user_account_key, conversation_key,
@@ -401,6 +522,16 @@ class GoApplicationMixin(GoWorkerMixin):
 
 
 class GoRouterMixin(GoWorkerMixin):
+    router_cache = None
+
+    def _go_setup_caches(self, config):
+        self.router_cache = LRUCache(
+            config.router_cache_size, config.router_cache_ttl)
+
+    def invalidate_cached_router(self, user_account_key, router_key):
+        if self.router_cache is not None:
+            self.router_cache.pop((user_account_key, router_key))
+
     def get_config_data_for_router(self, router):
         config = router.config.copy()
         config["router"] = router
@@ -420,9 +551,19 @@ class GoRouterMixin(GoWorkerMixin):
         # populated for us from the original message by the routing table
         # dispatcher.
         msg_mdh = self.get_metadata_helper(msg)
-        router = yield msg_mdh.get_router()
-
-        returnValue(self.get_config_for_router(router))
+        cache_key = (msg_mdh.get_account_key(), msg_mdh.get_router_key())
+        config = self.router_cache.get(cache_key)
+        if config is None:
+            router = yield msg_mdh.get_router()
+            # Routers that aren't running raise IgnoreMessage here, so only
+            # running ones are cached.
+            config = self.get_config_for_router(router)
+            self.router_cache.set(cache_key, config)
+        returnValue(config)
+
+    def process_command_config_changed(self, user_account_key, router_key):
+        """Discard any cached copy of a router and its config."""
+        self.invalidate_cached_router(user_account_key, router_key)
 
     @inlineCallbacks
     def process_command_start(self, user_account_key, router_key):
@@ -441,6 +582,7 @@ class GoRouterMixin(GoWorkerMixin):
             return
         router.set_status_started()
         yield router.save()
+        self.invalidate_cached_router(user_account_key, router_key)
 
     @inlineCallbacks
     def process_command_stop(self, user_account_key, router_key):
@@ -459,11 +601,27 @@ class GoRouterMixin(GoWorkerMixin):
             return
         router.set_status_stopped()
         yield router.save()
+        self.invalidate_cached_router(user_account_key, router_key)
 
 
 class GoApplicationConfigMixin(GoWorkerConfigMixin):
     conversation = ConfigConversation(
         "Conversation instance for this message", required=False)
+    contact_load_concurrency = ConfigInt(
+        "Number of contact bunches to load concurrently when sending to a "
+        "conversation's contacts.", default=1, static=True)
+    account_contact_load_concurrency = ConfigDict(
+        "Per-account overrides for `contact_load_concurrency`, keyed by "
+        "account key.", default={}, static=True)
+    conversation_cache_size = ConfigInt(
+        "Maximum number of conversation configs to cache.",
+        default=1000, static=True)
+    conversation_cache_ttl = ConfigFloat(
+        "Number of seconds a cached conversation config may be used for "
+        "before the conversation is reloaded. Cached configs are discarded "
+        "sooner when this worker processes a start, stop or config_changed "
+        "command for the conversation. Set to zero to disable caching.",
+        default=5, static=True)
 
 
 class GoApplicationConfig(ApplicationWorker.CONFIG_CLASS,
@@ -510,6 +668,15 @@ class GoRouterConfigMixin(GoWorkerConfigMixin):
         required=True, static=True)
     router = ConfigRouter(
         "Router instance for this message", required=False)
+    router_cache_size = ConfigInt(
+        "Maximum number of router configs to cache.",
+        default=1000, static=True)
+    router_cache_ttl = ConfigFloat(
+        "Number of seconds a cached router config may be used for before the "
+        "router is reloaded. Cached configs are discarded sooner when this "
+        "worker processes a start, stop or config_changed command for the "
+        "router. Set to zero to disable caching.",
+        default=5, static=True)
 
 
 class GoRouterConfig(BaseWorker.CONFIG_CLASS, GoRouterConfigMixin):
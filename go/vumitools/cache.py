@@ -0,0 +1,154 @@
+# -*- test-case-name: go.vumitools.tests.test_cache -*-
+
+"""Caches for Vumi Go workers."""
+
+import json
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import returnValue
+from vumi.persist.redis_base import Manager
+
+
+class LRUCache(object):
+    """A size-bounded, least-recently-used cache with expiring entries.
+
+    :param int max_size:
+        The maximum number of entries to hold. The least recently used entry
+        is evicted when this is exceeded.
+    :param float ttl:
+        The number of seconds an entry lives for. ``None`` means entries
+        never expire and ``0`` disables the cache entirely.
+    :param clock:
+        An ``IReactorTime`` provider. Defaults to the global reactor.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=None):
+        if clock is None:
+            clock = reactor
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._get_entry(key) is not None
+
+    def enabled(self):
+        return self.max_size > 0 and self.ttl != 0
+
+    def _get_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _value = entry
+        if expires_at is not None and expires_at <= self.clock.seconds():
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        """Return the value cached for `key`, or `default` if there isn't one.
+
+        Lookups are counted in :attr:`hits` and :attr:`misses`.
+        """
+        entry = self._get_entry(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # Move the entry to the most recently used end.
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry[1]
+
+    def set(self, key, value):
+        if not self.enabled():
+            return
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = self.clock.seconds() + self.ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (expires_at, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def keys(self):
+        """Return the keys of all entries, including ones that have expired
+        but haven't been evicted yet."""
+        return self._entries.keys()
+
+    def clear(self):
+        self._entries.clear()
+
+
+class RoutingTableVersionStore(object):
+    """Tracks a version number for each account's routing table.
+
+    Anything that modifies a routing table bumps the account's version so that
+    workers holding cached copies of the table know to reload it.
+    """
+
+    def __init__(self, redis):
+        self.manager = self.redis = redis
+
+    def _version_key(self, user_account_key):
+        return "version:%s" % (user_account_key,)
+
+    @Manager.calls_manager
+    def get_version(self, user_account_key):
+        """Return the current routing table version for an account.
+
+        Returns ``None`` if the routing table has never been modified.
+        """
+        version = yield self.redis.get(self._version_key(user_account_key))
+        if version is not None:
+            version = int(version)
+        returnValue(version)
+
+    def bump_version(self, user_account_key):
+        return self.redis.incr(self._version_key(user_account_key))
+
+
+class OutboundRoutingMetadataCache(object):
+    """Holds the routing metadata of recently sent outbound messages.
+
+    Events only need a handful of fields from their outbound message in order
+    to be routed, so these are kept in Redis (keyed by message id) for a
+    limited time to avoid loading the whole message from the message store.
+
+    :param redis:
+        Redis manager to store metadata in.
+    :param int ttl:
+        Number of seconds to keep metadata for.
+    """
+
+    def __init__(self, redis, ttl):
+        self.manager = self.redis = redis
+        self.ttl = ttl
+
+    def _metadata_key(self, message_id):
+        return "outbound:%s" % (message_id,)
+
+    @Manager.calls_manager
+    def get(self, message_id):
+        """Return the cached metadata dict for a message or ``None``."""
+        metadata = yield self.redis.get(self._metadata_key(message_id))
+        if metadata is not None:
+            metadata = json.loads(metadata)
+        returnValue(metadata)
+
+    def set(self, message_id, metadata):
+        return self.redis.setex(
+            self._metadata_key(message_id), self.ttl, json.dumps(metadata))
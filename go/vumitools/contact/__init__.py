@@ -1,6 +1,7 @@
 from go.vumitools.contact.models import (
     ContactGroup, Contact, ContactStore, ContactError, ContactNotFoundError)
+from go.vumitools.contact.membership import GroupMembershipStore
 
 
 __all__ = ['ContactGroup', 'Contact', 'ContactStore', 'ContactError',
-           'ContactNotFoundError']
+           'ContactNotFoundError', 'GroupMembershipStore']
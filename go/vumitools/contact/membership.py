@@ -0,0 +1,167 @@
+# -*- test-case-name: go.vumitools.contact.tests.test_membership -*-
+
+"""Materialized contact group membership."""
+
+import json
+
+from twisted.internet.defer import returnValue
+from vumi.persist.redis_base import Manager
+
+
+class GroupMembershipStore(object):
+    """Holds the contact keys belonging to each contact group in Redis.
+
+    Resolving a group's members from Riak needs a secondary index query for
+    static groups and a Riak search for smart groups. Once a group has been
+    resolved its members are stored here as a Redis set so that later
+    lookups (and unions across a conversation's groups) are cheap.
+
+    Static group sets are kept up to date incrementally by the contact store
+    as contacts are added to, removed from or deleted from groups. Smart
+    group membership depends on arbitrary contact fields, so smart group sets
+    expire after :attr:`SMART_GROUP_TTL` seconds and are resolved again.
+    Static group sets also expire, after :attr:`STATIC_GROUP_TTL` seconds, so
+    that changes made without going through the contact store are picked up
+    eventually.
+
+    The static groups of the contact with each address that messages arrive
+    from are also cached here, so that routing on group membership doesn't
+    need to load the contact from Riak. These entries are dropped whenever
+    the contact store updates the contact's groups and expire after
+    :attr:`ADDR_GROUPS_TTL` seconds otherwise.
+
+    :param redis:
+        Redis manager to store membership in.
+    """
+
+    STATIC_GROUP_TTL = 60 * 60
+    SMART_GROUP_TTL = 5 * 60
+    # Number of contact keys to add to a set in a single command.
+    MATERIALIZE_BATCH_SIZE = 1000
+    ADDR_GROUPS_TTL = 5 * 60
+
+    def __init__(self, redis):
+        self.manager = self.redis = redis
+
+    def _members_key(self, group_key):
+        return "members:%s" % (group_key,)
+
+    def _materialized_key(self, group_key):
+        return "materialized:%s" % (group_key,)
+
+    def _addr_groups_key(self, account_key, field, value):
+        return "addr_groups:%s:%s:%s" % (account_key, field, value)
+
+    def _contact_addrs_key(self, contact_key):
+        return "contact_addrs:%s" % (contact_key,)
+
+    def ttl_for_group(self, group):
+        if group.is_smart_group():
+            return self.SMART_GROUP_TTL
+        return self.STATIC_GROUP_TTL
+
+    @Manager.calls_manager
+    def is_materialized(self, group_key):
+        """Return ``True`` if the group's members are held here."""
+        exists = yield self.redis.exists(self._materialized_key(group_key))
+        returnValue(bool(exists))
+
+    @Manager.calls_manager
+    def materialize(self, group_key, contact_keys, ttl):
+        """Replace the stored members of a group with `contact_keys`."""
+        members_key = self._members_key(group_key)
+        contact_keys = list(contact_keys)
+        yield self.redis.delete(members_key)
+        for i in range(0, len(contact_keys), self.MATERIALIZE_BATCH_SIZE):
+            yield self.redis.sadd(
+                members_key,
+                *contact_keys[i:i + self.MATERIALIZE_BATCH_SIZE])
+        yield self.redis.setex(self._materialized_key(group_key), ttl, "1")
+        if contact_keys:
+            # Give the set a little longer than the marker so that it never
+            # disappears out from under a group that's still materialized.
+            yield self.redis.expire(members_key, ttl + 60)
+
+    @Manager.calls_manager
+    def invalidate(self, group_key):
+        """Discard the stored members of a group."""
+        yield self.redis.delete(self._materialized_key(group_key))
+        yield self.redis.delete(self._members_key(group_key))
+
+    @Manager.calls_manager
+    def get_member_keys(self, group_key):
+        keys = yield self.redis.smembers(self._members_key(group_key))
+        returnValue(list(keys))
+
+    @Manager.calls_manager
+    def get_member_keys_for_groups(self, group_keys):
+        """Return the union of the stored members of several groups."""
+        group_keys = list(group_keys)
+        if not group_keys:
+            returnValue([])
+        keys = yield self.redis.sunion(*[
+            self._members_key(group_key) for group_key in group_keys])
+        returnValue(list(keys))
+
+    @Manager.calls_manager
+    def add_member(self, contact_key, group_keys):
+        """Add a contact to the stored members of each of `group_keys`.
+
+        Groups that aren't materialized are left alone, since they will be
+        resolved from Riak the next time they're needed.
+        """
+        for group_key in group_keys:
+            if (yield self.is_materialized(group_key)):
+                yield self.redis.sadd(
+                    self._members_key(group_key), contact_key)
+
+    @Manager.calls_manager
+    def remove_member(self, contact_key, group_keys):
+        """Remove a contact from the stored members of each of `group_keys`.
+        """
+        for group_key in group_keys:
+            yield self.redis.srem(self._members_key(group_key), contact_key)
+
+    @Manager.calls_manager
+    def get_addr_groups(self, account_key, field, value):
+        """Return the cached group keys for the contact with an address.
+
+        Returns ``None`` if nothing is cached for the address.
+        """
+        data = yield self.redis.get(
+            self._addr_groups_key(account_key, field, value))
+        if data is None:
+            returnValue(None)
+        returnValue(json.loads(data))
+
+    @Manager.calls_manager
+    def set_addr_groups(self, account_key, field, value, contact_key,
+                        group_keys):
+        """Cache the group keys for the contact with an address.
+
+        `contact_key` is ``None`` if there is no contact with the address.
+        Otherwise the address is recorded against the contact so that the
+        entry can be dropped when the contact's groups change.
+        """
+        addr_key = self._addr_groups_key(account_key, field, value)
+        yield self.redis.setex(
+            addr_key, self.ADDR_GROUPS_TTL, json.dumps(list(group_keys)))
+        if contact_key is not None:
+            contact_addrs_key = self._contact_addrs_key(contact_key)
+            yield self.redis.sadd(contact_addrs_key, addr_key)
+            yield self.redis.expire(contact_addrs_key, self.ADDR_GROUPS_TTL)
+
+    @Manager.calls_manager
+    def invalidate_addr(self, account_key, field, value):
+        """Discard the cached group keys for an address."""
+        yield self.redis.delete(
+            self._addr_groups_key(account_key, field, value))
+
+    @Manager.calls_manager
+    def invalidate_contact(self, contact_key):
+        """Discard the cached group keys for all of a contact's addresses."""
+        contact_addrs_key = self._contact_addrs_key(contact_key)
+        addr_keys = yield self.redis.smembers(contact_addrs_key)
+        for addr_key in addr_keys:
+            yield self.redis.delete(addr_key)
+        yield self.redis.delete(contact_addrs_key)
@@ -42,3 +42,27 @@ class ContactMigrator(ModelMigrator):
             mdata.set_value(field, value, index=('%s_bin' % (field,)))
 
         return mdata
+
+    def migrate_from_2(self, mdata):
+        index_fields = (
+            'msisdn', 'twitter_handle', 'facebook_id', 'bbm_pin', 'gtalk_id',
+            'mxit_id', 'wechat_id')
+
+        mdata.copy_values(
+            'name', 'surname', 'email_address', 'dob', 'created_at',
+            *index_fields)
+        mdata.copy_dynamic_values(
+            'extras-', 'subscription-')
+        mdata.copy_indexes(
+            'user_account_bin', 'groups_bin',
+            *['%s_bin' % (field,) for field in index_fields])
+
+        # Add stuff that's new in this version
+        mdata.set_value('$VERSION', 3)
+
+        surname = mdata.old_data['surname']
+        initial = surname[0].lower() if surname else None
+        mdata.set_value(
+            'surname_initial', initial, index='surname_initial_bin')
+
+        return mdata
@@ -45,6 +45,9 @@ DELIVERY_CLASSES = {
 }
 
 
+# Contact fields that hold addresses.
+ADDR_FIELDS = sorted(set(dc['field'] for dc in DELIVERY_CLASSES.values()))
+
 DEFAULT_DELIVERY_CLASS = 'ussd'
 
 
@@ -56,6 +59,13 @@ class ContactNotFoundError(ContactError):
     """Raised when a contact is not found"""
 
 
+def surname_initial(surname):
+    """Return the lowercased first letter of a surname, or ``None``."""
+    if not surname:
+        return None
+    return surname[0].lower()
+
+
 def contact_field_for_addr(delivery_class, addr):
     # TODO: change when we have proper address types in vumi
     delivery_class_dict = DELIVERY_CLASSES.get(delivery_class, None)
@@ -94,7 +104,7 @@ class ContactGroup(Model):
 class Contact(Model):
     """A contact"""
 
-    VERSION = 2
+    VERSION = 3
     MIGRATOR = ContactMigrator
 
     # key is UUID
@@ -107,6 +117,8 @@ class Contact(Model):
     groups = ManyToMany(ContactGroup)
     extra = Dynamic(prefix='extras-')
     subscription = Dynamic(prefix='subscription-')
+    # Only used for indexing. This is kept in sync with surname on save.
+    surname_initial = Unicode(max_length=1, null=True, index=True)
 
     # Address fields
     msisdn = Unicode(max_length=255, index=True)
@@ -117,6 +129,10 @@ class Contact(Model):
     mxit_id = Unicode(null=True, index=True)
     wechat_id = Unicode(null=True, index=True)
 
+    def save(self):
+        self.surname_initial = surname_initial(self.surname)
+        return super(Contact, self).save()
+
     def add_to_group(self, group):
         if isinstance(group, ContactGroup):
             self.groups.add(group)
@@ -160,6 +176,12 @@ class ContactStore(PerAccountStore):
     FIND_BY_INDEX = True
     FIND_BY_INDEX_SEARCH_FALLBACK = True
 
+    def __init__(self, base_manager, user_account_key, membership=None):
+        # If provided, `membership` is a GroupMembershipStore used to avoid
+        # resolving group members from Riak every time they're needed.
+        self.membership = membership
+        super(ContactStore, self).__init__(base_manager, user_account_key)
+
     def setup_proxies(self):
         self.contacts = self.manager.proxy(Contact)
         self.groups = self.manager.proxy(ContactGroup)
@@ -169,10 +191,15 @@ class ContactStore(PerAccountStore):
         return dict((k, v) for k, v in fields.iteritems()
                     if k not in cls.NONSETTABLE_CONTACT_FIELDS)
 
-    @Manager.calls_manager
     def new_contact(self, **fields):
-        contact_id = uuid4().get_hex()
+        return self.new_contact_with_key(uuid4().get_hex(), **fields)
 
+    @Manager.calls_manager
+    def new_contact_with_key(self, contact_id, **fields):
+        """
+        Create a contact with the given key. Saving over an existing contact
+        with the same key replaces it.
+        """
         # These are foreign keys.
         groups = fields.pop('groups', [])
 
@@ -184,15 +211,27 @@ class ContactStore(PerAccountStore):
             contact.add_to_group(group)
 
         yield contact.save()
+        yield self.invalidate_addr_groups(contact)
+        yield self.update_group_membership(
+            contact.key, added_group_keys=contact.groups.keys())
         returnValue(contact)
 
     @Manager.calls_manager
     def update_contact(self, key, **fields):
+        contact = yield self.get_contact_by_key(key)
+        contact = yield self.update_contact_fields(contact, **fields)
+        returnValue(contact)
+
+    @Manager.calls_manager
+    def update_contact_fields(self, contact, **fields):
+        """
+        Update and save an already loaded contact. This is
+        :meth:`update_contact` without the extra load.
+        """
         # These are foreign keys.
         groups = fields.pop('groups', [])
         fields = self.settable_contact_fields(**fields)
 
-        contact = yield self.get_contact_by_key(key)
         for field_name, field_value in fields.iteritems():
             if field_name in contact.field_descriptors:
                 setattr(contact, field_name, field_value)
@@ -201,8 +240,58 @@ class ContactStore(PerAccountStore):
             contact.add_to_group(group)
 
         yield contact.save()
+        yield self.invalidate_addr_groups(contact)
+        yield self.update_group_membership(
+            contact.key, added_group_keys=contact.groups.keys())
         returnValue(contact)
 
+    @Manager.calls_manager
+    def update_group_membership(self, contact_key, added_group_keys=(),
+                                removed_group_keys=()):
+        """
+        Update the materialized group membership after a contact has been
+        added to or removed from groups.
+
+        This should be called whenever a contact's groups are modified
+        without going through :meth:`new_contact` or :meth:`update_contact`.
+        """
+        if self.membership is None:
+            return
+        yield self.membership.invalidate_contact(contact_key)
+        if added_group_keys:
+            yield self.membership.add_member(contact_key, added_group_keys)
+        if removed_group_keys:
+            yield self.membership.remove_member(
+                contact_key, removed_group_keys)
+
+    @Manager.calls_manager
+    def invalidate_addr_groups(self, contact):
+        """
+        Discard the cached group keys for each of the contact's addresses.
+
+        A contact may have been saved with an address that was previously
+        cached as having no contact.
+        """
+        if self.membership is None:
+            return
+        for field in ADDR_FIELDS:
+            value = getattr(contact, field)
+            if value:
+                yield self.membership.invalidate_addr(
+                    self.user_account_key, field, value)
+
+    @Manager.calls_manager
+    def delete_contact(self, contact):
+        yield self.update_group_membership(
+            contact.key, removed_group_keys=contact.groups.keys())
+        yield contact.delete()
+
+    @Manager.calls_manager
+    def delete_group(self, group):
+        if self.membership is not None:
+            yield self.membership.invalidate(group.key)
+        yield group.delete()
+
     @Manager.calls_manager
     def new_group(self, name):
         group_id = uuid4().get_hex()
@@ -233,6 +322,15 @@ class ContactStore(PerAccountStore):
     @Manager.calls_manager
     def get_contacts_for_group(self, group):
         """Return contact keys for this group."""
+        if self.membership is not None:
+            yield self._materialize_group(group)
+            contacts = yield self.membership.get_member_keys(group.key)
+            returnValue(contacts)
+        contacts = yield self._resolve_contacts_for_group(group)
+        returnValue(contacts)
+
+    @Manager.calls_manager
+    def _resolve_contacts_for_group(self, group):
         contacts = set([])
         static_contacts = yield self.get_static_contacts_for_group(group)
         contacts.update(static_contacts)
@@ -241,17 +339,37 @@ class ContactStore(PerAccountStore):
             contacts.update(dynamic_contacts)
         returnValue(list(contacts))
 
+    @Manager.calls_manager
+    def _materialize_group(self, group):
+        if (yield self.membership.is_materialized(group.key)):
+            return
+        contacts = yield self._resolve_contacts_for_group(group)
+        yield self.membership.materialize(
+            group.key, contacts, self.membership.ttl_for_group(group))
+
     @Manager.calls_manager
     def get_contacts_for_conversation(self, conversation):
         """
         Collect all contacts relating to a conversation from static &
         dynamic groups.
         """
+        if self.membership is not None:
+            # Make sure every group is materialized and then let Redis take
+            # the union of their members.
+            group_keys = []
+            for groups in conversation.groups.load_all_bunches():
+                for group in (yield groups):
+                    yield self._materialize_group(group)
+                    group_keys.append(group.key)
+            contacts = yield self.membership.get_member_keys_for_groups(
+                group_keys)
+            returnValue(contacts)
+
         # Grab all contacts we can find
         contacts = set([])
         for groups in conversation.groups.load_all_bunches():
             for group in (yield groups):
-                group_contacts = yield self.get_contacts_for_group(group)
+                group_contacts = yield self._resolve_contacts_for_group(group)
                 contacts.update(group_contacts)
 
         returnValue(list(contacts))
@@ -274,41 +392,28 @@ class ContactStore(PerAccountStore):
         else:
             return self.contacts.index_lookup('groups', group.key).get_count()
 
+    def surname_initial_keys_page(self, letter, max_results=None,
+                                  continuation=None):
+        """
+        Return a page of keys for contacts with surnames starting with
+        `letter`.
+
+        See :meth:`vumi.persist.model.Model.index_keys_page` for details of
+        `max_results` and `continuation`.
+        """
+        return self.contacts.index_keys_page(
+            'surname_initial', surname_initial(letter),
+            max_results=max_results, continuation=continuation)
+
     @Manager.calls_manager
     def filter_contacts_on_surname(self, letter, group=None):
-        # FIXME: This does a mapreduce over a bucket, which means hitting every
-        #        key in riak.
-        # TODO: vumi.persist needs to have better ways of supporting
-        #       generic map reduce functions. There's a bunch of boilerplate
-        #       around getting bucket names and indexes that I'm doing
-        #       manually that could be automated.
-        mr = self.manager.riak_map_reduce()
-        bucket = self.manager.bucket_name(Contact)
-        mr.add_bucket(bucket)
-        if group is not None:
-            mr.index(bucket, 'groups_bin', group.key)
-        # Deleted values hang around with tombstone markers in Riak for a while
-        # before they get removed, and this happens a lot in tests. We need to
-        # find the real values amongst the deleted ones here.
-        # TODO: Make this a general thing?
-        js_function = """function(value, keyData, arg){
-            for (i in value.values) {
-                var val = value.values[i]
-                if (!val.metadata['X-Riak-Deleted']) {
-                    var data = JSON.parse(val.data);
-                    if (data.surname) {
-                        if (data.surname.toLowerCase()[0] === arg) {
-                            return [[value.key, val]];
-                        }
-                    }
-                }
-            }
-            return [];
-        }"""
-        mr.map(js_function, {'arg': letter.lower()})
-        contacts = yield self.manager.run_map_reduce(mr,
-            lambda manager, result: Contact.load(
-                manager, result[0], result[1]))
+        keys = yield self.contacts.index_keys(
+            'surname_initial', surname_initial(letter))
+        contacts = []
+        for contacts_bunch in self.contacts.load_all_bunches(keys):
+            for contact in (yield contacts_bunch):
+                if group is None or group.key in contact.groups.keys():
+                    contacts.append(contact)
         returnValue(contacts)
 
     def list_contacts(self):
@@ -358,6 +463,32 @@ class ContactStore(PerAccountStore):
         field_dict.setdefault('msisdn', u'unknown')
         return self.new_contact(**field_dict)
 
+    @Manager.calls_manager
+    def group_keys_for_addr(self, delivery_class, addr):
+        """
+        Returns the keys of the static groups the contact with an address
+        belongs to, or an empty list if there is no such contact.
+        """
+        field, value = contact_field_for_addr(delivery_class, addr)
+        if self.membership is not None:
+            group_keys = yield self.membership.get_addr_groups(
+                self.user_account_key, field, value)
+            if group_keys is not None:
+                returnValue(group_keys)
+
+        try:
+            contact = yield self.contact_for_addr(
+                delivery_class, addr, create=False)
+        except ContactNotFoundError:
+            contact_key, group_keys = None, []
+        else:
+            contact_key, group_keys = contact.key, contact.groups.keys()
+
+        if self.membership is not None:
+            yield self.membership.set_addr_groups(
+                self.user_account_key, field, value, contact_key, group_keys)
+        returnValue(group_keys)
+
     @Manager.calls_manager
     def contact_for_addr(self, delivery_class, addr, create=True):
         """
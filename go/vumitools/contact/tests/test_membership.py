@@ -0,0 +1,147 @@
+"""Tests for go.vumitools.contact.membership."""
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.vumitools.contact.membership import GroupMembershipStore
+
+
+class FakeGroup(object):
+    def __init__(self, query=None):
+        self.query = query
+
+    def is_smart_group(self):
+        return self.query is not None
+
+
+class TestGroupMembershipStore(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.store = GroupMembershipStore(
+            self.redis.sub_manager('contact_group_membership'))
+
+    def test_ttl_for_group(self):
+        self.assertEqual(
+            self.store.ttl_for_group(FakeGroup()),
+            GroupMembershipStore.STATIC_GROUP_TTL)
+        self.assertEqual(
+            self.store.ttl_for_group(FakeGroup(u'name:foo')),
+            GroupMembershipStore.SMART_GROUP_TTL)
+
+    @inlineCallbacks
+    def test_materialize(self):
+        self.assertFalse((yield self.store.is_materialized(u'group-1')))
+        yield self.store.materialize(u'group-1', [u'c1', u'c2'], 60)
+        self.assertTrue((yield self.store.is_materialized(u'group-1')))
+        self.assertEqual(
+            sorted((yield self.store.get_member_keys(u'group-1'))),
+            [u'c1', u'c2'])
+        ttl = yield self.store.redis.ttl("materialized:group-1")
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_materialize_replaces_members(self):
+        yield self.store.materialize(u'group-1', [u'c1', u'c2'], 60)
+        yield self.store.materialize(u'group-1', [u'c3'], 60)
+        self.assertEqual(
+            (yield self.store.get_member_keys(u'group-1')), [u'c3'])
+
+    @inlineCallbacks
+    def test_materialize_in_batches(self):
+        self.store.MATERIALIZE_BATCH_SIZE = 2
+        keys = [u'c%s' % (i,) for i in range(5)]
+        yield self.store.materialize(u'group-1', keys, 60)
+        self.assertEqual(
+            sorted((yield self.store.get_member_keys(u'group-1'))), keys)
+
+    @inlineCallbacks
+    def test_materialize_empty(self):
+        yield self.store.materialize(u'group-1', [], 60)
+        self.assertTrue((yield self.store.is_materialized(u'group-1')))
+        self.assertEqual((yield self.store.get_member_keys(u'group-1')), [])
+
+    @inlineCallbacks
+    def test_invalidate(self):
+        yield self.store.materialize(u'group-1', [u'c1'], 60)
+        yield self.store.invalidate(u'group-1')
+        self.assertFalse((yield self.store.is_materialized(u'group-1')))
+        self.assertEqual((yield self.store.get_member_keys(u'group-1')), [])
+
+    @inlineCallbacks
+    def test_get_member_keys_for_groups(self):
+        yield self.store.materialize(u'group-1', [u'c1', u'c2'], 60)
+        yield self.store.materialize(u'group-2', [u'c2', u'c3'], 60)
+        keys = yield self.store.get_member_keys_for_groups(
+            [u'group-1', u'group-2'])
+        self.assertEqual(sorted(keys), [u'c1', u'c2', u'c3'])
+        self.assertEqual(
+            (yield self.store.get_member_keys_for_groups([])), [])
+
+    @inlineCallbacks
+    def test_add_member(self):
+        yield self.store.materialize(u'group-1', [u'c1'], 60)
+        yield self.store.add_member(u'c2', [u'group-1', u'group-2'])
+        self.assertEqual(
+            sorted((yield self.store.get_member_keys(u'group-1'))),
+            [u'c1', u'c2'])
+        # Groups that aren't materialized are left alone.
+        self.assertEqual((yield self.store.get_member_keys(u'group-2')), [])
+
+    @inlineCallbacks
+    def test_remove_member(self):
+        yield self.store.materialize(u'group-1', [u'c1', u'c2'], 60)
+        yield self.store.remove_member(u'c1', [u'group-1'])
+        self.assertEqual(
+            (yield self.store.get_member_keys(u'group-1')), [u'c2'])
+
+    @inlineCallbacks
+    def test_addr_groups(self):
+        self.assertEqual(
+            (yield self.store.get_addr_groups(u'acc', 'msisdn', u'+271')),
+            None)
+        yield self.store.set_addr_groups(
+            u'acc', 'msisdn', u'+271', u'c1', [u'group-1'])
+        yield self.store.set_addr_groups(u'acc', 'msisdn', u'+272', None, [])
+        self.assertEqual(
+            (yield self.store.get_addr_groups(u'acc', 'msisdn', u'+271')),
+            [u'group-1'])
+        self.assertEqual(
+            (yield self.store.get_addr_groups(u'acc', 'msisdn', u'+272')), [])
+        self.assertEqual(
+            (yield self.store.get_addr_groups(u'acc2', 'msisdn', u'+271')),
+            None)
+        ttl = yield self.store.redis.ttl("addr_groups:acc:msisdn:+271")
+        self.assertTrue(0 < ttl <= GroupMembershipStore.ADDR_GROUPS_TTL)
+
+    @inlineCallbacks
+    def test_invalidate_addr(self):
+        yield self.store.set_addr_groups(
+            u'acc', 'msisdn', u'+271', u'c1', [u'group-1'])
+        yield self.store.invalidate_addr(u'acc', 'msisdn', u'+271')
+        self.assertEqual(
+            (yield self.store.get_addr_groups(u'acc', 'msisdn', u'+271')),
+            None)
+
+    @inlineCallbacks
+    def test_invalidate_contact(self):
+        yield self.store.set_addr_groups(
+            u'acc', 'msisdn', u'+271', u'c1', [u'group-1'])
+        yield self.store.set_addr_groups(
+            u'acc', 'gtalk_id', u'c1@example.com', u'c1', [u'group-1'])
+        yield self.store.set_addr_groups(
+            u'acc', 'msisdn', u'+272', u'c2', [u'group-1'])
+        yield self.store.invalidate_contact(u'c1')
+        self.assertEqual(
+            (yield self.store.get_addr_groups(u'acc', 'msisdn', u'+271')),
+            None)
+        self.assertEqual(
+            (yield self.store.get_addr_groups(
+                u'acc', 'gtalk_id', u'c1@example.com')),
+            None)
+        self.assertEqual(
+            (yield self.store.get_addr_groups(u'acc', 'msisdn', u'+272')),
+            [u'group-1'])
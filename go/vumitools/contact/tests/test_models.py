@@ -6,7 +6,8 @@ from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 from go.vumitools.account.models import AccountStore
 from go.vumitools.contact.models import (
     ContactNotFoundError, Contact, ContactStore)
-from go.vumitools.contact.old_models import ContactVNone, ContactV1
+from go.vumitools.contact.old_models import (
+    ContactVNone, ContactV1, ContactV2)
 from go.vumitools.tests.helpers import VumiApiHelper
 
 
@@ -23,7 +24,8 @@ class TestContact(VumiTestCase):
         per_account_manager = riak_manager.sub_manager(self.user.key)
         self.contacts_vnone = per_account_manager.proxy(ContactVNone)
         self.contacts_v1 = per_account_manager.proxy(ContactV1)
-        self.contacts_v2 = per_account_manager.proxy(Contact)
+        self.contacts_v2 = per_account_manager.proxy(ContactV2)
+        self.contacts_v3 = per_account_manager.proxy(Contact)
 
     def assert_with_index(self, model_obj, field, value):
         self.assertEqual(getattr(model_obj, field), value)
@@ -56,6 +58,9 @@ class TestContact(VumiTestCase):
     def make_contact_v2(self, **fields):
         return self._make_contact(self.contacts_v2, **fields)
 
+    def make_contact_v3(self, **fields):
+        return self._make_contact(self.contacts_v3, **fields)
+
     @inlineCallbacks
     def test_contact_vnone(self):
         contact = yield self.make_contact_vnone(name=u'name', msisdn=u'msisdn')
@@ -126,6 +131,54 @@ class TestContact(VumiTestCase):
         self.assert_with_index(contact_v2, 'mxit_id', 'mxit')
         self.assert_with_index(contact_v2, 'wechat_id', 'wechat')
 
+    @inlineCallbacks
+    def test_contact_v3(self):
+        contact = yield self.make_contact_v3(
+            name=u'name', surname=u'Surname', msisdn=u'msisdn')
+        self.assertEqual(contact.VERSION, 3)
+        self.assert_with_index(contact, 'surname_initial', u's')
+        self.assert_with_index(contact, 'msisdn', 'msisdn')
+
+    @inlineCallbacks
+    def test_contact_v3_surname_initial_updated_on_save(self):
+        contact = yield self.make_contact_v3(msisdn=u'msisdn')
+        self.assert_with_index(contact, 'surname_initial', None)
+        contact.surname = u'Other'
+        yield contact.save()
+        self.assert_with_index(contact, 'surname_initial', u'o')
+
+    @inlineCallbacks
+    def test_contact_v2_to_v3(self):
+        contact_v2 = yield self.make_contact_v2(
+            name=u'name', surname=u'Surname', msisdn=u'msisdn',
+            twitter_handle=u'twitter', facebook_id=u'facebook',
+            bbm_pin=u'bbm', gtalk_id=u'gtalk', mxit_id=u'mxit',
+            wechat_id=u'wechat')
+        contact_v2.extra["thing"] = u"extra-thing"
+        contact_v2.subscription["app"] = u"1"
+        yield contact_v2.save()
+        self.assertEqual(contact_v2.VERSION, 2)
+        contact_v3 = yield self.contacts_v3.load(contact_v2.key)
+        self.assertEqual(contact_v3.name, 'name')
+        self.assertEqual(contact_v3.extra["thing"], u"extra-thing")
+        self.assertEqual(contact_v3.subscription["app"], u"1")
+        self.assertEqual(contact_v3.VERSION, 3)
+        self.assert_with_index(contact_v3, 'surname_initial', u's')
+        self.assert_with_index(contact_v3, 'msisdn', 'msisdn')
+        self.assert_with_index(contact_v3, 'twitter_handle', 'twitter')
+        self.assert_with_index(contact_v3, 'facebook_id', 'facebook')
+        self.assert_with_index(contact_v3, 'bbm_pin', 'bbm')
+        self.assert_with_index(contact_v3, 'gtalk_id', 'gtalk')
+        self.assert_with_index(contact_v3, 'mxit_id', 'mxit')
+        self.assert_with_index(contact_v3, 'wechat_id', 'wechat')
+
+    @inlineCallbacks
+    def test_contact_v2_to_v3_without_surname(self):
+        contact_v2 = yield self.make_contact_v2(msisdn=u'msisdn')
+        contact_v3 = yield self.contacts_v3.load(contact_v2.key)
+        self.assertEqual(contact_v3.VERSION, 3)
+        self.assert_with_index(contact_v3, 'surname_initial', None)
+
     @inlineCallbacks
     def test_contact_vnone_to_v2(self):
         contact_vnone = yield self.make_contact_vnone(
@@ -259,3 +312,44 @@ class TestContactStore(VumiTestCase):
             'gtalk', u'foo@example.com')
         self.assertEqual(contact.gtalk_id, u'foo@example.com')
         self.assertEqual(contact.msisdn, u'unknown')
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname(self):
+        contact1 = yield self.contact_store.new_contact(
+            surname=u'Smith', msisdn=u'+27831234567')
+        contact2 = yield self.contact_store.new_contact(
+            surname=u'smythe', msisdn=u'+27831234568')
+        yield self.contact_store.new_contact(
+            surname=u'Jones', msisdn=u'+27831234569')
+        contacts = yield self.contact_store.filter_contacts_on_surname(u'S')
+        self.assertEqual(
+            sorted(c.key for c in contacts),
+            sorted([contact1.key, contact2.key]))
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname_for_group(self):
+        group = yield self.contact_store.new_group(u'group')
+        contact = yield self.contact_store.new_contact(
+            surname=u'Smith', msisdn=u'+27831234567', groups=[group])
+        yield self.contact_store.new_contact(
+            surname=u'Smythe', msisdn=u'+27831234568')
+        contacts = yield self.contact_store.filter_contacts_on_surname(
+            u's', group=group)
+        self.assertEqual([c.key for c in contacts], [contact.key])
+
+    @inlineCallbacks
+    def test_surname_initial_keys_page(self):
+        keys = []
+        for i in range(3):
+            contact = yield self.contact_store.new_contact(
+                surname=u'Smith %s' % (i,), msisdn=u'+2783123456%s' % (i,))
+            keys.append(contact.key)
+        page = yield self.contact_store.surname_initial_keys_page(
+            u's', max_results=2)
+        page_keys = list(page)
+        self.assertEqual(len(page_keys), 2)
+        self.assertTrue(page.has_next_page())
+        page = yield self.contact_store.surname_initial_keys_page(
+            u's', max_results=2, continuation=page.continuation)
+        page_keys.extend(page)
+        self.assertEqual(sorted(page_keys), sorted(keys))
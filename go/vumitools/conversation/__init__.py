@@ -1,3 +1,6 @@
 from go.vumitools.conversation.models import Conversation, ConversationStore
+from go.vumitools.conversation.registry import (
+    ConsistentHashRing, RunningConversationRegistry)
 
-__all__ = ['Conversation', 'ConversationStore']
+__all__ = ['Conversation', 'ConversationStore', 'ConsistentHashRing',
+           'RunningConversationRegistry']
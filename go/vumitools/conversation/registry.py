@@ -0,0 +1,209 @@
+# -*- test-case-name: go.vumitools.conversation.tests.test_registry -*-
+
+"""A registry of running conversations."""
+
+import bisect
+import hashlib
+import zlib
+
+from twisted.internet.defer import returnValue
+from vumi.persist.redis_base import Manager
+
+
+class ConsistentHashRing(object):
+    """Assigns keys to nodes by consistent hashing.
+
+    Each node is placed on the ring at several points so that keys are
+    spread evenly. Adding or removing a node only moves the keys that
+    belong to it.
+
+    :param list nodes:
+        The names of the nodes on the ring.
+    :param int replicas:
+        The number of points on the ring for each node.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        self.nodes = sorted(set(nodes))
+        self._ring = sorted(
+            (self._hash('%s:%d' % (node, i)), node)
+            for node in self.nodes for i in range(replicas))
+        self._points = [point for point, _ in self._ring]
+
+    def _hash(self, key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        """Return the node `key` belongs to or ``None`` if there are none."""
+        if not self._ring:
+            return None
+        i = bisect.bisect(self._points, self._hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+
+class RunningConversationRegistry(object):
+    """Keeps track of running conversations and their workers in Redis.
+
+    Finding the running conversations from Riak needs an index query for
+    every account and a load for every conversation (to find the worker
+    it belongs to). Application workers add conversations here when they
+    start and remove them when they stop, so that the metrics workers can
+    find them cheaply.
+
+    Conversations are spread over :attr:`NUM_SLOTS` Redis hashes so that
+    several metrics workers can split them up by slot.
+
+    Conversations started before the registry existed (or changed without
+    going through an application worker) aren't recorded, so the registry
+    needs to be rebuilt from Riak occasionally. It's considered complete
+    for :attr:`COMPLETE_TTL` seconds after being rebuilt. Only one worker
+    at a time should rebuild it (see :meth:`acquire_rebuild_lock`).
+
+    :param redis:
+        Redis manager to store the registry in.
+    """
+
+    NUM_SLOTS = 256
+    COMPLETE_TTL = 24 * 60 * 60
+    REBUILD_LOCK_TTL = 60 * 60
+
+    def __init__(self, redis):
+        self.manager = self.redis = redis
+
+    def _slot_key(self, slot):
+        return "slot:%d" % (slot,)
+
+    def _complete_key(self):
+        return "complete"
+
+    def _rebuild_lock_key(self):
+        return "rebuild_lock"
+
+    def _workers_key(self):
+        return "metrics_workers"
+
+    def _entry_field(self, user_account_key, conversation_key):
+        return "%s:%s" % (user_account_key, conversation_key)
+
+    def slot_for_conversation(self, conversation_key):
+        return zlib.crc32(conversation_key) % self.NUM_SLOTS
+
+    def add(self, user_account_key, conversation_key, worker_name):
+        """Record a running conversation."""
+        slot = self.slot_for_conversation(conversation_key)
+        return self.redis.hset(
+            self._slot_key(slot),
+            self._entry_field(user_account_key, conversation_key),
+            worker_name)
+
+    def remove(self, user_account_key, conversation_key):
+        """Forget a conversation that has stopped."""
+        slot = self.slot_for_conversation(conversation_key)
+        return self.redis.hdel(
+            self._slot_key(slot),
+            self._entry_field(user_account_key, conversation_key))
+
+    @Manager.calls_manager
+    def get_conversations(self, slot):
+        """Return the conversations in `slot`.
+
+        Returns a list of ``(user_account_key, conversation_key,
+        worker_name)`` tuples.
+        """
+        entries = yield self.redis.hgetall(self._slot_key(slot))
+        conversations = []
+        for field, worker_name in entries.iteritems():
+            user_account_key, _, conversation_key = field.partition(':')
+            conversations.append(
+                (user_account_key, conversation_key, worker_name))
+        returnValue(conversations)
+
+    @Manager.calls_manager
+    def is_complete(self):
+        """Return ``True`` if every running conversation is recorded."""
+        exists = yield self.redis.exists(self._complete_key())
+        returnValue(bool(exists))
+
+    @Manager.calls_manager
+    def acquire_rebuild_lock(self):
+        """Try to take the lock for rebuilding the registry.
+
+        Returns ``True`` if we got the lock. It expires after
+        :attr:`REBUILD_LOCK_TTL` seconds in case its holder goes away
+        without releasing it.
+        """
+        locked = yield self.redis.setnx(self._rebuild_lock_key(), "1")
+        if locked:
+            yield self.redis.expire(
+                self._rebuild_lock_key(), self.REBUILD_LOCK_TTL)
+        returnValue(bool(locked))
+
+    def release_rebuild_lock(self):
+        return self.redis.delete(self._rebuild_lock_key())
+
+    @Manager.calls_manager
+    def get_entries(self):
+        """Return the fields recorded in each slot.
+
+        Returns a dict mapping slots to sets of fields. A rebuild takes this
+        before it starts finding the running conversations and passes it to
+        :meth:`rebuild`.
+        """
+        entries = {}
+        for slot in range(self.NUM_SLOTS):
+            fields = yield self.redis.hgetall(self._slot_key(slot))
+            if fields:
+                entries[slot] = set(fields)
+        returnValue(entries)
+
+    @Manager.calls_manager
+    def rebuild(self, conversations, previous_entries):
+        """Replace the registry's entries with `conversations` and mark it
+        complete.
+
+        `conversations` is an iterable of ``(user_account_key,
+        conversation_key, worker_name)`` tuples. `previous_entries` is what
+        :meth:`get_entries` returned before they were found. Entries in it
+        that aren't in `conversations` are removed. Anything else is left
+        alone, so that conversations added while the rebuild was finding
+        them aren't lost.
+        """
+        slots = {}
+        for user_account_key, conversation_key, worker_name in conversations:
+            slot = self.slot_for_conversation(conversation_key)
+            field = self._entry_field(user_account_key, conversation_key)
+            slots.setdefault(slot, {})[field] = worker_name
+        for slot in sorted(set(slots) | set(previous_entries)):
+            entries = slots.get(slot, {})
+            stale = previous_entries.get(slot, set()) - set(entries)
+            if stale:
+                yield self.redis.hdel(self._slot_key(slot), *sorted(stale))
+            if entries:
+                yield self.redis.hmset(self._slot_key(slot), entries)
+        yield self.redis.setex(self._complete_key(), self.COMPLETE_TTL, "1")
+
+    @Manager.calls_manager
+    def heartbeat(self, worker_id, timestamp, timeout):
+        """Record that a metrics worker is alive.
+
+        Returns the ids of the workers that have sent a heartbeat within
+        the last `timeout` seconds, including `worker_id`.
+        """
+        workers_key = self._workers_key()
+        yield self.redis.zadd(workers_key, **{worker_id: timestamp})
+        stale = yield self.redis.zrangebyscore(
+            workers_key, '-inf', timestamp - timeout)
+        for stale_id in stale:
+            yield self.redis.zrem(workers_key, stale_id)
+        workers = yield self.redis.zrange(workers_key, 0, -1)
+        returnValue(workers)
+
+    def leave(self, worker_id):
+        """Remove a metrics worker that is shutting down."""
+        return self.redis.zrem(self._workers_key(), worker_id)
+
+    def slots_for_worker(self, worker_id, worker_ids):
+        """Return the slots `worker_id` is responsible for."""
+        ring = ConsistentHashRing(worker_ids)
+        return [slot for slot in range(self.NUM_SLOTS)
+                if ring.get_node(self._slot_key(slot)) == worker_id]
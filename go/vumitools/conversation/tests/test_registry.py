@@ -0,0 +1,138 @@
+"""Tests for go.vumitools.conversation.registry."""
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.vumitools.conversation.registry import (
+    ConsistentHashRing, RunningConversationRegistry)
+
+
+class TestConsistentHashRing(VumiTestCase):
+
+    def test_no_nodes(self):
+        ring = ConsistentHashRing([])
+        self.assertEqual(ring.get_node('foo'), None)
+
+    def test_single_node(self):
+        ring = ConsistentHashRing(['a'])
+        self.assertEqual(
+            set(ring.get_node('key%d' % (i,)) for i in range(100)),
+            set(['a']))
+
+    def test_spread(self):
+        ring = ConsistentHashRing(['a', 'b', 'c'])
+        nodes = [ring.get_node('key%d' % (i,)) for i in range(300)]
+        for node in ['a', 'b', 'c']:
+            self.assertTrue(nodes.count(node) > 50)
+
+    def test_stable_when_node_added(self):
+        keys = ['key%d' % (i,) for i in range(300)]
+        ring = ConsistentHashRing(['a', 'b'])
+        bigger_ring = ConsistentHashRing(['a', 'b', 'c'])
+        for key in keys:
+            node = bigger_ring.get_node(key)
+            if node != 'c':
+                self.assertEqual(node, ring.get_node(key))
+
+
+class TestRunningConversationRegistry(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.registry = RunningConversationRegistry(
+            self.redis.sub_manager('running_conversations'))
+
+    @inlineCallbacks
+    def get_all_conversations(self):
+        convs = []
+        for slot in range(self.registry.NUM_SLOTS):
+            slot_convs = yield self.registry.get_conversations(slot)
+            convs.extend(slot_convs)
+        returnValue(sorted(convs))
+
+    @inlineCallbacks
+    def test_add_and_remove(self):
+        yield self.registry.add(u'acc1', u'conv1', u'worker1')
+        yield self.registry.add(u'acc1', u'conv2', u'worker2')
+        slot = self.registry.slot_for_conversation(u'conv1')
+        convs = yield self.registry.get_conversations(slot)
+        self.assertTrue((u'acc1', u'conv1', u'worker1') in convs)
+
+        yield self.registry.remove(u'acc1', u'conv1')
+        convs = yield self.registry.get_conversations(slot)
+        self.assertFalse((u'acc1', u'conv1', u'worker1') in convs)
+
+    @inlineCallbacks
+    def test_rebuild(self):
+        yield self.registry.add(u'acc1', u'stopped', u'worker1')
+        yield self.registry.add(u'acc1', u'conv1', u'worker1')
+        self.assertFalse((yield self.registry.is_complete()))
+        previous_entries = yield self.registry.get_entries()
+        yield self.registry.add(u'acc1', u'added', u'worker1')
+
+        yield self.registry.rebuild([
+            (u'acc1', u'conv1', u'worker1'),
+            (u'acc2', u'conv2', u'worker2'),
+        ], previous_entries)
+        self.assertTrue((yield self.registry.is_complete()))
+        # Conversations that have stopped are removed but conversations
+        # added during the rebuild are kept.
+        convs = yield self.get_all_conversations()
+        self.assertEqual(convs, [
+            (u'acc1', u'added', u'worker1'),
+            (u'acc1', u'conv1', u'worker1'),
+            (u'acc2', u'conv2', u'worker2'),
+        ])
+
+    @inlineCallbacks
+    def test_get_entries(self):
+        self.assertEqual((yield self.registry.get_entries()), {})
+        yield self.registry.add(u'acc1', u'conv1', u'worker1')
+        slot = self.registry.slot_for_conversation(u'conv1')
+        self.assertEqual(
+            (yield self.registry.get_entries()), {slot: set([u'acc1:conv1'])})
+
+    @inlineCallbacks
+    def test_rebuild_sets_ttl(self):
+        yield self.registry.rebuild([], {})
+        ttl = yield self.registry.redis.ttl('complete')
+        self.assertTrue(0 < ttl <= self.registry.COMPLETE_TTL)
+
+    @inlineCallbacks
+    def test_rebuild_lock(self):
+        self.assertTrue((yield self.registry.acquire_rebuild_lock()))
+        self.assertFalse((yield self.registry.acquire_rebuild_lock()))
+        ttl = yield self.registry.redis.ttl('rebuild_lock')
+        self.assertTrue(0 < ttl <= self.registry.REBUILD_LOCK_TTL)
+
+        yield self.registry.release_rebuild_lock()
+        self.assertTrue((yield self.registry.acquire_rebuild_lock()))
+
+    @inlineCallbacks
+    def test_heartbeat(self):
+        workers = yield self.registry.heartbeat('w1', 100, 10)
+        self.assertEqual(workers, ['w1'])
+        workers = yield self.registry.heartbeat('w2', 105, 10)
+        self.assertEqual(sorted(workers), ['w1', 'w2'])
+        # w1 hasn't been seen for more than 10 seconds.
+        workers = yield self.registry.heartbeat('w2', 115, 10)
+        self.assertEqual(workers, ['w2'])
+
+    @inlineCallbacks
+    def test_leave(self):
+        yield self.registry.heartbeat('w1', 100, 10)
+        yield self.registry.leave('w1')
+        workers = yield self.registry.heartbeat('w2', 101, 10)
+        self.assertEqual(workers, ['w2'])
+
+    def test_slots_for_worker(self):
+        workers = ['w1', 'w2', 'w3']
+        slots = [self.registry.slots_for_worker(w, workers) for w in workers]
+        self.assertEqual(
+            sorted(sum(slots, [])), range(self.registry.NUM_SLOTS))
+        self.assertEqual(
+            self.registry.slots_for_worker('w1', ['w1']),
+            range(self.registry.NUM_SLOTS))
@@ -222,6 +222,17 @@ class TestConversationWrapper(VumiTestCase):
         [sent_message] = yield self.conv.sent_messages_in_cache()
         self.assertEqual(msg['message_id'], sent_message['message_id'])
 
+    @inlineCallbacks
+    def test_notify_config_changed(self):
+        yield self.conv.notify_config_changed()
+        [cmd] = self.vumi_helper.get_dispatched_commands()
+        self.assertEqual(cmd['worker_name'], 'dummy_application')
+        self.assertEqual(cmd['command'], 'config_changed')
+        self.assertEqual(cmd['kwargs'], {
+            'user_account_key': self.conv.user_account.key,
+            'conversation_key': self.conv.key,
+        })
+
     @inlineCallbacks
     def test_get_channels(self):
         yield self.conv.start()
@@ -342,6 +353,66 @@ class TestConversationWrapper(VumiTestCase):
             ['+27000000001'],
             (yield get_contacts()))
 
+    @inlineCallbacks
+    def test_get_opted_in_contact_bunches_with_opt_out_snapshot(self):
+        contact_store = self.user_helper.user_api.contact_store
+        user_account = yield self.user_helper.get_user_account()
+        opt_out_store = OptOutStore.from_user_account(user_account)
+
+        group = yield contact_store.new_group(u'a group')
+        self.conv.add_group(group)
+        yield self.conv.save()
+        for msisdn in [u'+27000000001', u'+27000000002']:
+            yield contact_store.new_contact(msisdn=msisdn, groups=[group])
+        yield opt_out_store.new_opt_out(u'msisdn', u'+27000000002', {
+            'message_id': u'some-message-id',
+        })
+
+        bunches = yield self.conv.get_opted_in_contact_bunches(
+            self.conv.delivery_class, snapshot_opt_outs=True)
+        # Opt-outs made after the snapshot is taken aren't seen.
+        yield opt_out_store.new_opt_out(u'msisdn', u'+27000000001', {
+            'message_id': u'some-message-id',
+        })
+        contacts = []
+        for bunch in bunches:
+            contacts.extend((yield bunch))
+        self.assertEqual([c.msisdn for c in contacts], [u'+27000000001'])
+
+    @inlineCallbacks
+    def test_get_opted_in_contact_bunches_concurrency(self):
+        contact_store = self.conv.user_api.contact_store
+        contact_store.manager.load_bunch_size = 1
+        group = yield contact_store.new_group(u'a group')
+        self.conv.add_group(group)
+        yield self.conv.save()
+        for i in range(4):
+            yield contact_store.new_contact(
+                msisdn=u'+2700000000%s' % (i,), groups=[group])
+
+        filtered = []
+        orig_filter = self.conv._filter_opted_out_contacts
+
+        def filter_opted_out_contacts(*args, **kw):
+            filtered.append(args)
+            return orig_filter(*args, **kw)
+
+        self.patch(
+            self.conv, '_filter_opted_out_contacts', filter_opted_out_contacts)
+
+        bunches = yield self.conv.get_opted_in_contact_bunches(
+            self.conv.delivery_class, concurrency=3)
+        contacts = []
+        contacts.extend((yield bunches.next()))
+        # The first bunch is only handed over once two more are in flight.
+        self.assertEqual(len(filtered), 3)
+        for bunch in bunches:
+            contacts.extend((yield bunch))
+        self.assertEqual(len(filtered), 4)
+        self.assertEqual(
+            sorted(c.msisdn for c in contacts),
+            [u'+2700000000%s' % (i,) for i in range(4)])
+
     @inlineCallbacks
     def test_get_inbound_throughput(self):
         yield self.conv.start()
@@ -3,7 +3,7 @@
 
 import warnings
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from twisted.internet.defer import returnValue
 
@@ -165,6 +165,14 @@ class ConversationWrapper(object):
                                     user_account_key=self.c.user_account.key,
                                     conversation_key=self.c.key)
 
+    def notify_config_changed(self):
+        """Tell this conversation's application worker that its config has
+        changed so that it discards any cached copy.
+        """
+        return self.dispatch_command('config_changed',
+                                     user_account_key=self.c.user_account.key,
+                                     conversation_key=self.c.key)
+
     @Manager.calls_manager
     def _remove_from_routing_table(self):
         """Remove routing entries for this conversation.
@@ -174,7 +182,7 @@ class ConversationWrapper(object):
         user_account = yield self.c.user_account.get(self.api.manager)
         routing_table = yield self.user_api.get_routing_table(user_account)
         routing_table.remove_conversation(self.c)
-        yield user_account.save()
+        yield self.user_api.save_routing_table(user_account)
 
     @Manager.calls_manager
     def send_token_url(self, token_url, msisdn):
@@ -542,41 +550,70 @@ class ConversationWrapper(object):
         returnValue(count / (sample_time / 60.0))
 
     @Manager.calls_manager
-    def _filter_opted_out_contacts(self, contacts, delivery_class):
+    def _filter_opted_out_contacts(self, contacts, delivery_class,
+                                   opt_out_snapshot=None):
         # TODO: Less hacky address type handling.
         address_type = 'gtalk' if delivery_class == 'gtalk' else 'msisdn'
         contacts = yield contacts
         opt_out_store = OptOutStore(
             self.api.manager, self.user_api.user_account_key)
 
-        filtered_contacts = []
-        for contact in contacts:
-            contact_addr = contact.addr_for(delivery_class)
-            if contact_addr:
-                opt_out = yield opt_out_store.get_opt_out(
-                    address_type, contact_addr)
-                if not opt_out:
-                    filtered_contacts.append(contact)
-        returnValue(filtered_contacts)
+        contacts = [c for c in contacts if c.addr_for(delivery_class)]
+        if opt_out_snapshot is not None:
+            returnValue([
+                contact for contact in contacts
+                if opt_out_store.opt_out_id(
+                    address_type, contact.addr_for(delivery_class))
+                not in opt_out_snapshot])
+
+        opted_out = yield opt_out_store.get_opted_out_addresses(
+            address_type, [c.addr_for(delivery_class) for c in contacts])
+        returnValue([
+            contact for contact in contacts
+            if contact.addr_for(delivery_class) not in opted_out])
 
     @Manager.calls_manager
-    def get_opted_in_contact_bunches(self, delivery_class):
+    def get_opted_in_contact_bunches(self, delivery_class,
+                                     snapshot_opt_outs=False, concurrency=1):
         """
         Get a generator that produces batches the contacts with
         an address attribute that is appropriate for the conversation's
         delivery_class and that are opted in.
+
+        If `snapshot_opt_outs` is ``True``, the keys of all of the account's
+        opt-outs are loaded up front with a single index lookup and every
+        batch is checked against that snapshot instead of looking up opt-outs
+        for each batch. Only the keys are held in memory, so this suits
+        accounts with many opt-outs as well as few, at the cost of not seeing
+        opt-outs made after the send starts.
+
+        Up to `concurrency` bunches are loaded ahead of the one the caller is
+        currently waiting for. Further bunches are only requested as the
+        caller consumes earlier ones, so a slow consumer limits the load we
+        put on Riak.
         """
         contact_store = self.user_api.contact_store
         contact_keys = yield self.get_contact_keys()
         contacts_iter = yield contact_store.contacts.load_all_bunches(
             contact_keys)
 
+        opt_out_snapshot = None
+        if snapshot_opt_outs:
+            opt_out_store = OptOutStore(
+                self.api.manager, self.user_api.user_account_key)
+            opt_out_snapshot = yield opt_out_store.get_opt_out_snapshot()
+
         # We return a generator here. It's important that this is iterated over
         # slowly, otherwise we risk hammering our Riak servers to death.
         def opted_in_contacts_generator():
             # NOTE: This is a generator, *not* an async flattener.
+            in_flight = deque()
             for contacts_bunch in contacts_iter:
-                yield self._filter_opted_out_contacts(
-                    contacts_bunch, delivery_class)
+                in_flight.append(self._filter_opted_out_contacts(
+                    contacts_bunch, delivery_class, opt_out_snapshot))
+                if len(in_flight) >= concurrency:
+                    yield in_flight.popleft()
+            while in_flight:
+                yield in_flight.popleft()
 
         returnValue(opted_in_contacts_generator())
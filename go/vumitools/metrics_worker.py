@@ -1,11 +1,14 @@
 # -*- test-case-name: go.vumitools.tests.test_metrics_worker -*-
 
+import time
+from uuid import uuid4
+
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
 
 from vumi import log
 from vumi.worker import BaseWorker
-from vumi.config import ConfigInt, ConfigError
+from vumi.config import ConfigInt, ConfigText, ConfigError
 from vumi.persist.model import Manager
 
 from go.vumitools.api import VumiApi, VumiApiCommand, ApiCommandPublisher
@@ -18,12 +21,21 @@ class GoMetricsWorkerConfig(BaseWorker.CONFIG_CLASS, GoWorkerConfigMixin):
        into `metrics_interval / metrics_granularity` buckets.
 
        Immediately afterwards and then after each `metrics_granulatiry`
-       interval, the metrics worker sends a `collect_metrics` command to each
-       of the conversations in the current bucket until all buckets have been
-       processed.
+       interval, the metrics worker sends `collect_metrics_batch` commands
+       for the conversations in the current bucket (one for each application
+       worker and up to `metrics_batch_size` conversations) until all buckets
+       have been processed.
 
        Once all buckets have been processed, active conversations are
        collected again and the cycle repeats.
+
+       Active conversations are read from the registry of running
+       conversations maintained by the application workers. Several metrics
+       workers may share the registry, each taking the part of it assigned
+       to its `metrics_worker_id`. When the registry needs rebuilding from
+       Riak, one of the metrics workers does so in the background while
+       metrics continue to be collected for the conversations already in
+       it.
        """
 
     metrics_interval = ConfigInt(
@@ -39,6 +51,18 @@ class GoMetricsWorkerConfig(BaseWorker.CONFIG_CLASS, GoWorkerConfigMixin):
         default=5,
         static=True)
 
+    metrics_batch_size = ConfigInt(
+        "The most conversations to include in a single "
+        "`collect_metrics_batch` command.",
+        default=100,
+        static=True)
+
+    metrics_worker_id = ConfigText(
+        "A unique identifier for this metrics worker, used to split the "
+        "running conversations between metrics workers. A random one is "
+        "generated if this is not set.",
+        static=True)
+
     def post_validate(self):
         if (self.metrics_interval % self.metrics_granularity != 0):
             raise ConfigError("Metrics interval must be an integer multiple"
@@ -76,15 +100,25 @@ class GoMetricsWorker(BaseWorker, GoWorkerMixin):
             config.metrics_interval // config.metrics_granularity)
         self._buckets = dict((i, []) for i in range(self._num_buckets))
         self._conversation_workers = {}
+        self._worker_id = config.metrics_worker_id or uuid4().hex
+        # Workers that haven't sent a heartbeat for two cycles are considered
+        # gone and their conversations are taken over by the rest.
+        self._worker_timeout = 2 * config.metrics_interval
+        self._rebuild_d = None
+        self._stopping = False
 
         self._looper = LoopingCall(self.metrics_loop_func)
         self._looper.start(config.metrics_granularity)
 
     @inlineCallbacks
     def teardown_worker(self):
+        self._stopping = True
         if self._looper.running:
             self._looper.stop()
+        if self._rebuild_d is not None:
+            yield self._rebuild_d
 
+        yield self.vumi_api.running_conversations.leave(self._worker_id)
         yield self.redis.close_manager()
         yield self._go_teardown_worker()
 
@@ -93,33 +127,107 @@ class GoMetricsWorker(BaseWorker, GoWorkerMixin):
 
     @inlineCallbacks
     def populate_conversation_buckets(self):
-        account_keys = yield self.find_account_keys()
+        registry = self.vumi_api.running_conversations
+        complete = yield registry.is_complete()
+        if not complete:
+            self.start_rebuild()
+        worker_ids = yield registry.heartbeat(
+            self._worker_id, time.time(), self._worker_timeout)
+        disabled_keys = yield self.redis.smembers('disabled_metrics_accounts')
+        disabled_keys = set(disabled_keys)
+        account_keys = set()
         num_conversations = 0
+        for slot in registry.slots_for_worker(self._worker_id, worker_ids):
+            convs = yield registry.get_conversations(slot)
+            for account_key, conv_key, worker_name in convs:
+                if account_key in disabled_keys:
+                    continue
+                account_keys.add(account_key)
+                num_conversations += 1
+                bucket = self.bucket_for_conversation(conv_key)
+                self._buckets[bucket].append(
+                    (account_key, conv_key, worker_name))
+        log.info(
+            "Scheduled metrics commands for %d conversations in %d accounts."
+            % (num_conversations, len(account_keys)))
+
+    def start_rebuild(self):
+        """Start rebuilding the registry of running conversations in the
+        background, unless we're already doing so."""
+        if self._rebuild_d is not None:
+            return
+        self._rebuild_d = d = self.rebuild_running_conversations()
+        d.addErrback(log.err, "Error rebuilding running conversations.")
+        d.addBoth(self._rebuild_finished)
+
+    def _rebuild_finished(self, _):
+        self._rebuild_d = None
+
+    @inlineCallbacks
+    def rebuild_running_conversations(self):
+        """Rebuild the registry of running conversations from Riak.
+
+        This picks up conversations that were started before the registry
+        existed or that were changed without an application worker seeing
+        it. Nothing is done if another metrics worker is already rebuilding
+        the registry.
+        """
+        registry = self.vumi_api.running_conversations
+        locked = yield registry.acquire_rebuild_lock()
+        if not locked:
+            return
+        try:
+            previous_entries = yield registry.get_entries()
+            running = yield self.find_running_conversations()
+            if running is not None:
+                yield registry.rebuild(running, previous_entries)
+                log.info(
+                    "Rebuilt running conversations registry with %d "
+                    "conversations." % (len(running),))
+        finally:
+            yield registry.release_rebuild_lock()
+
+    @inlineCallbacks
+    def find_running_conversations(self):
+        """Return the running conversations in enabled accounts as
+        ``(account_key, conversation_key, worker_name)`` tuples, or
+        ``None`` if the worker stopped before they were all found."""
+        account_keys = yield self.find_account_keys()
+        running = []
         # We deliberarely serialise this. We don't want to hit the datastore
         # too hard for metrics.
         for account_key in account_keys:
+            if self._stopping:
+                returnValue(None)
             conv_keys = yield self.find_conversations_for_account(account_key)
-            num_conversations += len(conv_keys)
             for conv_key in conv_keys:
-                bucket = self.bucket_for_conversation(conv_key)
                 if conv_key not in self._conversation_workers:
                     # TODO: Clear out archived conversations
                     user_api = self.vumi_api.get_user_api(account_key)
                     conv = yield user_api.get_wrapped_conversation(conv_key)
                     self._conversation_workers[conv_key] = conv.worker_name
-                worker_name = self._conversation_workers[conv_key]
-                self._buckets[bucket].append(
-                    (account_key, conv_key, worker_name))
-        log.info(
-            "Scheduled metrics commands for %d conversations in %d accounts."
-            % (num_conversations, len(account_keys)))
+                running.append(
+                    (account_key, conv_key,
+                     self._conversation_workers[conv_key]))
+        returnValue(running)
 
     @inlineCallbacks
     def process_bucket(self, bucket):
         convs, self._buckets[bucket] = self._buckets[bucket], []
+        convs_by_worker = {}
         for account_key, conversation_key, worker_name in convs:
-            yield self.send_metrics_command(
-                account_key, conversation_key, worker_name)
+            convs_by_worker.setdefault(worker_name, []).append(
+                (account_key, conversation_key))
+        batch_size = self.get_static_config().metrics_batch_size
+        for worker_name, worker_convs in sorted(convs_by_worker.items()):
+            for i in range(0, len(worker_convs), batch_size):
+                batch = worker_convs[i:i + batch_size]
+                if len(batch) == 1:
+                    [(account_key, conversation_key)] = batch
+                    yield self.send_metrics_command(
+                        account_key, conversation_key, worker_name)
+                else:
+                    yield self.send_metrics_batch_command(batch, worker_name)
 
     def increment_bucket(self):
         self._current_bucket += 1
@@ -152,3 +260,10 @@ class GoMetricsWorker(BaseWorker, GoWorkerMixin):
             conversation_key=conversation_key,
             user_account_key=account_key)
         return self.command_publisher.publish_message(cmd)
+
+    def send_metrics_batch_command(self, conversations, worker_name):
+        cmd = VumiApiCommand.command(
+            worker_name,
+            'collect_metrics_batch',
+            conversations=[list(conv) for conv in conversations])
+        return self.command_publisher.publish_message(cmd)
@@ -44,6 +44,43 @@ class OptOutStore(PerAccountStore):
     def get_opt_out(self, addr_type, addr_value):
         return self.opt_outs.load(self.opt_out_id(addr_type, addr_value))
 
+    @Manager.calls_manager
+    def get_opted_out_addresses(self, addr_type, addr_values):
+        """
+        Return the set of addresses in `addr_values` that have opted out.
+
+        The opt-outs are loaded in bunches rather than one at a time, so this
+        should be used instead of :meth:`get_opt_out` when checking many
+        addresses.
+        """
+        addrs_by_id = dict(
+            (self.opt_out_id(addr_type, addr_value), addr_value)
+            for addr_value in addr_values)
+        opted_out = set()
+        for opt_outs_bunch in self.opt_outs.load_all_bunches(
+                addrs_by_id.keys()):
+            for opt_out in (yield opt_outs_bunch):
+                key = opt_out.key
+                if isinstance(key, unicode):
+                    key = key.encode('utf-8')
+                opted_out.add(addrs_by_id[key])
+        returnValue(opted_out)
+
+    @Manager.calls_manager
+    def get_opt_out_snapshot(self):
+        """
+        Return the set of opt-out ids (see :meth:`opt_out_id`) for all of the
+        account's opt-outs.
+
+        This is a single index lookup, so it's a cheap way to check the
+        opt-out status of every recipient of a large send against the same
+        point-in-time view of the account's opt-outs.
+        """
+        keys = yield self.list_opt_outs()
+        returnValue(set(
+            key.encode('utf-8') if isinstance(key, unicode) else key
+            for key in keys))
+
     @Manager.calls_manager
     def delete_opt_out(self, addr_type, addr_value):
         opt_out = yield self.get_opt_out(addr_type, addr_value)
@@ -60,6 +60,32 @@ class TestOptOutStore(VumiTestCase):
         opt_out = yield self.opt_out_store.get_opt_out("msisdn", "+1234")
         self.assertEqual(opt_out.message, msg['message_id'])
 
+    @inlineCallbacks
+    def test_get_opted_out_addresses(self):
+        store = self.opt_out_store
+        for addr in ["+1234", "+1235"]:
+            yield store.new_opt_out(
+                "msisdn", addr, self.msg_helper.make_inbound("inbound"))
+        opted_out = yield store.get_opted_out_addresses(
+            "msisdn", ["+1234", "+1235", "+1236"])
+        self.assertEqual(opted_out, set(["+1234", "+1235"]))
+
+    @inlineCallbacks
+    def test_get_opted_out_addresses_empty(self):
+        opted_out = yield self.opt_out_store.get_opted_out_addresses(
+            "msisdn", [])
+        self.assertEqual(opted_out, set())
+
+    @inlineCallbacks
+    def test_get_opt_out_snapshot(self):
+        store = self.opt_out_store
+        self.assertEqual((yield store.get_opt_out_snapshot()), set())
+        yield store.new_opt_out(
+            "msisdn", "+1234", self.msg_helper.make_inbound("inbound"))
+        self.assertEqual(
+            (yield store.get_opt_out_snapshot()),
+            set([store.opt_out_id("msisdn", "+1234")]))
+
     @inlineCallbacks
     def test_delete_opt_out(self):
         store = self.opt_out_store
@@ -3,11 +3,14 @@
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.dispatchers.endpoint_dispatchers import RoutingTableDispatcher
-from vumi.config import ConfigDict, ConfigText
+from vumi.blinkenlights.metrics import MetricManager, Count
+from vumi.config import (
+    ConfigDict, ConfigText, ConfigInt, ConfigFloat, ConfigField)
 from vumi.message import TransportEvent
 from vumi import log
 
 from go.vumitools.app_worker import GoWorkerMixin, GoWorkerConfigMixin
+from go.vumitools.cache import LRUCache, OutboundRoutingMetadataCache
 from go.vumitools.routing_table import GoConnector
 
 
@@ -189,6 +192,10 @@ class RoutingMetadata(object):
         return (dst == outbound_dst and src == outbound_src)
 
 
+class ConfigCompiledRoutingTable(ConfigField):
+    pass
+
+
 class AccountRoutingTableDispatcherConfig(RoutingTableDispatcher.CONFIG_CLASS,
                                           GoWorkerConfigMixin):
     application_connector_mapping = ConfigDict(
@@ -213,12 +220,37 @@ class AccountRoutingTableDispatcherConfig(RoutingTableDispatcher.CONFIG_CLASS,
         static=True, required=False)
     user_account_key = ConfigText(
         "Key of the user account the message is from.")
+    compiled_routing_table = ConfigCompiledRoutingTable(
+        "Compiled routing table for the user account the message is from.",
+        required=False)
     default_unroutable_inbound_reply = ConfigText(
         "Default text to send in response to unroutable inbound messages"
         " if the tagpool specifies `reply_to_unroutable_inbound` but not"
         " `unroutable_inbound_reply`.",
         default="Vumi Go could not route your message. Please try again soon.",
         static=True, required=False)
+    metrics_prefix = ConfigText(
+        "Prefix for metrics published by this dispatcher. Defaults to the"
+        " worker name.",
+        static=True, required=False)
+    routing_table_cache_size = ConfigInt(
+        "Maximum number of account routing tables to cache.",
+        default=1000, static=True, required=False)
+    tag_cache_size = ConfigInt(
+        "Maximum number of tag to account mappings to cache.",
+        default=10000, static=True, required=False)
+    routing_cache_ttl = ConfigFloat(
+        "Number of seconds cached routing tables and tag to account mappings"
+        " may be used for before being reloaded. Cached entries are discarded"
+        " sooner if the account's routing table changes. Set to zero to"
+        " disable caching.",
+        default=300, static=True, required=False)
+    outbound_metadata_ttl = ConfigInt(
+        "Number of seconds to keep the routing metadata of outbound messages"
+        " sent to transports in Redis for routing their events. Events for"
+        " older messages fall back to loading the message from the message"
+        " store. Set to zero to disable.",
+        default=60 * 60 * 24, static=True, required=False)
 
 
 class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
@@ -320,9 +352,32 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             config.receive_inbound_connectors)
         self.transport_connectors.discard(
             self.router_connectors)
+        self._setup_routing_caches(config)
+        self.outbound_metadata_cache = None
+        if config.outbound_metadata_ttl:
+            self.outbound_metadata_cache = OutboundRoutingMetadataCache(
+                self.redis.sub_manager('outbound_routing_metadata'),
+                config.outbound_metadata_ttl)
+
+    def _setup_routing_caches(self, config):
+        self.routing_table_cache = LRUCache(
+            config.routing_table_cache_size, config.routing_cache_ttl)
+        self.tag_cache = LRUCache(
+            config.tag_cache_size, config.routing_cache_ttl)
+        metrics_prefix = config.metrics_prefix or self.worker_name
+        self.metrics = MetricManager(
+            metrics_prefix + '.', publisher=self.metric_publisher)
+        for name in ['routing_table_cache', 'tag_cache']:
+            self.metrics.register(Count('%s.hits' % (name,)))
+            self.metrics.register(Count('%s.misses' % (name,)))
+        self.metrics.start_polling()
+
+    def _count_cache_lookup(self, name, hit):
+        self.metrics['%s.%s' % (name, 'hits' if hit else 'misses')].inc()
 
     @inlineCallbacks
     def teardown_dispatcher(self):
+        self.metrics.stop_polling()
         yield self._go_teardown_worker()
         yield super(AccountRoutingTableDispatcher, self).teardown_dispatcher()
 
@@ -348,9 +403,10 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
         if msg_mdh.has_user_account():
             user_account_key = msg_mdh.get_account_key()
+            version = yield self.get_routing_table_version(user_account_key)
         elif msg_mdh.tag is not None:
-            tag_info = yield msg_mdh.get_tag_info()
-            user_account_key = tag_info.metadata['user_account']
+            user_account_key, version = yield self.get_account_for_tag(
+                msg_mdh)
             if user_account_key is None:
                 raise UnownedTagError(
                     "Message received for unowned tag.", msg)
@@ -358,15 +414,102 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             raise UnroutableMessageError(
                 "No user account key or tag on message", msg)
 
-        user_api = self.get_user_api(user_account_key)
-        routing_table = yield user_api.get_routing_table()
+        routing_table = yield self.get_routing_table(
+            user_account_key, version)
 
         config_dict = self.config.copy()
         config_dict['user_account_key'] = user_account_key
         config_dict['routing_table'] = routing_table._routing_table
+        config_dict['compiled_routing_table'] = routing_table.compiled()
 
         returnValue(self.CONFIG_CLASS(config_dict))
 
+    def get_routing_table_version(self, user_account_key):
+        return self.vumi_api.routing_table_versions.get_version(
+            user_account_key)
+
+    @inlineCallbacks
+    def get_account_for_tag(self, msg_mdh):
+        """Determine the user account that owns the tag on a message.
+
+        Returns a tuple of the user account key (or ``None`` if the tag is not
+        owned by an account) and the account's current routing table version.
+
+        Tag ownership only changes when a tag is released, which also modifies
+        (and thus bumps the version of) the owning account's routing table, so
+        cached tag owners are only used while that version is unchanged.
+        """
+        tag = tuple(msg_mdh.tag)
+        cached = self.tag_cache.get(tag)
+        if cached is not None:
+            user_account_key, cached_version = cached
+            version = yield self.get_routing_table_version(user_account_key)
+            if version == cached_version:
+                self._count_cache_lookup('tag_cache', hit=True)
+                returnValue((user_account_key, version))
+            self.tag_cache.pop(tag)
+        self._count_cache_lookup('tag_cache', hit=False)
+
+        tag_info = yield msg_mdh.get_tag_info()
+        user_account_key = tag_info.metadata['user_account']
+        if user_account_key is None:
+            # We don't cache unowned tags so that newly acquired tags are
+            # routed immediately.
+            returnValue((None, None))
+        version = yield self.get_routing_table_version(user_account_key)
+        self.tag_cache.set(tag, (user_account_key, version))
+        returnValue((user_account_key, version))
+
+    @inlineCallbacks
+    def get_routing_table(self, user_account_key, version):
+        """Return the routing table for an account, using a cached copy if
+        it is still at the given `version`.
+        """
+        cached = self.routing_table_cache.get(user_account_key)
+        if cached is not None:
+            cached_version, routing_table = cached
+            if version == cached_version:
+                self._count_cache_lookup('routing_table_cache', hit=True)
+                returnValue(routing_table)
+            self.routing_table_cache.pop(user_account_key)
+        self._count_cache_lookup('routing_table_cache', hit=False)
+
+        user_api = self.get_user_api(user_account_key)
+        routing_table = yield user_api.get_routing_table()
+        # Build the compiled index once for each cached routing table version.
+        routing_table.compiled()
+        self.routing_table_cache.set(
+            user_account_key, (version, routing_table))
+        returnValue(routing_table)
+
+    def process_command_invalidate_routing_table(self, user_account_key):
+        """Discard any cached routing table for the given account.
+
+        Useful if a routing table has been modified without bumping its
+        version.
+        """
+        log.info("Invalidating cached routing table for account '%s'." % (
+            user_account_key,))
+        self.routing_table_cache.pop(user_account_key)
+
+    def find_target(self, config, msg, connector_name):
+        """Look up the target for a message in the compiled routing table.
+
+        The connector in the returned `[connector, endpoint]` pair is the
+        compiled table's shared :class:`GoConnector`, so it doesn't need to
+        be parsed again.
+        """
+        compiled = config.compiled_routing_table
+        if compiled is None:
+            return super(AccountRoutingTableDispatcher, self).find_target(
+                config, msg, connector_name)
+        endpoint_name = msg.get_routing_endpoint()
+        target = compiled.lookup_target(connector_name, endpoint_name)
+        if target is None:
+            log.warning("No routing information for endpoint '%s' on '%s'" % (
+                endpoint_name, connector_name))
+        return target
+
     def connector_type(self, connector_name):
         if connector_name in self.billing_connectors:
             return self.BILLING
@@ -409,13 +552,17 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         the corresponding dispatcher connector to publish on. Set any
         appropriate Go helper_metadata required by the destination.
 
+        The target connector may also be an already parsed `GoConnector`.
+
         Raises `UnroutableMessageError` if the parsed `GoConnector` has a
         connector type not approriate to the message direction.
 
         Note: `str(go_connector)` is what is stored in Go routing tables.
         """
         msg_mdh = self.get_metadata_helper(msg)
-        conn = GoConnector.parse(target[0])
+        conn = target[0]
+        if not isinstance(conn, GoConnector):
+            conn = GoConnector.parse(conn)
 
         if direction == self.INBOUND:
             allowed_types = (
@@ -540,6 +687,34 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             rmeta.push_source(src_conn_str, msg.get_routing_endpoint())
         return src_conn_str
 
+    def outbound_routing_metadata(self, msg):
+        """Return the parts of an outbound message's metadata that are needed
+        to route its events.
+        """
+        msg_mdh = self.get_metadata_helper(msg)
+        msg_rmeta = RoutingMetadata(msg)
+        user_account_key = None
+        if msg_mdh.has_user_account():
+            user_account_key = msg_mdh.get_account_key()
+        return {
+            'hops': msg_rmeta.get_hops(),
+            'is_reply_to_unroutable': msg_rmeta.get_unroutable_reply(),
+            'tag': msg_mdh.tag,
+            'user_account': user_account_key,
+        }
+
+    @inlineCallbacks
+    def publish_outbound(self, msg, connector_name, endpoint):
+        """Publish an outbound message, caching its routing metadata for its
+        events first if it is going to a transport.
+        """
+        if (self.outbound_metadata_cache is not None and
+                self.connector_type(connector_name) == self.TRANSPORT_TAG):
+            yield self.outbound_metadata_cache.set(
+                msg['message_id'], self.outbound_routing_metadata(msg))
+        yield super(AccountRoutingTableDispatcher, self).publish_outbound(
+            msg, connector_name, endpoint)
+
     @inlineCallbacks
     def publish_inbound_optout(self, config, msg):
         """Publish an inbound opt-out request to the opt-out worker."""
@@ -750,7 +925,9 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
                     connector_name, msg), msg)
 
         if self.billing_outbound_connector:
-            target_conn = GoConnector.parse(target[0])
+            target_conn = target[0]
+            if not isinstance(target_conn, GoConnector):
+                target_conn = GoConnector.parse(target_conn)
             if target_conn.ctype == target_conn.TRANSPORT_TAG:
                 tag = [target_conn.tagpool, target_conn.tagname]
                 yield self.publish_outbound_to_billing(config, msg, tag)
@@ -777,40 +954,66 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
                 and event_mdh.tag is not None):
             return
 
-        # some metadata is missing, grab the associated outbound message
-        # and look for it there:
+        # some metadata is missing, grab the associated outbound message's
+        # routing metadata and look for it there:
 
-        msg = yield self.find_message_for_event(event)
-        if msg is None:
+        msg_desc, msg_metadata = yield self.find_outbound_routing_metadata(
+            event)
+        if msg_metadata is None:
             raise UnroutableMessageError(
                 "Could not find transport user message for event", event)
-        msg_mdh = self.get_metadata_helper(msg)
-        msg_rmeta = RoutingMetadata(msg)
-        msg_unroutable = msg_rmeta.get_unroutable_reply()
+        msg_unroutable = msg_metadata['is_reply_to_unroutable']
 
-        msg_hops = msg_rmeta.get_hops()
+        msg_hops = msg_metadata['hops']
         event_rmeta.set_outbound_hops(msg_hops)
 
         if msg_unroutable:
             event_rmeta.set_unroutable_reply()
 
-        if msg_mdh.tag is None:
+        if msg_metadata['tag'] is None:
             raise UnroutableMessageError(
-                "Outbound message for event has no tag set: %r" % (msg,),
+                "Outbound message for event has no tag set: %s" % (msg_desc,),
                 event)
         # set the tag on the event so that if it is from a transport
         # we can set the source of the message correctly in acquire_source.
-        event_mdh.set_tag(msg_mdh.tag)
+        event_mdh.set_tag(msg_metadata['tag'])
 
         if not msg_unroutable or msg_hops:
             # unroutable replies without hops were never associated with a
             # user account and so aren't required to have one. All other
             # messages must.
-            if not msg_mdh.has_user_account():
+            if msg_metadata['user_account'] is None:
                 raise UnroutableMessageError(
                     "Outbound message for event has no associated"
-                    " user account: %r" % (msg,), event)
-            event_mdh.set_user_account(msg_mdh.get_account_key())
+                    " user account: %s" % (msg_desc,), event)
+            event_mdh.set_user_account(msg_metadata['user_account'])
+
+    @inlineCallbacks
+    def find_outbound_routing_metadata(self, event):
+        """Find the routing metadata of the outbound message for an event.
+
+        The metadata cached when the outbound message was published is used
+        if it is available, otherwise the outbound message is loaded from the
+        message store.
+
+        Returns a tuple of a description of the outbound message for error
+        messages and the metadata (or ``None`` if it could not be found).
+        """
+        user_message_id = event.get('user_message_id')
+        if (self.outbound_metadata_cache is not None
+                and user_message_id is not None):
+            msg_metadata = yield self.outbound_metadata_cache.get(
+                user_message_id)
+            if msg_metadata is not None:
+                returnValue((
+                    "<cached routing metadata for message %r>" % (
+                        user_message_id,),
+                    msg_metadata))
+
+        msg = yield self.find_message_for_event(event)
+        if msg is None:
+            returnValue((None, None))
+        returnValue((msg, self.outbound_routing_metadata(msg)))
 
     @inlineCallbacks
     def process_event(self, config, event, connector_name):
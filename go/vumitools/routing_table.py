@@ -160,6 +160,125 @@ def _to_conn(conn):
     return conn
 
 
+class CompiledRoutingTable(object):
+    """Immutable, indexed representation of a routing table dictionary.
+
+    Built once per version of a routing table (see
+    :meth:`RoutingTable.compiled`) so that lookups in either direction don't
+    need to scan every entry or re-parse connector strings:
+
+    * each distinct connector string is parsed into a single shared
+      :class:`GoConnector`,
+    * forward and reverse adjacency indexes are keyed on connector strings,
+    * transitive closures are computed on first use and remembered.
+
+    :param dict routing_table:
+        The nested routing table dictionary. It is not modified or retained.
+    """
+
+    def __init__(self, routing_table):
+        self._connectors = {}
+        self._entries = []
+        # src_conn_str -> {src_endpoint: (dst_conn, dst_endpoint)}
+        self._forward = {}
+        # dst_conn_str -> [(dst_endpoint, src_conn, src_endpoint), ...]
+        self._reverse = {}
+        self._transitive_targets = {}
+        self._transitive_sources = {}
+
+        for src_str, endpoints in routing_table.iteritems():
+            src_conn = self.connector(src_str)
+            forward = self._forward.setdefault(str(src_conn), {})
+            for src_endp, (dst_str, dst_endp) in endpoints.iteritems():
+                dst_conn = self.connector(dst_str)
+                self._entries.append((src_conn, src_endp, dst_conn, dst_endp))
+                forward[src_endp] = (dst_conn, dst_endp)
+                self._reverse.setdefault(str(dst_conn), []).append(
+                    (dst_endp, src_conn, src_endp))
+
+    def connector(self, conn):
+        """Return the shared :class:`GoConnector` for `conn`.
+
+        :param conn: a connector string or :class:`GoConnector`.
+        """
+        conn_str = str(conn)
+        go_conn = self._connectors.get(conn_str)
+        if go_conn is None:
+            go_conn = _to_conn(conn)
+            self._connectors[conn_str] = go_conn
+        return go_conn
+
+    def entries(self):
+        """Return a list of (src_conn, src_endpoint, dst_conn, dst_endpoint)
+        tuples.
+        """
+        return list(self._entries)
+
+    def lookup_target(self, src_conn, src_endpoint):
+        target = self._forward.get(str(src_conn), {}).get(src_endpoint)
+        if target is not None:
+            target = list(target)
+        return target
+
+    def lookup_targets(self, src_conn):
+        return [
+            (src_endp, [dst_conn, dst_endp])
+            for src_endp, (dst_conn, dst_endp)
+            in self._forward.get(str(src_conn), {}).iteritems()]
+
+    def lookup_source(self, target_conn, target_endpoint):
+        for dst_endp, src_conn, src_endp in self._reverse.get(
+                str(target_conn), []):
+            if dst_endp == target_endpoint:
+                return [src_conn, src_endp]
+        return None
+
+    def lookup_sources(self, target_conn):
+        return [
+            (dst_endp, [src_conn, src_endp])
+            for dst_endp, src_conn, src_endp
+            in self._reverse.get(str(target_conn), [])]
+
+    def _transitive_search(self, start_conn, lookup):
+        start_conn = self.connector(start_conn)
+        pending = [start_conn]
+        seen = set([str(start_conn)])
+        results = set()
+        while pending:
+            conn = pending.pop()
+            for _endp, (found_conn, _found_endp) in lookup(conn):
+                results.add(found_conn)
+                if found_conn.ctype != GoConnector.ROUTER:
+                    continue
+                other_side = self.connector(found_conn.flip_direction())
+                if str(other_side) not in seen:
+                    pending.append(other_side)
+                    seen.add(str(other_side))
+        return frozenset(results)
+
+    def transitive_targets(self, src_conn):
+        """Return the set of connectors reachable from `src_conn`.
+
+        See :meth:`RoutingTable.transitive_targets`.
+        """
+        key = str(src_conn)
+        if key not in self._transitive_targets:
+            self._transitive_targets[key] = self._transitive_search(
+                src_conn, self.lookup_targets)
+        return set(self._transitive_targets[key])
+
+    def transitive_sources(self, dst_conn):
+        """Return the set of connectors that lead to `dst_conn`.
+
+        See :meth:`RoutingTable.transitive_sources`.
+        """
+        key = str(dst_conn)
+        if key not in self._transitive_sources:
+            self._transitive_sources[key] = self._transitive_search(
+                dst_conn, self.lookup_sources)
+        return set(self._transitive_sources[key])
+
+
 class RoutingTable(object):
     """Interface to routing table dictionaries.
 
@@ -180,6 +299,7 @@ class RoutingTable(object):
         if routing_table is None:
             routing_table = {}
         self._routing_table = routing_table
+        self._compiled = None
 
     def __eq__(self, other):
         if not isinstance(other, RoutingTable):
@@ -189,44 +309,39 @@ class RoutingTable(object):
     def __nonzero__(self):
         return bool(self._routing_table)
 
+    def compiled(self):
+        """Return the :class:`CompiledRoutingTable` for the current entries.
+
+        The compiled table is built on first use and shared until the routing
+        table is next modified.
+        """
+        if self._compiled is None:
+            self._compiled = CompiledRoutingTable(self._routing_table)
+        return self._compiled
+
+    def _modified(self):
+        self._compiled = None
+
     def lookup_target(self, src_conn, src_endpoint):
-        target = self._routing_table.get(str(src_conn), {}).get(src_endpoint)
-        if target is not None:
-            conn, ep = target
-            target = [_to_conn(conn), ep]
-        return target
+        return self.compiled().lookup_target(src_conn, src_endpoint)
 
     def lookup_targets(self, src_conn):
-        targets = []
-        for ep, dst in self._routing_table.get(str(src_conn), {}).iteritems():
-            dst_str, dst_ep = dst
-            targets.append((ep, [_to_conn(dst_str), dst_ep]))
-        return targets
+        return self.compiled().lookup_targets(src_conn)
 
     def lookup_source(self, target_conn, target_endpoint):
         target_conn = _to_conn(target_conn)
-        for src_conn, src_endpoint, dst_conn, dst_endpoint in self.entries():
-            if dst_conn == target_conn and dst_endpoint == target_endpoint:
-                return [src_conn, src_endpoint]
-        return None
+        return self.compiled().lookup_source(target_conn, target_endpoint)
 
     def lookup_sources(self, target_conn):
         target_conn = _to_conn(target_conn)
-        sources = []
-        for src_conn, src_endpoint, dst_conn, dst_endpoint in self.entries():
-            if dst_conn == target_conn:
-                sources.append((dst_endpoint, [src_conn, src_endpoint]))
-        return sources
+        return self.compiled().lookup_sources(target_conn)
 
     def entries(self):
         """Iterate over entries in the routing table.
 
         Yield tuples of (src_conn, src_endpoint, dst_conn, dst_endpoint).
         """
-        for src_conn, endpoints in self._routing_table.iteritems():
-            for src_endp, (dst_conn, dst_endp) in endpoints.iteritems():
-                yield (
-                    _to_conn(src_conn), src_endp, _to_conn(dst_conn), dst_endp)
+        return iter(self.compiled().entries())
 
     def add_entry(self, src_conn, src_endpoint, dst_conn, dst_endpoint):
         src_conn = _to_conn(src_conn)
@@ -239,6 +354,7 @@ class RoutingTable(object):
                     str(src_conn), src_endpoint, connector_dict[src_endpoint],
                     [str(dst_conn), dst_endpoint]))
         connector_dict[src_endpoint] = [str(dst_conn), dst_endpoint]
+        self._modified()
 
     def remove_entry(self, src_conn, src_endpoint):
         src_conn = _to_conn(src_conn)
@@ -251,6 +367,7 @@ class RoutingTable(object):
             return None
 
         old_dest = connector_dict.pop(src_endpoint)
+        self._modified()
 
         if not connector_dict:
             # This is the last entry for this connector
@@ -264,6 +381,7 @@ class RoutingTable(object):
         Useful when the connector is going away for some reason.
         """
         conn = _to_conn(conn)
+        self._modified()
         # remove entries with connector as source
         self._routing_table.pop(str(conn), None)
 
@@ -326,22 +444,7 @@ class RoutingTable(object):
         :param str src_conn: source connector to start search with.
         :rtype: set of destination connector strings.
         """
-        src_conn = _to_conn(src_conn)
-        sources = [src_conn]
-        sources_seen = set(sources)
-        results = set()
-        while sources:
-            source = sources.pop()
-            destinations = self.lookup_targets(source)
-            for _src_endpoint, (dst_conn, _dst_endpoint) in destinations:
-                results.add(dst_conn)
-                if dst_conn.ctype != GoConnector.ROUTER:
-                    continue
-                extra_src = str(dst_conn.flip_direction())
-                if extra_src not in sources_seen:
-                    sources.append(extra_src)
-                    sources_seen.add(extra_src)
-        return results
+        return self.compiled().transitive_targets(_to_conn(src_conn))
 
     def transitive_sources(self, dst_conn):
         """Return all connectors that lead to `dst_conn`.
@@ -363,22 +466,7 @@ class RoutingTable(object):
         :param str dst_conn: destination connector to start search with.
         :rtype: set of source connector strings.
         """
-        dst_conn = _to_conn(dst_conn)
-        destinations = [dst_conn]
-        destinations_seen = set(destinations)
-        results = set()
-        while destinations:
-            destination = destinations.pop()
-            sources = self.lookup_sources(destination)
-            for _dst_endpoint, (src_conn, _src_endpoint) in sources:
-                results.add(src_conn)
-                if src_conn.ctype != GoConnector.ROUTER:
-                    continue
-                extra_dst = str(src_conn.flip_direction())
-                if extra_dst not in destinations_seen:
-                    destinations.append(extra_dst)
-                    destinations_seen.add(extra_dst)
-        return results
+        return self.compiled().transitive_sources(_to_conn(dst_conn))
 
     def validate_entry(self, src_conn, src_endpoint, dst_conn, dst_endpoint):
         """Validate the provided entry.
@@ -397,6 +485,11 @@ class RoutingTable(object):
 
     def validate_all_entries(self):
         """Validates all entries in the routing table.
+
+        This recompiles the routing table (in case the underlying dictionary
+        has been modified directly) and the result is shared by subsequent
+        lookups.
         """
-        for entry in self.entries():
+        self._compiled = CompiledRoutingTable(self._routing_table)
+        for entry in self._compiled.entries():
             self.validate_entry(*entry)
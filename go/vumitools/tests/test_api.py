@@ -231,6 +231,34 @@ class TestTxVumiUserApi(VumiTestCase):
         self.assertEqual(
             RoutingTable(), (yield self.user_api.get_routing_table()))
 
+    @inlineCallbacks
+    def test_release_tag_bumps_routing_table_version(self):
+        [tag1] = yield self.vumi_helper.setup_tagpool(u"pool1", [u"1234"])
+        yield self.user_helper.add_tagpool_permission(u"pool1")
+        yield self.user_api.acquire_specific_tag(tag1)
+        versions = self.vumi_api.routing_table_versions
+        version = yield versions.get_version(self.user_api.user_account_key)
+        yield self.user_api.release_tag(tag1)
+        self.assertNotEqual(
+            version,
+            (yield versions.get_version(self.user_api.user_account_key)))
+
+    @inlineCallbacks
+    def test_save_routing_table(self):
+        user = yield self.user_api.get_user_account()
+        routing_table = RoutingTable()
+        routing_table.add_entry(
+            u"TRANSPORT_TAG:pool1:1234", u"default",
+            u"CONVERSATION:bulk_message:conv1", u"default")
+        user.routing_table = routing_table
+        versions = self.vumi_api.routing_table_versions
+        self.assertEqual(
+            None, (yield versions.get_version(user.key)))
+        yield self.user_api.save_routing_table(user)
+        self.assertEqual(
+            routing_table, (yield self.user_api.get_routing_table()))
+        self.assertEqual(1, (yield versions.get_version(user.key)))
+
     @inlineCallbacks
     def test_get_empty_routing_table(self):
         routing_table = yield self.user_api.get_routing_table()
@@ -475,6 +503,18 @@ class TestTxVumiRouterApi(VumiTestCase):
             'router_key': router.key,
         })
 
+    @inlineCallbacks
+    def test_notify_config_changed(self):
+        router = yield self.create_router(status=u'running')
+        router_api = yield self.get_router_api(router)
+        yield router_api.notify_config_changed()
+        [cmd] = self.vumi_helper.get_dispatched_commands()
+        self.assertEqual(cmd['command'], 'config_changed')
+        self.assertEqual(cmd['kwargs'], {
+            'user_account_key': router.user_account.key,
+            'router_key': router.key,
+        })
+
 
 class TestVumiRouterApi(TestTxVumiRouterApi):
     is_sync = True
@@ -97,6 +97,84 @@ class TestGoApplicationWorker(VumiTestCase):
         ack = yield self.app_helper.make_dispatch_ack(conv=self.conv)
         self.assertEqual([ack], self.app.events)
 
+    @inlineCallbacks
+    def test_message_config_cached(self):
+        yield self.app_helper.start_conversation(self.conv)
+        cache_key = (self.conv.user_account.key, self.conv.key)
+        self.assertFalse(cache_key in self.app.conversation_cache)
+        msg = yield self.app_helper.make_dispatch_inbound(
+            "inbound", conv=self.conv)
+        self.assertTrue(cache_key in self.app.conversation_cache)
+
+        config = yield self.app.get_message_config(msg)
+        self.assertEqual(config, self.app.conversation_cache.get(cache_key))
+
+    @inlineCallbacks
+    def test_message_config_cache_disabled(self):
+        app = yield self.app_helper.get_app_worker({
+            'conversation_cache_ttl': 0,
+        })
+        yield self.app_helper.start_conversation(self.conv)
+        yield self.app_helper.make_dispatch_inbound("inbound", conv=self.conv)
+        self.assertEqual(len(app.conversation_cache), 0)
+
+    @inlineCallbacks
+    def test_stopped_conversation_not_cached(self):
+        yield self.app_helper.make_dispatch_inbound("inbound", conv=self.conv)
+        self.assertEqual(len(self.app.conversation_cache), 0)
+
+    @inlineCallbacks
+    def test_stop_invalidates_cached_config(self):
+        yield self.app_helper.start_conversation(self.conv)
+        msg = yield self.app_helper.make_dispatch_inbound(
+            "inbound", conv=self.conv)
+        yield self.app_helper.stop_conversation(self.conv)
+        self.assertEqual(len(self.app.conversation_cache), 0)
+        yield self.app_helper.make_dispatch_inbound("inbound", conv=self.conv)
+        self.assertEqual([msg], self.app.msgs)
+
+    @inlineCallbacks
+    def test_start_and_stop_update_running_conversations(self):
+        registry = self.app.vumi_api.running_conversations
+        slot = registry.slot_for_conversation(self.conv.key)
+        entry = (
+            self.conv.user_account.key, self.conv.key, self.conv.worker_name)
+
+        yield self.app_helper.start_conversation(self.conv)
+        convs = yield registry.get_conversations(slot)
+        self.assertTrue(entry in convs)
+
+        yield self.app_helper.stop_conversation(self.conv)
+        convs = yield registry.get_conversations(slot)
+        self.assertFalse(entry in convs)
+
+    @inlineCallbacks
+    def test_config_changed_invalidates_cached_config(self):
+        yield self.app_helper.start_conversation(self.conv)
+        yield self.app_helper.make_dispatch_inbound("inbound", conv=self.conv)
+        self.conv.c.config = {'foo': 'bar'}
+        yield self.conv.save()
+        yield self.conv.notify_config_changed()
+        yield self.app_helper.dispatch_commands_to_app()
+        self.assertEqual(len(self.app.conversation_cache), 0)
+
+        msg = yield self.app_helper.make_dispatch_inbound(
+            "inbound", conv=self.conv)
+        config = yield self.app.get_message_config(msg)
+        self.assertEqual(config.conversation.config, {'foo': 'bar'})
+
+    def test_get_contact_load_concurrency_default(self):
+        self.assertEqual(self.app.get_contact_load_concurrency(u'acc'), 1)
+
+    @inlineCallbacks
+    def test_get_contact_load_concurrency(self):
+        app = yield self.app_helper.get_app_worker({
+            'contact_load_concurrency': 3,
+            'account_contact_load_concurrency': {u'big-acc': 10},
+        })
+        self.assertEqual(app.get_contact_load_concurrency(u'acc'), 3)
+        self.assertEqual(app.get_contact_load_concurrency(u'big-acc'), 10)
+
     @inlineCallbacks
     def test_collect_metrics(self):
         yield self.app_helper.start_conversation(self.conv)
@@ -114,6 +192,68 @@ class TestGoApplicationWorker(VumiTestCase):
             self.app_helper.get_published_metrics(self.app),
             [("%s.dummy_metric" % prefix, 42)])
 
+    @inlineCallbacks
+    def test_collect_metrics_batch(self):
+        conv2 = yield self.app_helper.create_conversation()
+        yield self.app_helper.start_conversation(self.conv)
+        yield self.app_helper.start_conversation(conv2)
+        acc_key = self.conv.user_account.key
+
+        yield self.app_helper.dispatch_command(
+            'collect_metrics_batch',
+            conversations=[[acc_key, self.conv.key], [acc_key, conv2.key]])
+
+        # All the metrics are published in a single message.
+        [metric_msg] = self.app_helper.worker_helper.get_dispatched_metrics()
+        prefix = "go.campaigns.test-0-user.conversations.%s"
+        self.assertEqual(
+            sorted(self.app_helper.get_published_metrics(self.app)),
+            sorted([
+                ("%s.dummy_metric" % (prefix % self.conv.key,), 42),
+                ("%s.dummy_metric" % (prefix % conv2.key,), 42),
+            ]))
+        self.assertEqual(self.app._metrics_conversations, set())
+
+    @inlineCallbacks
+    def test_collect_metrics_batch_bad_conversation(self):
+        conv2 = yield self.app_helper.create_conversation()
+        yield self.app_helper.start_conversation(self.conv)
+        yield self.app_helper.start_conversation(conv2)
+        acc_key = self.conv.user_account.key
+
+        def get_conversation_definition(conv_type, conv):
+            if conv.key == conv2.key:
+                raise ValueError("Bad conversation")
+            return DummyConversationDefinition(conv)
+
+        self.patch(
+            app_worker, 'get_conversation_definition',
+            get_conversation_definition)
+
+        yield self.app_helper.dispatch_command(
+            'collect_metrics_batch',
+            conversations=[[acc_key, self.conv.key], [acc_key, conv2.key]])
+
+        # The other conversation's metrics are still published.
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        prefix = "go.campaigns.test-0-user.conversations.%s" % self.conv.key
+        self.assertEqual(
+            self.app_helper.get_published_metrics(self.app),
+            [("%s.dummy_metric" % prefix, 42)])
+
+    @inlineCallbacks
+    def test_collect_metrics_batch_skips_running_collections(self):
+        yield self.app_helper.start_conversation(self.conv)
+        acc_key = self.conv.user_account.key
+        self.app._metrics_conversations.add((self.conv.key, acc_key))
+
+        with LogCatcher(message='Ignoring') as lc:
+            yield self.app_helper.dispatch_command(
+                'collect_metrics_batch',
+                conversations=[[acc_key, self.conv.key]])
+            self.assertEqual(len(lc.messages()), 1)
+        self.assertEqual(self.app_helper.get_published_metrics(self.app), [])
+
     @inlineCallbacks
     def test_conversation_metric_publishing(self):
         yield self.app_helper.start_conversation(self.conv)
@@ -194,6 +334,17 @@ class TestGoRouterWorker(VumiTestCase):
         ])
         yield self.assert_status('stopped')
 
+    @inlineCallbacks
+    def test_stop_invalidates_cached_config(self):
+        yield self.rtr_helper.start_router(self.router)
+        cache_key = (self.router.user_account.key, self.router.key)
+        msg = self.rtr_helper.make_inbound("foo", router=self.router)
+        yield self.rtr_worker.get_message_config(msg)
+        self.assertTrue(cache_key in self.rtr_worker.router_cache)
+
+        yield self.rtr_helper.stop_router(self.router)
+        self.assertFalse(cache_key in self.rtr_worker.router_cache)
+
     @inlineCallbacks
     def test_handle_event(self):
         yield self.rtr_helper.start_router(self.router)
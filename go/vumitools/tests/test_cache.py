@@ -0,0 +1,138 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.vumitools.cache import (
+    LRUCache, RoutingTableVersionStore, OutboundRoutingMetadataCache)
+
+
+class TestLRUCache(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def mk_cache(self, max_size=3, ttl=None):
+        return LRUCache(max_size, ttl, clock=self.clock)
+
+    def test_get_missing(self):
+        cache = self.mk_cache()
+        self.assertEqual(cache.get("foo"), None)
+        self.assertEqual(cache.get("foo", "default"), "default")
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_set_and_get(self):
+        cache = self.mk_cache()
+        cache.set("foo", "bar")
+        self.assertEqual(cache.get("foo"), "bar")
+        self.assertTrue("foo" in cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_evicts_least_recently_used(self):
+        cache = self.mk_cache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_entries_expire(self):
+        cache = self.mk_cache(ttl=10)
+        cache.set("foo", "bar")
+        self.clock.advance(9)
+        self.assertEqual(cache.get("foo"), "bar")
+        self.clock.advance(1)
+        self.assertEqual(cache.get("foo"), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_set_refreshes_expiry(self):
+        cache = self.mk_cache(ttl=10)
+        cache.set("foo", "bar")
+        self.clock.advance(5)
+        cache.set("foo", "baz")
+        self.clock.advance(9)
+        self.assertEqual(cache.get("foo"), "baz")
+
+    def test_zero_ttl_disables_cache(self):
+        cache = self.mk_cache(ttl=0)
+        self.assertFalse(cache.enabled())
+        cache.set("foo", "bar")
+        self.assertEqual(cache.get("foo"), None)
+
+    def test_zero_size_disables_cache(self):
+        cache = self.mk_cache(max_size=0)
+        self.assertFalse(cache.enabled())
+        cache.set("foo", "bar")
+        self.assertEqual(cache.get("foo"), None)
+
+    def test_pop(self):
+        cache = self.mk_cache()
+        cache.set("foo", "bar")
+        self.assertEqual(cache.pop("foo"), "bar")
+        self.assertEqual(cache.pop("foo"), None)
+        self.assertEqual(cache.pop("foo", "default"), "default")
+
+    def test_keys(self):
+        cache = self.mk_cache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(sorted(cache.keys()), ["a", "b"])
+
+    def test_clear(self):
+        cache = self.mk_cache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class TestRoutingTableVersionStore(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.versions = RoutingTableVersionStore(
+            self.redis.sub_manager('routing_table_versions'))
+
+    @inlineCallbacks
+    def test_get_version_unset(self):
+        version = yield self.versions.get_version(u"user-1")
+        self.assertEqual(version, None)
+
+    @inlineCallbacks
+    def test_bump_version(self):
+        yield self.versions.bump_version(u"user-1")
+        self.assertEqual((yield self.versions.get_version(u"user-1")), 1)
+        yield self.versions.bump_version(u"user-1")
+        self.assertEqual((yield self.versions.get_version(u"user-1")), 2)
+        self.assertEqual((yield self.versions.get_version(u"user-2")), None)
+
+
+class TestOutboundRoutingMetadataCache(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.cache = OutboundRoutingMetadataCache(
+            self.redis.sub_manager('outbound_routing_metadata'), 60)
+
+    @inlineCallbacks
+    def test_get_missing(self):
+        self.assertEqual((yield self.cache.get(u"msg-1")), None)
+
+    @inlineCallbacks
+    def test_set_and_get(self):
+        metadata = {'hops': [[['a', 'b'], ['c', 'd']]], 'tag': ['pool', 't']}
+        yield self.cache.set(u"msg-1", metadata)
+        self.assertEqual((yield self.cache.get(u"msg-1")), metadata)
+
+    @inlineCallbacks
+    def test_set_expires(self):
+        yield self.cache.set(u"msg-1", {})
+        ttl = yield self.cache.redis.ttl("outbound:msg-1")
+        self.assertTrue(0 < ttl <= 60)
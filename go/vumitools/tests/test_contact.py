@@ -316,3 +316,119 @@ class TestContactStore(VumiTestCase):
                                      msisdn=u'unknown')
         yield check_contact_for_addr('voice', u'+27831234567',
                                      msisdn=u'+27831234567')
+
+
+class TestContactStoreWithMembership(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.vumi_helper = yield self.add_helper(VumiApiHelper())
+        self.user_helper = yield self.vumi_helper.make_user(u'user')
+        self.store = self.user_helper.user_api.contact_store
+        self.membership = self.store.membership
+
+    @inlineCallbacks
+    def test_get_contacts_for_group_materializes_group(self):
+        group = yield self.store.new_group(u'group')
+        contact = yield self.store.new_contact(
+            msisdn=u'+27831234567', groups=[group])
+        self.assertFalse((yield self.membership.is_materialized(group.key)))
+        self.assertEqual(
+            (yield self.store.get_contacts_for_group(group)), [contact.key])
+        self.assertTrue((yield self.membership.is_materialized(group.key)))
+        self.assertEqual(
+            (yield self.membership.get_member_keys(group.key)), [contact.key])
+
+    @inlineCallbacks
+    def test_new_contact_updates_membership(self):
+        group = yield self.store.new_group(u'group')
+        self.assertEqual((yield self.store.get_contacts_for_group(group)), [])
+        contact = yield self.store.new_contact(
+            msisdn=u'+27831234567', groups=[group])
+        self.assertEqual(
+            (yield self.membership.get_member_keys(group.key)), [contact.key])
+
+    @inlineCallbacks
+    def test_update_contact_updates_membership(self):
+        group = yield self.store.new_group(u'group')
+        contact = yield self.store.new_contact(msisdn=u'+27831234567')
+        self.assertEqual((yield self.store.get_contacts_for_group(group)), [])
+        yield self.store.update_contact(contact.key, groups=[group])
+        self.assertEqual(
+            (yield self.membership.get_member_keys(group.key)), [contact.key])
+
+    @inlineCallbacks
+    def test_delete_contact_updates_membership(self):
+        group = yield self.store.new_group(u'group')
+        contact = yield self.store.new_contact(
+            msisdn=u'+27831234567', groups=[group])
+        yield self.store.get_contacts_for_group(group)
+        yield self.store.delete_contact(contact)
+        self.assertEqual((yield self.store.get_contacts_for_group(group)), [])
+
+    @inlineCallbacks
+    def test_update_group_membership(self):
+        group = yield self.store.new_group(u'group')
+        contact = yield self.store.new_contact(
+            msisdn=u'+27831234567', groups=[group])
+        yield self.store.get_contacts_for_group(group)
+        contact.groups.remove(group)
+        yield contact.save()
+        yield self.store.update_group_membership(
+            contact.key, removed_group_keys=[group.key])
+        self.assertEqual((yield self.store.get_contacts_for_group(group)), [])
+
+    @inlineCallbacks
+    def test_delete_group(self):
+        group = yield self.store.new_group(u'group')
+        yield self.store.get_contacts_for_group(group)
+        yield self.store.delete_group(group)
+        self.assertEqual((yield self.store.get_group(group.key)), None)
+        self.assertFalse((yield self.membership.is_materialized(group.key)))
+
+    @inlineCallbacks
+    def test_get_contacts_for_conversation(self):
+        group1 = yield self.store.new_group(u'group1')
+        group2 = yield self.store.new_group(u'group2')
+        contact1 = yield self.store.new_contact(
+            msisdn=u'+27831234567', groups=[group1])
+        contact2 = yield self.store.new_contact(
+            msisdn=u'+27831234568', groups=[group1, group2])
+        conv = yield self.user_helper.create_conversation(
+            u'bulk_message', groups=[group1, group2])
+        contact_keys = yield self.store.get_contacts_for_conversation(conv)
+        self.assertEqual(
+            sorted(contact_keys), sorted([contact1.key, contact2.key]))
+        self.assertTrue((yield self.membership.is_materialized(group1.key)))
+        self.assertTrue((yield self.membership.is_materialized(group2.key)))
+
+    @inlineCallbacks
+    def test_group_keys_for_addr(self):
+        group = yield self.store.new_group(u'group')
+        contact = yield self.store.new_contact(
+            msisdn=u'+27831234567', groups=[group])
+        self.assertEqual(
+            (yield self.store.group_keys_for_addr('sms', u'27831234567')),
+            [group.key])
+        self.assertEqual(
+            (yield self.membership.get_addr_groups(
+                self.user_helper.account_key, 'msisdn', u'+27831234567')),
+            [group.key])
+        # Changes to the contact's groups are picked up.
+        contact.groups.remove(group)
+        yield contact.save()
+        yield self.store.update_group_membership(
+            contact.key, removed_group_keys=[group.key])
+        self.assertEqual(
+            (yield self.store.group_keys_for_addr('sms', u'27831234567')), [])
+
+    @inlineCallbacks
+    def test_group_keys_for_addr_no_contact(self):
+        group = yield self.store.new_group(u'group')
+        self.assertEqual(
+            (yield self.store.group_keys_for_addr('sms', u'27831234567')), [])
+        # A new contact with the address replaces the cached result.
+        yield self.store.new_contact(msisdn=u'+27831234567', groups=[group])
+        self.assertEqual(
+            (yield self.store.group_keys_for_addr('sms', u'27831234567')),
+            [group.key])
@@ -2,8 +2,9 @@
 
 import copy
 import re
+import time
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 from twisted.internet.task import Clock, LoopingCall
 
 from vumi.tests.helpers import VumiTestCase
@@ -89,6 +90,7 @@ class TestGoMetricsWorker(VumiTestCase):
             self.conversation_names[conv.key] = conv.name
 
         self.assert_conversations_bucketed(worker, {})
+        yield worker.rebuild_running_conversations()
         with LogCatcher(message='Scheduled') as lc:
             yield worker.populate_conversation_buckets()
             [log_msg] = lc.messages()
@@ -117,6 +119,7 @@ class TestGoMetricsWorker(VumiTestCase):
             self.conversation_names[conv.key] = conv.name
 
         self.assert_conversations_bucketed(worker, {})
+        yield worker.rebuild_running_conversations()
         yield worker.populate_conversation_buckets()
         yield worker.process_bucket(2)
         self.assert_conversations_bucketed(worker, {
@@ -194,6 +197,43 @@ class TestGoMetricsWorker(VumiTestCase):
         self.assertEqual(
             cmd['kwargs']['user_account_key'], user_helper.account_key)
 
+    @inlineCallbacks
+    def test_send_metrics_batch_command(self):
+        worker = yield self.get_metrics_worker()
+
+        yield worker.send_metrics_batch_command(
+            [(u'acc1', u'conv1'), (u'acc2', u'conv2')], 'my_conv_application')
+        [cmd] = self.vumi_helper.get_dispatched_commands()
+
+        self.assertEqual(cmd['worker_name'], 'my_conv_application')
+        self.assertEqual(cmd['command'], 'collect_metrics_batch')
+        self.assertEqual(cmd['kwargs']['conversations'], [
+            [u'acc1', u'conv1'], [u'acc2', u'conv2']])
+
+    @inlineCallbacks
+    def test_process_bucket_batches(self):
+        worker = yield self.get_metrics_worker({'metrics_batch_size': 2})
+        worker._buckets[0] = [
+            (u'acc1', u'conv1', u'app1'),
+            (u'acc1', u'conv2', u'app1'),
+            (u'acc2', u'conv3', u'app1'),
+            (u'acc1', u'conv4', u'app2'),
+        ]
+
+        yield worker.process_bucket(0)
+        cmds = self.vumi_helper.get_dispatched_commands()
+        self.assertEqual(
+            [(c['worker_name'], c['command'], c['kwargs']) for c in cmds], [
+                (u'app1', 'collect_metrics_batch', {'conversations': [
+                    [u'acc1', u'conv1'], [u'acc1', u'conv2']]}),
+                (u'app1', 'collect_metrics', {
+                    'user_account_key': u'acc2', 'conversation_key': u'conv3',
+                }),
+                (u'app2', 'collect_metrics', {
+                    'user_account_key': u'acc1', 'conversation_key': u'conv4',
+                }),
+            ])
+
     @inlineCallbacks
     def setup_metric_loop_conversations(self, worker):
         user1_helper = yield self.vumi_helper.make_user(u'acc1')
@@ -205,6 +245,7 @@ class TestGoMetricsWorker(VumiTestCase):
         for conv in [conv0, conv1, conv2, conv3]:
             self.conversation_names[conv.key] = conv.name
 
+        yield worker.rebuild_running_conversations()
         returnValue([conv0, conv1, conv2, conv3])
 
     @inlineCallbacks
@@ -247,3 +288,134 @@ class TestGoMetricsWorker(VumiTestCase):
             2: [conv2],
             3: [conv3],
         })
+
+    @inlineCallbacks
+    def test_populate_conversation_buckets_from_registry(self):
+        worker = yield self.get_metrics_worker()
+        user_helper = yield self.vumi_helper.make_user(u'acc1')
+        conv1 = yield self.make_conv(user_helper, u'conv1', started=True)
+        conv2 = yield self.make_conv(user_helper, u'conv2')
+        for conv in [conv1, conv2]:
+            self.conversation_names[conv.key] = conv.name
+
+        with LogCatcher(message='Rebuilt') as lc:
+            yield worker.rebuild_running_conversations()
+            self.assertEqual(len(lc.messages()), 1)
+        yield worker.populate_conversation_buckets()
+        self.assert_conversations_bucketed(worker, {1: [conv1]})
+        yield worker.process_bucket(1)
+
+        # After that, only the registry is consulted.
+        yield worker.vumi_api.running_conversations.add(
+            user_helper.account_key, conv2.key, u'my_conv_application')
+        with LogCatcher(message='Rebuilt') as lc:
+            yield worker.populate_conversation_buckets()
+            self.assertEqual(lc.messages(), [])
+        self.assert_conversations_bucketed(worker, {
+            1: [conv1],
+            2: [conv2],
+        })
+
+    @inlineCallbacks
+    def test_populate_conversation_buckets_skips_disabled_accounts(self):
+        worker = yield self.get_metrics_worker()
+        user1_helper = yield self.vumi_helper.make_user(u'acc1')
+        user2_helper = yield self.vumi_helper.make_user(u'acc2')
+        conv1 = yield self.make_conv(user1_helper, u'conv1', started=True)
+        conv2 = yield self.make_conv(user2_helper, u'conv2', started=True)
+        for conv in [conv1, conv2]:
+            self.conversation_names[conv.key] = conv.name
+        yield worker.redis.sadd(
+            'disabled_metrics_accounts', user2_helper.account_key)
+
+        yield worker.rebuild_running_conversations()
+        registry = worker.vumi_api.running_conversations
+        slot_convs = yield registry.get_conversations(
+            registry.slot_for_conversation(conv2.key))
+        self.assertFalse(conv2.key in [key for _, key, _ in slot_convs])
+
+        # Conversations added by application workers are still skipped.
+        yield registry.add(
+            user2_helper.account_key, conv2.key, u'my_conv_application')
+        yield worker.populate_conversation_buckets()
+        self.assert_conversations_bucketed(worker, {1: [conv1]})
+
+    @inlineCallbacks
+    def test_rebuild_running_conversations_removes_stopped(self):
+        worker = yield self.get_metrics_worker()
+        user_helper = yield self.vumi_helper.make_user(u'acc1')
+        conv1 = yield self.make_conv(user_helper, u'conv1', started=True)
+        conv2 = yield self.make_conv(user_helper, u'conv2')
+        registry = worker.vumi_api.running_conversations
+        # The application worker never saw the conversation stop.
+        yield registry.add(
+            user_helper.account_key, conv2.key, u'my_conv_application')
+
+        yield worker.rebuild_running_conversations()
+        convs = []
+        for slot in set(registry.slot_for_conversation(conv.key)
+                        for conv in [conv1, conv2]):
+            slot_convs = yield registry.get_conversations(slot)
+            convs.extend(key for _, key, _ in slot_convs)
+        self.assertEqual(convs, [conv1.key])
+
+    @inlineCallbacks
+    def test_populate_conversation_buckets_shared(self):
+        worker = yield self.get_metrics_worker({
+            'metrics_worker_id': 'worker1',
+        })
+        registry = worker.vumi_api.running_conversations
+        yield registry.heartbeat('worker2', time.time(), 600)
+
+        user_helper = yield self.vumi_helper.make_user(u'acc1')
+        convs = []
+        for i in range(10):
+            conv = yield self.make_conv(
+                user_helper, u'conv%d' % (i,), started=True)
+            self.conversation_names[conv.key] = conv.name
+            convs.append(conv)
+
+        yield worker.rebuild_running_conversations()
+        yield worker.populate_conversation_buckets()
+        slots = registry.slots_for_worker('worker1', ['worker1', 'worker2'])
+        self.assert_conversations_bucketed(worker, dict(
+            (i, [conv]) for i, conv in enumerate(convs)
+            if registry.slot_for_conversation(conv.key) in slots))
+
+    @inlineCallbacks
+    def test_populate_conversation_buckets_starts_rebuild(self):
+        worker = yield self.get_metrics_worker()
+        rebuilds = []
+
+        def rebuild_running_conversations():
+            d = Deferred()
+            rebuilds.append(d)
+            return d
+
+        worker.rebuild_running_conversations = rebuild_running_conversations
+        # The rebuild runs in the background and only one runs at a time.
+        yield worker.populate_conversation_buckets()
+        yield worker.populate_conversation_buckets()
+        self.assertEqual(len(rebuilds), 1)
+        rebuilds[0].callback(None)
+        yield worker.populate_conversation_buckets()
+        self.assertEqual(len(rebuilds), 2)
+        rebuilds[1].callback(None)
+
+    @inlineCallbacks
+    def test_rebuild_running_conversations_locked(self):
+        worker = yield self.get_metrics_worker()
+        registry = worker.vumi_api.running_conversations
+        user_helper = yield self.vumi_helper.make_user(u'acc1')
+        yield self.make_conv(user_helper, u'conv1', started=True)
+
+        # Another worker is rebuilding the registry.
+        yield registry.acquire_rebuild_lock()
+        yield worker.rebuild_running_conversations()
+        self.assertFalse((yield registry.is_complete()))
+
+        yield registry.release_rebuild_lock()
+        yield worker.rebuild_running_conversations()
+        self.assertTrue((yield registry.is_complete()))
+        # The lock is released once the rebuild is done.
+        self.assertTrue((yield registry.acquire_rebuild_lock()))
@@ -443,7 +443,7 @@ class RoutingTableDispatcherTestCase(VumiTestCase):
 
 class TestRoutingTableDispatcher(RoutingTableDispatcherTestCase):
 
-    def get_dispatcher(self):
+    def get_dispatcher(self, **extra_config):
         config = self.vumi_helper.mk_config({
             "receive_inbound_connectors": [
                 "sphex", "router_ro"
@@ -464,6 +464,7 @@ class TestRoutingTableDispatcher(RoutingTableDispatcherTestCase):
             },
             "opt_out_connector": "optout",
         })
+        config.update(extra_config)
         return self.vumi_helper.get_worker_helper().get_worker(
             AccountRoutingTableDispatcher, config)
 
@@ -767,6 +768,115 @@ class TestRoutingTableDispatcher(RoutingTableDispatcherTestCase):
         ])
         self.assertEqual([msg], self.get_dispatched_outbound('sphex'))
 
+    @inlineCallbacks
+    def test_outbound_message_to_transport_caches_routing_metadata(self):
+        dispatcher = yield self.get_dispatcher()
+        msg = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+        metadata = yield dispatcher.outbound_metadata_cache.get(
+            msg['message_id'])
+        self.assertEqual(metadata, {
+            'hops': [
+                [['CONVERSATION:app1:conv1', 'default'],
+                 ['TRANSPORT_TAG:pool1:1234', 'default']],
+            ],
+            'is_reply_to_unroutable': False,
+            'tag': ['pool1', '1234'],
+            'user_account': self.user_account_key,
+        })
+
+    @inlineCallbacks
+    def test_event_routing_with_cached_routing_metadata(self):
+        yield self.get_dispatcher()
+        msg = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+        [sent_msg] = self.get_dispatched_outbound('sphex')
+        # The outbound message isn't in the message store, so the event can
+        # only be routed using the cached metadata.
+        ack = self.msg_helper.make_ack(sent_msg)
+        yield self.dispatch_event(ack, 'sphex')
+        self.with_md(ack, tag=('pool1', '1234'), conv=('app1', 'conv1'),
+                     hops=[
+                         ['TRANSPORT_TAG:pool1:1234', 'default'],
+                         ['CONVERSATION:app1:conv1', 'default'],
+                     ], outbound_hops_from=sent_msg)
+        self.assertEqual([ack], self.get_dispatched_events('app1'))
+
+    @inlineCallbacks
+    def test_outbound_metadata_cache_disabled(self):
+        dispatcher = yield self.get_dispatcher(outbound_metadata_ttl=0)
+        self.assertEqual(dispatcher.outbound_metadata_cache, None)
+        msg = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+        self.assertEqual(1, len(self.get_dispatched_outbound('sphex')))
+
+    @inlineCallbacks
+    def test_routing_table_cached(self):
+        dispatcher = yield self.get_dispatcher()
+        msg1 = self.with_md(
+            self.msg_helper.make_inbound("foo"), tag=("pool1", "1234"))
+        msg2 = self.with_md(
+            self.msg_helper.make_inbound("bar"), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg1, 'sphex')
+        yield self.dispatch_inbound(msg2, 'sphex')
+        self.assertEqual(
+            [msg1['message_id'], msg2['message_id']],
+            [m['message_id'] for m in self.get_dispatched_inbound('app1')])
+        self.assertEqual(
+            (dispatcher.tag_cache.hits, dispatcher.tag_cache.misses), (1, 1))
+        self.assertEqual(
+            (dispatcher.routing_table_cache.hits,
+             dispatcher.routing_table_cache.misses), (1, 1))
+
+    @inlineCallbacks
+    def test_routing_table_cache_discarded_on_change(self):
+        dispatcher = yield self.get_dispatcher()
+        msg1 = self.with_md(
+            self.msg_helper.make_inbound("foo"), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg1, 'sphex')
+        self.assertEqual(1, len(self.get_dispatched_inbound('app1')))
+
+        user_api = self.user_helper.user_api
+        user_account = yield user_api.get_user_account()
+        user_account.routing_table.add_entry(
+            "TRANSPORT_TAG:pool1:1234", "default",
+            "CONVERSATION:app2:conv2", "default")
+        yield user_api.save_routing_table(user_account)
+
+        msg2 = self.with_md(
+            self.msg_helper.make_inbound("bar"), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg2, 'sphex')
+        self.assertEqual(1, len(self.get_dispatched_inbound('app1')))
+        self.assertEqual(1, len(self.get_dispatched_inbound('app2')))
+        self.assertEqual(dispatcher.routing_table_cache.misses, 2)
+
+    @inlineCallbacks
+    def test_routing_table_cache_disabled(self):
+        dispatcher = yield self.get_dispatcher(routing_cache_ttl=0)
+        for content in ["foo", "bar"]:
+            msg = self.with_md(
+                self.msg_helper.make_inbound(content), tag=("pool1", "1234"))
+            yield self.dispatch_inbound(msg, 'sphex')
+        self.assertEqual(2, len(self.get_dispatched_inbound('app1')))
+        self.assertEqual(dispatcher.routing_table_cache.hits, 0)
+        self.assertEqual(dispatcher.tag_cache.hits, 0)
+
+    @inlineCallbacks
+    def test_process_command_invalidate_routing_table(self):
+        dispatcher = yield self.get_dispatcher()
+        msg = self.with_md(
+            self.msg_helper.make_inbound("foo"), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg, 'sphex')
+        self.assertTrue(
+            self.user_account_key in dispatcher.routing_table_cache)
+        dispatcher.process_command_invalidate_routing_table(
+            self.user_account_key)
+        self.assertFalse(
+            self.user_account_key in dispatcher.routing_table_cache)
+
 
 class TestRoutingTableDispatcherWithBilling(RoutingTableDispatcherTestCase):
 
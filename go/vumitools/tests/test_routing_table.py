@@ -4,7 +4,7 @@ from vumi.tests.helpers import VumiTestCase
 from vumi.tests.utils import LogCatcher
 
 from go.vumitools.routing_table import (
-    RoutingTable, GoConnector, GoConnectorError)
+    RoutingTable, CompiledRoutingTable, GoConnector, GoConnectorError)
 
 
 class FakeConversation(object):
@@ -340,6 +340,66 @@ class TestRoutingTable(VumiTestCase):
         add_entry(self.CONV_1, "bar", self.CONV_1, "baz")
         self.assertRaises(ValueError, rt.validate_all_entries)
 
+    def test_compiled_is_shared(self):
+        rt = self.make_rt()
+        compiled = rt.compiled()
+        self.assertTrue(isinstance(compiled, CompiledRoutingTable))
+        self.assertTrue(rt.compiled() is compiled)
+
+    def test_compiled_discarded_on_add_entry(self):
+        rt = self.make_rt()
+        compiled = rt.compiled()
+        rt.add_entry(self.CHANNEL_2, "default2", self.CONV_2, "default")
+        self.assertFalse(rt.compiled() is compiled)
+        self.assertEqual(rt.lookup_target(self.CHANNEL_2, "default2"),
+                         [GoConnector.parse(self.CONV_2), "default"])
+
+    def test_compiled_discarded_on_remove_entry(self):
+        rt = self.make_rt()
+        compiled = rt.compiled()
+        rt.remove_entry(self.CONV_1, "default1.1")
+        self.assertFalse(rt.compiled() is compiled)
+        self.assertEqual(rt.lookup_source(self.CHANNEL_2, "default2"), None)
+
+    def test_compiled_discarded_on_remove_connector(self):
+        rt = self.make_rt()
+        compiled = rt.compiled()
+        rt.remove_connector(self.CHANNEL_3)
+        self.assertFalse(rt.compiled() is compiled)
+        self.assertEqual(rt.lookup_sources(self.CHANNEL_3), [])
+
+    def test_compiled_interns_connectors(self):
+        rt = self.make_rt(copy.deepcopy(self.COMPLEX_ROUTING))
+        conns = [c for entry in rt.entries() for c in (entry[0], entry[2])
+                 if str(c) == self.ROUTER_1_OUTBOUND]
+        self.assertEqual(len(conns), 4)
+        self.assertEqual(len(set(id(c) for c in conns)), 1)
+        self.assertTrue(
+            rt.compiled().connector(self.ROUTER_1_OUTBOUND) is conns[0])
+
+    def test_compiled_transitive_targets_memoized(self):
+        rt = self.make_rt(copy.deepcopy(self.COMPLEX_ROUTING))
+        compiled = rt.compiled()
+        targets = rt.transitive_targets(self.CHANNEL_2)
+        self.assert_connectors(targets, [
+            self.ROUTER_1_INBOUND, self.CONV_1, self.CONV_2])
+        # Mutating the result must not affect later lookups.
+        targets.clear()
+        self.assert_connectors(rt.transitive_targets(self.CHANNEL_2), [
+            self.ROUTER_1_INBOUND, self.CONV_1, self.CONV_2])
+        self.assertEqual(compiled._transitive_targets.keys(),
+                         [self.CHANNEL_2])
+
+    def test_validate_all_entries_recompiles(self):
+        rt = self.make_rt()
+        compiled = rt.compiled()
+        rt._routing_table[self.CHANNEL_2] = {
+            "default": [self.CONV_2, "default"]}
+        rt.validate_all_entries()
+        self.assertFalse(rt.compiled() is compiled)
+        self.assertEqual(rt.lookup_target(self.CHANNEL_2, "default"),
+                         [GoConnector.parse(self.CONV_2), "default"])
+
 
 class TestGoConnector(VumiTestCase):
     def test_create_conversation_connector(self):
@@ -98,7 +98,7 @@ class WizardCreateView(BaseWizardView):
         tag_conn = channel.get_connector()
         routing_table.add_entry(conv_conn, "default", tag_conn, "default")
         routing_table.add_entry(tag_conn, "default", conv_conn, "default")
-        user_account.save()
+        request.user_api.save_routing_table(user_account)
 
 
 @login_required